@@ -0,0 +1,85 @@
+import time
+import threading
+from collections import OrderedDict
+from .config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+
+class TokenCache:
+    """Bounded TTL cache of verified access tokens.
+
+    Each entry holds the decoded claims and a snapshot of the user, so a
+    repeat request with the same token skips both ``jwt.decode`` and the
+    user query. Entries never outlive the token's ``exp`` claim and are
+    dropped as soon as the user is updated or deactivated.
+
+    Every invalidation bumps ``generation``. A caller reads it before
+    loading the user and passes it to ``put``, which then refuses to cache
+    a snapshot that an invalidation may have overtaken in the meantime.
+    """
+
+    def __init__(self, max_entries: int = AUTH_CACHE_SIZE, ttl: float = AUTH_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.generation = 0
+        self._entries = OrderedDict()  # token -> (expires_at, claims, user)
+        self._tokens_by_user = {}  # user id -> set of tokens
+        self._lock = threading.Lock()
+
+    def get(self, token: str):
+        """Return ``(claims, user)`` for a cached token, or None."""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, token: str, claims: dict, user, generation: int = None):
+        """Cache ``user`` for ``token``, unless an invalidation ran after ``generation`` was read."""
+        expires_at = min(time.time() + self.ttl, claims.get("exp", 0))
+        with self._lock:
+            if expires_at <= time.time() or (generation is not None and generation != self.generation):
+                return
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (expires_at, claims, user)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        """Forget every cached token that belongs to a user."""
+        with self._lock:
+            self.generation += 1
+            for token in list(self._tokens_by_user.get(user_id, ())):
+                self._remove(token)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "entries": len(self._entries),
+            }
+
+    def _remove(self, token: str):
+        _, _, user = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(user.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user.id]
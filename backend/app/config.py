@@ -0,0 +1,52 @@
+import os
+import sys
+
+# Database
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./sql_app.db")  # Must name an async driver
+DATABASE_PROFILE = os.getenv("DATABASE_PROFILE", "production")  # "production" or "default" (driver defaults)
+# SQLite has a single writer, so a small pool queues writers fairly instead of leaving them in busy_timeout
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", "0"))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", "30"))  # Seconds to wait for a free connection
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # Safe with WAL; only the last commits can be lost on power failure
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # Bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # Negative values are KiB per connection
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # Milliseconds a writer waits for the lock
+
+# Image generation
+GENERATORS_DIR = os.getenv(
+    "GENERATORS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "modules_ext", "image_generation"),
+)
+GENERATED_IMAGES_DIR = os.getenv("GENERATED_IMAGES_DIR", "./generated_images")
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", str(365 * 24 * 3600)))  # Content-addressed, so never stale
+DERIVATIVE_WIDTHS = [int(width) for width in os.getenv("DERIVATIVE_WIDTHS", "320,640").split(",")]  # Thumbnail sizes served
+DERIVATIVE_WORKERS = int(os.getenv("DERIVATIVE_WORKERS", "2"))  # Processes that resize images on first request
+GENERATION_MODEL = os.getenv("GENERATION_MODEL", "runwayml/stable-diffusion-v1-5")
+GENERATION_EXECUTOR = os.getenv("GENERATION_EXECUTOR", "thread")  # "thread", "process" or "worker"
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "1"))  # Jobs that may run at the same time
+MAX_JOBS_PER_USER = int(os.getenv("MAX_JOBS_PER_USER", "1"))  # Running jobs allowed per user
+# Queue priority per account as "email=priority,..."; everyone else gets 0, and clients cannot choose it
+JOB_PRIORITIES = {
+    email.strip().lower(): int(priority)
+    for email, _, priority in (entry.partition("=") for entry in os.getenv("JOB_PRIORITIES", "").split(",") if entry.strip())
+}
+GENERATION_CPU_OPTIMIZED = os.getenv("GENERATION_CPU_OPTIMIZED", "0") == "1"  # CPU inference profile when there is no GPU
+GENERATION_COMPILE = os.getenv("GENERATION_COMPILE", "0") == "1"  # torch.compile the UNet in that profile
+LINE_ART_OUTPUT = os.getenv("LINE_ART_OUTPUT", "1") == "1"  # Clean results into 1-bit line art before storing
+GENERATION_TRACE_LOG_PATH = os.getenv("GENERATION_TRACE_LOG_PATH", "")  # JSON line of stage timings per image; empty disables
+
+def import_generators():
+    """Make the generator scripts in GENERATORS_DIR importable."""
+    if GENERATORS_DIR not in sys.path:
+        sys.path.insert(0, GENERATORS_DIR)
+
+# Authentication
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))  # Verified tokens kept in memory
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "300"))  # Seconds, capped by each token's exp
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # Hashes at any other cost are upgraded on login
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))  # Beyond this, reply 503
+
+# Observability
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "")  # JSON line per request with its bcrypt/JWT/DB spans; empty disables
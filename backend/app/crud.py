@@ -1,24 +1,42 @@
+import base64
+from sqlalchemy import event, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from . import models, schemas
-from passlib.context import CryptContext
+from . import models, schemas, telemetry
+from .auth_cache import TokenCache
+from .config import JOB_PRIORITIES
+from .database import SessionLocal, AsyncSessionLocal
+from .passwords import pwd_context, password_hasher
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from fastapi import HTTPException, status
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 # JWT settings
 SECRET_KEY = "your-secret-key-here"  # Change this in production
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Verified tokens, so hot tokens skip jwt.decode and the user query
+token_cache = TokenCache()
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _invalidate_cached_tokens(mapper, connection, target):
+    token_cache.invalidate_user(target.id)
+
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
+async def get_user_async(db: AsyncSession, user_id: int):
+    return await db.get(models.User, user_id)
+
+async def get_user_by_email_async(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
 def create_user(db: Session, user: schemas.UserCreate):
     hashed_password = pwd_context.hash(user.password)
     db_user = models.User(
@@ -32,6 +50,47 @@ def create_user(db: Session, user: schemas.UserCreate):
     db.refresh(db_user)
     return db_user
 
+async def create_user_async(db: AsyncSession, user: schemas.UserCreate):
+    hashed_password = await password_hasher.hash(user.password)
+    db_user = models.User(
+        email=user.email,
+        first_name=user.first_name,
+        last_name=user.last_name,
+        hashed_password=hashed_password
+    )
+    db.add(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    return db_user
+
+def update_user(db: Session, user_id: int, **fields):
+    db_user = get_user(db, user_id)
+    if db_user is None:
+        return None
+    for name, value in fields.items():
+        setattr(db_user, name, value)
+    db.commit()
+    db.refresh(db_user)
+    token_cache.invalidate_user(user_id)
+    return db_user
+
+async def update_user_async(db: AsyncSession, user_id: int, **fields):
+    db_user = await get_user_async(db, user_id)
+    if db_user is None:
+        return None
+    for name, value in fields.items():
+        setattr(db_user, name, value)
+    await db.commit()
+    await db.refresh(db_user)
+    token_cache.invalidate_user(user_id)
+    return db_user
+
+def deactivate_user(db: Session, user_id: int):
+    return update_user(db, user_id, is_active=False)
+
+async def deactivate_user_async(db: AsyncSession, user_id: int):
+    return await update_user_async(db, user_id, is_active=False)
+
 def authenticate_user(db: Session, email: str, password: str):
     user = get_user_by_email(db, email)
     if not user:
@@ -40,27 +99,189 @@ def authenticate_user(db: Session, email: str, password: str):
         return False
     return user
 
+async def authenticate_user_async(db: AsyncSession, email: str, password: str):
+    user = await get_user_by_email_async(db, email)
+    if not user:
+        return False
+    valid, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not valid:
+        return False
+    if new_hash:
+        # Stored with a different bcrypt cost; upgrade it now that we know the password
+        user.hashed_password = new_hash
+        await db.commit()
+        await db.refresh(user)
+    return user
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    with telemetry.span("jwt"):
+        encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(db: Session, token: str):
-    credentials_exception = HTTPException(
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _decode_token(token: str):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
+        with telemetry.span("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
-        raise credentials_exception
-    user = get_user_by_email(db, email=email)
-    if user is None:
-        raise credentials_exception
-    return user
\ No newline at end of file
+        raise _credentials_exception()
+    if payload.get("sub") is None:
+        raise _credentials_exception()
+    return payload
+
+def _cache_snapshot(token: str, payload: dict, user, generation: int):
+    if user is None or not user.is_active:
+        raise _credentials_exception()
+    snapshot = schemas.User.model_validate(user, from_attributes=True)
+    token_cache.put(token, payload, snapshot, generation)
+    return snapshot
+
+def get_current_user(db: Session, token: str):
+    """Return a snapshot (``schemas.User``) of the user a token belongs to."""
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached[1]
+    payload = _decode_token(token)
+    generation = token_cache.generation  # Read before the user, so a deactivation during the query is noticed
+    return _cache_snapshot(token, payload, get_user_by_email(db, email=payload["sub"]), generation)
+
+async def get_current_user_async(db: AsyncSession, token: str):
+    """Async ``get_current_user``; a cached token never touches the database."""
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached[1]
+    payload = _decode_token(token)
+    generation = token_cache.generation  # Read before the user, so a deactivation during the query is noticed
+    return _cache_snapshot(token, payload, await get_user_by_email_async(db, email=payload["sub"]), generation)
+
+def job_priority(user: models.User):
+    """Queue priority for ``user``'s jobs, set by the server in JOB_PRIORITIES."""
+    return JOB_PRIORITIES.get(user.email.lower(), 0)
+
+def create_job(db: Session, owner_id: int, request: schemas.GenerationRequest, priority: int = 0):
+    db_job = models.GenerationJob(
+        owner_id=owner_id,
+        prompt=request.prompt,
+        width=request.width,
+        height=request.height,
+        priority=priority,
+        previews=request.previews,
+    )
+    db.add(db_job)
+    db.commit()
+    db.refresh(db_job)
+    return db_job
+
+async def create_job_async(db: AsyncSession, owner_id: int, request: schemas.GenerationRequest, priority: int = 0):
+    db_job = models.GenerationJob(
+        owner_id=owner_id,
+        prompt=request.prompt,
+        width=request.width,
+        height=request.height,
+        priority=priority,
+        previews=request.previews,
+    )
+    db.add(db_job)
+    await db.commit()
+    await db.refresh(db_job)
+    return db_job
+
+def get_job(db: Session, job_id: int, owner_id: int):
+    return db.query(models.GenerationJob).filter(
+        models.GenerationJob.id == job_id, models.GenerationJob.owner_id == owner_id
+    ).first()
+
+async def get_job_async(db: AsyncSession, job_id: int, owner_id: int):
+    result = await db.execute(select(models.GenerationJob).where(
+        models.GenerationJob.id == job_id, models.GenerationJob.owner_id == owner_id
+    ))
+    return result.scalars().first()
+
+def get_job_status(job_id: int):
+    db = SessionLocal()
+    try:
+        job = db.query(models.GenerationJob.status).filter(models.GenerationJob.id == job_id).first()
+        return job.status if job else None
+    finally:
+        db.close()
+
+async def get_job_status_async(job_id: int):
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(select(models.GenerationJob.status).where(models.GenerationJob.id == job_id))
+        return result.scalars().first()
+
+def get_unfinished_jobs(db: Session):
+    return db.query(models.GenerationJob).filter(
+        models.GenerationJob.status.in_(["queued", "running"])
+    ).all()
+
+def create_creation(db: Session, job: models.GenerationJob, content_hash: str, lqip: str = None):
+    """Record the image a finished job produced in its owner's creations."""
+    db_creation = models.Creation(
+        owner_id=job.owner_id,
+        job_id=job.id,
+        title=job.prompt if len(job.prompt) <= 60 else job.prompt[:57].rstrip() + "...",
+        description=job.prompt,
+        image_path=job.result_path,
+        content_hash=content_hash,
+        lqip=lqip,
+        width=job.width,
+        height=job.height,
+    )
+    db.add(db_creation)
+    db.commit()
+    db.refresh(db_creation)
+    return db_creation
+
+def encode_cursor(created_at: datetime, creation_id: int):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{creation_id}".encode()).decode("ascii")
+
+def decode_cursor(cursor: str):
+    try:
+        created_at, creation_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode().split("|")
+        return datetime.fromisoformat(created_at), int(creation_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def get_creations_page_async(db: AsyncSession, owner_id: int, limit: int, cursor: str = None):
+    """Return ``(rows, next_cursor)`` for one page of a user's creations, newest first.
+
+    Pages are keyset-paginated on ``(created_at, id)``, so every page is a
+    range scan of ``ix_creations_owner_created_id`` however deep it is.
+    Only the columns the grid renders are selected.
+    """
+    query = select(
+        models.Creation.id,
+        models.Creation.title,
+        models.Creation.description,
+        models.Creation.width,
+        models.Creation.height,
+        models.Creation.created_at,
+        models.Creation.content_hash,
+        models.Creation.lqip,
+    ).where(models.Creation.owner_id == owner_id)
+    if cursor:
+        query = query.where(
+            tuple_(models.Creation.created_at, models.Creation.id) < tuple_(*decode_cursor(cursor))
+        )
+    query = query.order_by(models.Creation.created_at.desc(), models.Creation.id.desc()).limit(limit + 1)
+    rows = (await db.execute(query)).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1].created_at, rows[-1].id)
+
+async def get_image_path_async(db: AsyncSession, content_hash: str):
+    result = await db.execute(
+        select(models.Creation.image_path).where(models.Creation.content_hash == content_hash).limit(1)
+    )
+    return result.scalars().first()
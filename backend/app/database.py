@@ -1,12 +1,61 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from . import telemetry
+from .config import (
+    DATABASE_URL, DATABASE_PROFILE, DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW, DATABASE_POOL_TIMEOUT,
+    SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT,
+)
+
+SQLALCHEMY_DATABASE_URL = DATABASE_URL
+
+_url = make_url(SQLALCHEMY_DATABASE_URL)
+_is_sqlite = _url.get_backend_name() == "sqlite"
+_tuned = DATABASE_PROFILE == "production"
+_in_memory = _is_sqlite and _url.database in (None, "", ":memory:")  # Uses a single-connection pool
+
+# A sized pool in place of the default, so bursts wait briefly for a connection instead of failing
+_pool_options = dict(
+    pool_size=DATABASE_POOL_SIZE,
+    max_overflow=DATABASE_MAX_OVERFLOW,
+    pool_timeout=DATABASE_POOL_TIMEOUT,
+    pool_pre_ping=not _is_sqlite,
+) if _tuned and not _in_memory else {}
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+def apply_sqlite_profile(dbapi_connection, connection_record):
+    """Set the production PRAGMAs on every new SQLite connection.
 
+    WAL lets readers run alongside the single writer, and ``busy_timeout``
+    makes concurrent writers queue for the lock instead of failing with
+    "database is locked".
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.close()
+
+# Request handlers use the async engine so queries never block the event loop
+async_engine = create_async_engine(SQLALCHEMY_DATABASE_URL, **_pool_options)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# Generation worker threads and table creation use a sync engine on the same database
+SYNC_DATABASE_URL = _url.set(drivername=_url.get_backend_name())
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SYNC_DATABASE_URL, connect_args={"check_same_thread": False} if _is_sqlite else {}, **_pool_options
 )
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+# Every statement shows up as a "db" span in the request metrics and trace log
+telemetry.time_queries(async_engine.sync_engine)
+telemetry.time_queries(engine)
+
+if _is_sqlite and _tuned:
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_profile)
+    event.listen(engine, "connect", apply_sqlite_profile)
+
+Base = declarative_base()
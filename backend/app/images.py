@@ -0,0 +1,57 @@
+import os
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from .config import DERIVATIVE_WORKERS
+from .jobs import import_generators
+
+import_generators()
+import derivatives  # noqa: E402  (lives in GENERATORS_DIR)
+import regions  # noqa: E402
+
+class DerivativeRenderer:
+    """Make image thumbnails and region maps on first request, in a small process pool.
+
+    Finished files stay on disk next to the source image, so only the
+    first request pays for the work. Concurrent requests for the same
+    file share one render.
+    """
+
+    def __init__(self, workers: int = DERIVATIVE_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._inflight = {}  # derivative path -> asyncio.Future
+        self._lock = threading.Lock()
+
+    async def render(self, image_path: str, content_hash: str, width: int, fmt: str):
+        """Return the path of the thumbnail, making it first if needed."""
+        path = derivatives.derivative_path(image_path, width, fmt, content_hash)
+        return await self._render(path, derivatives.make_derivative, image_path, width, fmt, content_hash)
+
+    async def render_regions(self, image_path: str, content_hash: str):
+        """Return the path of the image's region map, computing it first if needed."""
+        path = regions.regions_path(image_path, content_hash)
+        return await self._render(path, regions.write_regions, image_path, content_hash)
+
+    async def _render(self, path: str, func, *args):
+        if os.path.exists(path):
+            return path
+        future = self._inflight.get(path)
+        if future is None:
+            with self._lock:
+                if self._executor is None:
+                    context = multiprocessing.get_context("spawn")
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+            self._inflight[path] = future
+            future.add_done_callback(lambda _: self._inflight.pop(path, None))
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+renderer = DerivativeRenderer()
@@ -0,0 +1,270 @@
+import io
+import os
+import queue
+import base64
+import itertools
+import threading
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from . import models, crud
+from .config import (
+    GENERATED_IMAGES_DIR, GENERATION_MODEL, import_generators,
+    GENERATION_EXECUTOR, GENERATION_WORKERS, MAX_JOBS_PER_USER, LINE_ART_OUTPUT,
+    GENERATION_CPU_OPTIMIZED, GENERATION_COMPILE, GENERATION_TRACE_LOG_PATH,
+)
+from .database import SessionLocal
+
+# Pipeline loaded once per thread-pool process or pool worker process
+_pipe = None
+_pipe_lock = threading.Lock()
+
+def _encode_preview(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+def finish_image(path: str):
+    """Post-process a freshly generated image in place, in the executor that made it."""
+    if LINE_ART_OUTPUT:
+        from lineart import convert_file
+        convert_file(path, path)
+    # Precompute the fill regions so the coloring UI never waits for them
+    from regions import write_regions
+    write_regions(path)
+    return path
+
+def run_generation(spec: dict, progress_queue=None):
+    """Generate one image in this process, loading the pipeline on first use.
+
+    Per-step progress is put on ``progress_queue`` as ``(job_id, event)`` pairs.
+    """
+    global _pipe
+    import_generators()
+    import torch
+    from generate_local_diffusers import load_model, generate_image, latents_to_preview
+
+    def report(step, total_steps, latents):
+        event = {"status": "running", "step": step, "total_steps": total_steps}
+        if spec.get("previews"):
+            event["preview"] = _encode_preview(latents_to_preview(latents))
+        progress_queue.put((spec["job_id"], event))
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    with _pipe_lock:
+        if _pipe is None:
+            if GENERATION_TRACE_LOG_PATH:
+                import instrumentation
+                instrumentation.enable_trace_log(GENERATION_TRACE_LOG_PATH)
+            cpu_profile = None
+            if GENERATION_CPU_OPTIMIZED and device == "cpu":
+                from cpu_inference import CpuProfile, available_cpus
+                # Pool processes each hold a pipeline, so they split the cores between them
+                workers = GENERATION_WORKERS if GENERATION_EXECUTOR == "process" else 1
+                threads = max(1, available_cpus() // workers)
+                cpu_profile = CpuProfile(threads, compile_unet=GENERATION_COMPILE)
+            _pipe = load_model(GENERATION_MODEL, device, cpu_profile)
+        if not generate_image(_pipe, spec["prompt"], spec["output_path"], spec["width"], spec["height"], device=device,
+                              progress_callback=report if progress_queue is not None else None):
+            raise RuntimeError("Image generation failed")
+    return finish_image(spec["output_path"])
+
+def run_on_worker(spec: dict, progress_queue=None):
+    """Generate one image on the resident generation worker.
+
+    The worker reports step counts but not previews.
+    """
+    import_generators()
+    from generation_worker import DEFAULT_WORKER_URL, submit_job, wait_for_job
+
+    def report(job):
+        if progress_queue is not None and job["status"] == "running" and job["step"]:
+            progress_queue.put((spec["job_id"], {"status": "running", "step": job["step"], "total_steps": job["total_steps"]}))
+
+    job_id = submit_job(DEFAULT_WORKER_URL, spec["prompt"], spec["output_path"], spec["width"], spec["height"])
+    result = wait_for_job(DEFAULT_WORKER_URL, job_id, on_update=report)
+    if result["status"] != "done":
+        raise RuntimeError(result.get("error", "Image generation failed on the worker"))
+    return finish_image(spec["output_path"])
+
+def create_executor(kind: str, max_workers: int):
+    """Return ``(executor, task, progress_queue)`` for the configured executor kind."""
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers), run_generation, queue.Queue()
+    if kind == "process":
+        # Spawn rather than fork so each worker starts with a clean torch runtime
+        context = multiprocessing.get_context("spawn")
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        return executor, run_generation, context.Manager().Queue()
+    if kind == "worker":
+        return ThreadPoolExecutor(max_workers=max_workers), run_on_worker, queue.Queue()
+    raise ValueError(f"Unknown generation executor: {kind}")
+
+class JobDispatcher:
+    """Feed queued generation jobs to an executor.
+
+    Jobs are started highest priority first (oldest first within a
+    priority), at most ``max_workers`` at a time and at most
+    ``max_per_user`` per user. Job state is persisted in the
+    ``generation_jobs`` table so clients can poll it, and every state
+    change and denoising step is published to ``broker`` for streaming.
+    """
+
+    def __init__(self, kind: str = GENERATION_EXECUTOR, max_workers: int = GENERATION_WORKERS,
+                 max_per_user: int = MAX_JOBS_PER_USER, broker=None):
+        self.max_workers = max_workers
+        self.max_per_user = max_per_user
+        self.broker = broker
+        self._executor, self._task, self._progress = create_executor(kind, max_workers)
+        self._pending = []  # (-priority, sequence, job_id, owner_id)
+        self._running = {}  # job_id -> (owner_id, future)
+        self._per_user = Counter()
+        self._cancelled = set()
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._relay_progress, daemon=True).start()
+
+    def submit(self, job: models.GenerationJob):
+        with self._condition:
+            self._pending.append((-job.priority, next(self._sequence), job.id, job.owner_id))
+            self._condition.notify()
+
+    def recover(self):
+        """Re-queue jobs left unfinished by a previous server process."""
+        db = SessionLocal()
+        try:
+            jobs = sorted(crud.get_unfinished_jobs(db), key=lambda job: job.created_at)
+            for job in jobs:
+                job.status = "queued"
+                job.started_at = None
+            db.commit()
+            for job in jobs:
+                self.submit(job)
+        finally:
+            db.close()
+
+    def cancel(self, job_id: int):
+        """Cancel a queued or running job. Returns False if it already finished."""
+        with self._condition:
+            entry = next((entry for entry in self._pending if entry[2] == job_id), None)
+            if entry is None:
+                if job_id not in self._running:
+                    return False
+                # A running diffusion call cannot be interrupted; its result is discarded
+                self._cancelled.add(job_id)
+                future = self._running[job_id][1]
+                if future is not None:
+                    future.cancel()
+                return True
+            self._pending.remove(entry)
+        # The database is only written once the lock is released, so submit() never waits on it
+        self._update(job_id, status="cancelled", finished_at=datetime.utcnow())
+        return True
+
+    def shutdown(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._progress.put(None)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _next_job(self):
+        eligible = [entry for entry in self._pending if self._per_user[entry[3]] < self.max_per_user]
+        if not eligible or len(self._running) >= self.max_workers:
+            return None
+        entry = min(eligible)
+        self._pending.remove(entry)
+        return entry
+
+    def _dispatch_loop(self):
+        while True:
+            with self._condition:
+                entry = self._next_job()
+                while entry is None and not self._stopped:
+                    self._condition.wait()
+                    entry = self._next_job()
+                if self._stopped:
+                    return
+                _, _, job_id, owner_id = entry
+                # Hold the worker slot while the job is marked running; the future is filled in below
+                self._running[job_id] = (owner_id, None)
+                self._per_user[owner_id] += 1
+            job = self._update(job_id, status="running", started_at=datetime.utcnow())
+            spec = {
+                "job_id": job_id,
+                "previews": job.previews,
+                "prompt": job.prompt,
+                "width": job.width,
+                "height": job.height,
+                "output_path": os.path.abspath(os.path.join(GENERATED_IMAGES_DIR, str(owner_id), f"{job_id}.png")),
+            }
+            future = self._executor.submit(self._task, spec, self._progress)
+            with self._condition:
+                self._running[job_id] = (owner_id, future)
+                if job_id in self._cancelled:
+                    future.cancel()
+            future.add_done_callback(lambda future, job_id=job_id: self._finished(job_id, future))
+
+    def _finished(self, job_id: int, future):
+        with self._condition:
+            owner_id, _ = self._running.pop(job_id)
+            self._per_user[owner_id] -= 1
+            cancelled = job_id in self._cancelled
+            self._cancelled.discard(job_id)
+            self._condition.notify()
+
+        error = None if future.cancelled() else future.exception()
+        if cancelled:
+            if error is None and not future.cancelled() and os.path.exists(future.result()):
+                os.remove(future.result())
+            self._update(job_id, status="cancelled", finished_at=datetime.utcnow())
+        elif error is not None:
+            self._update(job_id, status="failed", error=str(error), finished_at=datetime.utcnow())
+        else:
+            # Record the creation first, so a job reported done always has its image in the gallery
+            job = self._update(job_id, result_path=future.result())
+            try:
+                self._add_creation(job)
+            except Exception as e:
+                self._update(job_id, status="failed", error=f"Could not record the image: {e}",
+                             finished_at=datetime.utcnow())
+            else:
+                self._update(job_id, status="done", finished_at=datetime.utcnow())
+
+    def _relay_progress(self):
+        while True:
+            item = self._progress.get()
+            if item is None:
+                return
+            if self.broker:
+                self.broker.publish(*item)
+
+    def _add_creation(self, job: models.GenerationJob):
+        import_generators()
+        from derivatives import file_hash, make_lqip
+        content_hash = file_hash(job.result_path)
+        lqip = make_lqip(job.result_path)
+        db = SessionLocal()
+        try:
+            crud.create_creation(db, job, content_hash, lqip)
+        finally:
+            db.close()
+
+    def _update(self, job_id: int, **fields):
+        db = SessionLocal()
+        try:
+            job = db.query(models.GenerationJob).filter(models.GenerationJob.id == job_id).first()
+            for name, value in fields.items():
+                setattr(job, name, value)
+            db.commit()
+            db.refresh(job)
+            db.expunge(job)
+        finally:
+            db.close()
+        if self.broker and "status" in fields:
+            self.broker.publish(job_id, {"status": job.status, "error": job.error})
+        return job
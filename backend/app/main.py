@@ -1,14 +1,37 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import os
+import gzip
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import models, schemas, crud
-from .database import engine, SessionLocal
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, schemas, crud, jobs, progress, passwords, images, telemetry
+from .config import IMAGE_CACHE_MAX_AGE, DERIVATIVE_WIDTHS
+from .database import async_engine, AsyncSessionLocal
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+# Background generation jobs and their progress streams
+broker = progress.ProgressBroker()
+dispatcher = None
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global dispatcher
+    # Create database tables
+    async with async_engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.create_all)
+    broker.bind(asyncio.get_running_loop())
+    dispatcher = jobs.JobDispatcher(broker=broker)
+    dispatcher.recover()
+    yield
+    dispatcher.shutdown()
+    passwords.password_hasher.shutdown()
+    images.renderer.shutdown()
+    await async_engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -19,29 +42,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dependency to get DB session
-def get_db():
-    db = SessionLocal()
+# Request latency by route, plus the bcrypt/JWT/DB spans inside each request
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    token = telemetry.start_request()
+    status_code = 500
     try:
-        yield db
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
     finally:
-        db.close()
+        # The route template, not the raw path, so metrics stay one series per endpoint
+        route = request.scope.get("route")
+        telemetry.finish_request(token, request.method, route.path if route else "unmatched", status_code)
+
+# Shed load instead of queueing when the password hashing pool is saturated
+@app.exception_handler(passwords.HasherBusy)
+async def hasher_busy_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server busy, please try again"},
+        headers={"Retry-After": "1"},
+    )
+
+# Dependency to get DB session
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
 # OAuth2 scheme for token authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # User registration endpoint
 @app.post("/register/", response_model=schemas.User)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await crud.get_user_by_email_async(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+    return await crud.create_user_async(db=db, user=user)
 
 # User login endpoint
 @app.post("/token")
-def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    db_user = crud.authenticate_user(db, user.email, user.password)
+async def login(user: schemas.UserLogin, db: AsyncSession = Depends(get_db)):
+    db_user = await crud.authenticate_user_async(db, user.email, user.password)
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -53,10 +96,145 @@ def login(user: schemas.UserLogin, db: Session = Depends(get_db)):
 
 # Protected route example
 @app.get("/users/me/", response_model=schemas.User)
-async def read_users_me(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    current_user = crud.get_current_user(db, token)
+async def read_users_me(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = await crud.get_current_user_async(db, token)
     return current_user
 
+# Queue an image generation job
+@app.post("/generate", response_model=schemas.GenerationJob, status_code=status.HTTP_202_ACCEPTED)
+async def create_generation_job(request: schemas.GenerationRequest, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = await crud.get_current_user_async(db, token)
+    job = await crud.create_job_async(db, current_user.id, request, crud.job_priority(current_user))
+    dispatcher.submit(job)
+    return job
+
+# Generation job status
+@app.get("/jobs/{job_id}", response_model=schemas.GenerationJob)
+async def read_job(job_id: int, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = await crud.get_current_user_async(db, token)
+    job = await crud.get_job_async(db, job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+# Stream job progress as server-sent events
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: int, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = await crud.get_current_user_async(db, token)
+    job = await crud.get_job_async(db, job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        progress.event_stream(broker, job.id, lambda: crud.get_job_status_async(job_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Cancel a queued or running job
+@app.delete("/jobs/{job_id}", response_model=schemas.GenerationJob)
+async def cancel_job(job_id: int, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    current_user = await crud.get_current_user_async(db, token)
+    job = await crud.get_job_async(db, job_id, current_user.id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Cancelling a queued job writes its status with the dispatcher's sync session
+    if not await asyncio.to_thread(dispatcher.cancel, job.id):
+        raise HTTPException(status_code=409, detail=f"Job already {job.status}")
+    await db.refresh(job)
+    return job
+
+# Page through the current user's creations, newest first
+@app.get("/creations", response_model=schemas.CreationPage)
+async def read_creations(
+    cursor: Optional[str] = None,
+    limit: int = Query(24, ge=1, le=100),
+    token: str = Depends(oauth2_scheme),
+    db: AsyncSession = Depends(get_db),
+):
+    current_user = await crud.get_current_user_async(db, token)
+    rows, next_cursor = await crud.get_creations_page_async(db, current_user.id, limit, cursor)
+    return schemas.CreationPage(
+        items=[
+            schemas.CreationSummary.model_validate(row, from_attributes=True).model_copy(
+                update={"image_url": f"/images/{row.content_hash}" if row.content_hash else None}
+            )
+            for row in rows
+        ],
+        next_cursor=next_cursor,
+    )
+
+def _read_gzip(path: str):
+    with gzip.open(path, "rb") as f:
+        return f.read()
+
+def _etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match", "")
+    return if_none_match.strip() == "*" or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+# Serve a generated image, or a thumbnail of it with ?w=<width>, by content hash.
+# The hash is unguessable and the bytes behind it never change, so no auth is
+# needed and clients may cache forever.
+@app.get("/images/{content_hash}")
+async def read_image(
+    request: Request,
+    content_hash: str = Path(pattern="^[0-9a-f]{64}$"),
+    width: Optional[int] = Query(None, alias="w"),
+    fmt: str = Query("webp", alias="format"),
+    db: AsyncSession = Depends(get_db),
+):
+    if width is not None and (width not in DERIVATIVE_WIDTHS or fmt not in images.derivatives.SUPPORTED_FORMATS):
+        raise HTTPException(status_code=400, detail=f"Thumbnails come in widths {DERIVATIVE_WIDTHS} "
+                                                    f"and formats {list(images.derivatives.SUPPORTED_FORMATS)}")
+    etag = f'"{content_hash}"' if width is None else f'"{content_hash}-{width}w.{fmt}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable"}
+    # The ETag comes from the URL, so revalidation is answered without touching the database or disk
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    image_path = await crud.get_image_path_async(db, content_hash)
+    if image_path is None or not os.path.isfile(image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    if width is not None:
+        image_path = await images.renderer.render(image_path, content_hash, width, fmt)
+    # FileResponse streams from disk in chunks and answers Range requests itself
+    return FileResponse(image_path, headers=headers)
+
+# Fillable regions of an image for tap-to-fill: a gzipped binary label map
+# (see regions.encode_regions for the layout), cached like the image itself
+@app.get("/images/{content_hash}/regions")
+async def read_image_regions(
+    request: Request,
+    content_hash: str = Path(pattern="^[0-9a-f]{64}$"),
+    db: AsyncSession = Depends(get_db),
+):
+    # The gzip and identity bodies differ, so each gets its own ETag and caches key on Accept-Encoding
+    gzipped = "gzip" in request.headers.get("accept-encoding", "")
+    etag = f'"{content_hash}-regions-gz"' if gzipped else f'"{content_hash}-regions"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable", "Vary": "Accept-Encoding"}
+    if _etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    image_path = await crud.get_image_path_async(db, content_hash)
+    if image_path is None or not os.path.isfile(image_path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    regions_path = await images.renderer.render_regions(image_path, content_hash)
+    if not gzipped:
+        data = await asyncio.to_thread(_read_gzip, regions_path)
+        return Response(content=data, media_type="application/octet-stream", headers=headers)
+    return FileResponse(regions_path, media_type="application/octet-stream", headers={**headers, "Content-Encoding": "gzip"})
+
+# Counters for scraping, in Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+def read_metrics():
+    stats = crud.token_cache.stats()
+    lines = []
+    for name, kind, help_text, value in [
+        ("auth_token_cache_hits_total", "counter", "Requests authenticated from the token cache", stats["hits"]),
+        ("auth_token_cache_misses_total", "counter", "Requests that had to decode the token", stats["misses"]),
+        ("auth_token_cache_invalidations_total", "counter", "Cached tokens dropped after a user change", stats["invalidations"]),
+        ("auth_token_cache_entries", "gauge", "Tokens currently cached", stats["entries"]),
+    ]:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+    return "\n".join(lines) + "\n" + telemetry.render()
+
 # Root endpoint
 @app.get("/")
 def read_root():
@@ -1,4 +1,6 @@
-from sqlalchemy import Boolean, Column, Integer, String
+from datetime import datetime
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, Integer, String
+from sqlalchemy.orm import relationship
 from .database import Base
 
 class User(Base):
@@ -9,4 +11,43 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String)
     hashed_password = Column(String)
-    is_active = Column(Boolean, default=True)
\ No newline at end of file
+    is_active = Column(Boolean, default=True)
+
+    creations = relationship("Creation", back_populates="owner", lazy="raise")
+
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    prompt = Column(String)
+    width = Column(Integer, default=512)
+    height = Column(Integer, default=512)
+    priority = Column(Integer, default=0)
+    previews = Column(Boolean, default=False)  # Stream low-res previews while generating
+    status = Column(String, default="queued", index=True)  # queued, running, done, failed, cancelled
+    result_path = Column(String, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+class Creation(Base):
+    __tablename__ = "creations"
+    # Finds one owner's "newest first" page with a range scan; the selected columns
+    # (title, description, lqip...) still come from the table, one rowid lookup per row
+    __table_args__ = (Index("ix_creations_owner_created_id", "owner_id", "created_at", "id"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    job_id = Column(Integer, ForeignKey("generation_jobs.id"), nullable=True)
+    title = Column(String)
+    description = Column(String)
+    image_path = Column(String)
+    content_hash = Column(String, index=True)  # sha256 of the image; served at /images/<content_hash>
+    lqip = Column(String, nullable=True)  # Tiny placeholder image as a data URI
+    width = Column(Integer)
+    height = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    owner = relationship("User", back_populates="creations")
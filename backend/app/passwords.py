@@ -0,0 +1,89 @@
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from passlib.context import CryptContext
+from . import telemetry
+from .config import BCRYPT_ROUNDS, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING
+
+# Hashes made with a different cost are flagged by needs_update and rehashed on login
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+class HasherBusy(Exception):
+    """Raised when too many password hashes are already waiting for the pool."""
+
+def _hash(password: str):
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+class PasswordHasher:
+    """Run bcrypt in a size-bounded process pool instead of on request threads.
+
+    At most ``max_pending`` operations may be queued or running; beyond
+    that callers get ``HasherBusy`` straight away rather than waiting. If
+    a worker dies (OOM kill, crash), the broken pool is replaced and the
+    operation retried once.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    async def hash(self, password: str):
+        with telemetry.span("bcrypt"):
+            return await self._run(_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """Return ``(valid, new_hash)``; ``new_hash`` is set when the stored hash needs an upgrade."""
+        with telemetry.span("bcrypt"):
+            return await self._run(_verify_and_update, password, hashed_password)
+
+    async def _run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HasherBusy()
+            self.pending += 1
+        try:
+            executor = self._get_executor()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def _discard_executor(self, executor):
+        """Drop a broken pool so the next call starts a new one; concurrent callers may already have."""
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,88 @@
+import json
+import asyncio
+import threading
+from collections import defaultdict
+
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+KEEPALIVE_SECONDS = 15  # Comment lines sent to idle streams so proxies keep them open
+SUBSCRIBER_BUFFER = 32  # Events buffered per watcher before progress updates are dropped
+
+class ProgressBroker:
+    """Fan generation progress out to any number of async watchers.
+
+    Executor threads call ``publish`` and each watcher owns an
+    ``asyncio.Queue`` on the server's event loop, so watching a job costs
+    no thread at all.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._latest = {}
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def publish(self, job_id: int, event: dict):
+        """Send an event to every watcher of a job. Safe to call from any thread."""
+        event = dict(event, job_id=job_id)
+        with self._lock:
+            if event["status"] in FINISHED_STATUSES:
+                self._latest.pop(job_id, None)
+            else:
+                self._latest[job_id] = event
+            queues = list(self._subscribers.get(job_id, ()))
+        if self._loop is not None:
+            for queue in queues:
+                self._loop.call_soon_threadsafe(_offer, queue, event)
+
+    def subscribe(self, job_id: int):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        with self._lock:
+            self._subscribers[job_id].add(queue)
+            latest = self._latest.get(job_id)
+        if latest:
+            queue.put_nowait(latest)
+        return queue
+
+    def unsubscribe(self, job_id: int, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers[job_id].discard(queue)
+            if not self._subscribers[job_id]:
+                del self._subscribers[job_id]
+
+def _offer(queue: asyncio.Queue, event: dict):
+    if queue.full() and event["status"] not in FINISHED_STATUSES:
+        return  # A slow watcher skips intermediate steps
+    if queue.full():
+        queue.get_nowait()  # Never drop the final event
+    queue.put_nowait(event)
+
+def _format(event: dict):
+    return f"event: {event['status']}\ndata: {json.dumps(event)}\n\n"
+
+async def event_stream(broker: ProgressBroker, job_id: int, load_status):
+    """Yield server-sent events for a job until it finishes.
+
+    ``load_status()`` is a coroutine function returning the job's stored
+    status. It is checked once the watcher is subscribed, so a job
+    finishing in between is not missed.
+    """
+    queue = broker.subscribe(job_id)
+    try:
+        status = await load_status()
+        if status in FINISHED_STATUSES:
+            yield _format({"job_id": job_id, "status": status})
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield _format(event)
+            if event["status"] in FINISHED_STATUSES:
+                return
+    finally:
+        broker.unsubscribe(job_id, queue)
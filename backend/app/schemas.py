@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import Optional
+from pydantic import BaseModel, EmailStr, Field
+from typing import List, Optional
+from datetime import datetime
 
 class UserBase(BaseModel):
     email: EmailStr
@@ -24,4 +25,43 @@ class User(UserBase):
 
 class Token(BaseModel):
     access_token: str
-    token_type: str
\ No newline at end of file
+    token_type: str
+
+class GenerationRequest(BaseModel):
+    prompt: str = Field(min_length=1, max_length=500)
+    width: int = Field(default=512, ge=64, le=1024, multiple_of=8)
+    height: int = Field(default=512, ge=64, le=1024, multiple_of=8)
+    previews: bool = False
+
+class GenerationJob(BaseModel):
+    id: int
+    prompt: str
+    width: int
+    height: int
+    priority: int
+    status: str
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
+
+class CreationSummary(BaseModel):
+    """The columns the creations grid renders."""
+    id: int
+    title: str
+    description: str
+    width: int
+    height: int
+    created_at: datetime
+    image_url: Optional[str] = None  # Relative to the API root; add ?w=<width> for a WebP/AVIF thumbnail
+    lqip: Optional[str] = None  # Data URI to show while the image loads
+
+    class Config:
+        orm_mode = True
+
+class CreationPage(BaseModel):
+    items: List[CreationSummary]
+    next_cursor: Optional[str] = None  # Pass back as ``cursor`` for the next page; None on the last page
@@ -0,0 +1,93 @@
+import json
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from sqlalchemy import event
+from .config import TRACE_LOG_PATH, import_generators
+
+import_generators()
+import instrumentation  # noqa: E402  (lives in GENERATORS_DIR)
+from instrumentation import StageMetrics  # noqa: E402
+
+# Seconds; fine-grained at the low end, where cached requests and single queries land
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+request_seconds = StageMetrics("http_request_duration_seconds", "Time to answer a request", LATENCY_BUCKETS,
+                               label_names=("method", "route", "status"))
+span_seconds = StageMetrics("span_duration_seconds", "Time spent in bcrypt, JWT and database calls", LATENCY_BUCKETS,
+                            label_names=("span",))
+
+# Spans of the request being handled in this context, or None outside a request
+_current_spans = contextvars.ContextVar("request_spans", default=None)
+
+trace_logger = logging.getLogger("app.trace")
+if TRACE_LOG_PATH:
+    _handler = logging.FileHandler(TRACE_LOG_PATH, encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+def record_span(name: str, seconds: float):
+    """Count ``seconds`` against span ``name``, and against the current request's trace."""
+    span_seconds.observe(name, seconds)
+    spans = _current_spans.get()
+    if spans is not None:
+        totals = spans.setdefault(name, {"count": 0, "ms": 0.0})
+        totals["count"] += 1
+        totals["ms"] += seconds * 1000
+
+@contextmanager
+def span(name: str):
+    """Time the body of a ``with`` block (sync or async code) as one ``name`` span."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started)
+
+def start_request():
+    """Begin collecting spans for a request; returns a token for ``finish_request``."""
+    return _current_spans.set({}), time.perf_counter()
+
+def finish_request(token, method: str, route: str, status: int):
+    context_token, started = token
+    seconds = time.perf_counter() - started
+    spans = _current_spans.get()
+    _current_spans.reset(context_token)
+    request_seconds.observe((method, route, str(status)), seconds)
+    if trace_logger.handlers:
+        for totals in spans.values():
+            totals["ms"] = round(totals["ms"], 2)
+        trace_logger.info(json.dumps({
+            "time": round(time.time(), 3),
+            "method": method,
+            "route": route,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 2),
+            "spans": spans,
+        }))
+
+def time_queries(engine):
+    """Record every statement run on a sync ``engine`` (for async engines, pass ``.sync_engine``) as a ``db`` span."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        record_span("db", time.perf_counter() - conn.info["query_started"].pop())
+
+    @event.listens_for(engine, "handle_error")
+    def _failed(context):
+        started = context.connection.info.get("query_started") if context.connection is not None else None
+        if started:
+            record_span("db", time.perf_counter() - started.pop())
+
+def render():
+    """All request and span histograms in Prometheus text format, plus generation stage timings.
+
+    The stage timings only fill in when the thread executor runs the pipeline in this process.
+    """
+    return request_seconds.render() + span_seconds.render() + instrumentation.metrics.render()
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import tempfile
+import itertools
+import subprocess
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+
+# Default configuration
+DEFAULT_PROFILES = ['default', 'production']
+DEFAULT_REQUESTS = 2000
+DEFAULT_CONCURRENCY = 32
+DEFAULT_WRITE_RATIO = 0.3  # Share of requests that register a new user
+DEFAULT_SEED_USERS = 20
+DEFAULT_BCRYPT_ROUNDS = 4  # Cheapest cost, so the database rather than hashing is the bottleneck
+DEFAULT_PORT = 8765
+
+def start_server(profile, db_path, port, bcrypt_rounds):
+    """Run the API in a subprocess against a fresh database file."""
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite+aiosqlite:///{db_path}",
+        DATABASE_PROFILE=profile,
+        BCRYPT_ROUNDS=str(bcrypt_rounds),
+        AUTH_CACHE_SIZE='0',  # Every /users/me/ request reads the users table
+        GENERATED_IMAGES_DIR=os.path.join(os.path.dirname(db_path), 'generated_images'),
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app.main:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError(f"Server did not start on port {port}")
+
+def call(conn, method, path, payload=None, token=None):
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    body = json.dumps(payload) if payload is not None else None
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+def user_payload(email):
+    return {'email': email, 'password': 'benchmark', 'first_name': 'Bench', 'last_name': 'Mark'}
+
+def seed_tokens(port, count, concurrency):
+    """Register and log in the reader accounts.
+
+    This runs concurrently so the server's password hashing pool is fully
+    spawned before anything is timed.
+    """
+    def seed(i):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        call(conn, 'POST', '/register/', user_payload(f"seed{i}@example.com"))
+        _, body = call(conn, 'POST', '/token', {'email': f"seed{i}@example.com", 'password': 'benchmark'})
+        return json.loads(body)['access_token']
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(seed, range(count)))
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_load(port, tokens, requests, concurrency, write_ratio):
+    """Fire a shuffled mix of registrations and profile reads and time each one."""
+    operations = ['register'] * int(requests * write_ratio)
+    operations += ['me'] * (requests - len(operations))
+    random.shuffle(operations)
+    emails = itertools.count()
+    results = {'register': [], 'me': []}
+    errors = {'register': 0, 'me': 0}
+    lock = threading.Lock()
+
+    def worker(ops):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        for op in ops:
+            start = time.perf_counter()
+            try:
+                if op == 'register':
+                    status, _ = call(conn, 'POST', '/register/', user_payload(f"user{next(emails)}@example.com"))
+                else:
+                    status, _ = call(conn, 'GET', '/users/me/', token=random.choice(tokens))
+            except OSError:
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                status = None
+            with lock:
+                if status == 200:
+                    results[op].append(time.perf_counter() - start)
+                else:
+                    errors[op] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, [operations[i::concurrency] for i in range(concurrency)]))
+    return time.perf_counter() - started, results, errors
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /register/ and /users/me/ under concurrent load, with and without the SQLite profile')
+    parser.add_argument('--profiles', nargs='+', default=DEFAULT_PROFILES, choices=DEFAULT_PROFILES, help='Database profiles to compare (default: both)')
+    parser.add_argument('--requests', '-n', type=int, default=DEFAULT_REQUESTS, help=f'Requests per profile (default: {DEFAULT_REQUESTS})')
+    parser.add_argument('--concurrency', '-c', type=int, default=DEFAULT_CONCURRENCY, help=f'Concurrent clients (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--write-ratio', type=float, default=DEFAULT_WRITE_RATIO, help=f'Share of requests that register users (default: {DEFAULT_WRITE_RATIO})')
+    parser.add_argument('--seed-users', type=int, default=DEFAULT_SEED_USERS, help=f'Users whose tokens the readers use (default: {DEFAULT_SEED_USERS})')
+    parser.add_argument('--bcrypt-rounds', type=int, default=DEFAULT_BCRYPT_ROUNDS, help=f'bcrypt cost for the server (default: {DEFAULT_BCRYPT_ROUNDS})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port for the server under test (default: {DEFAULT_PORT})')
+
+    args = parser.parse_args()
+
+    summary = {}
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            server = start_server(profile, os.path.join(tmp_dir, 'bench.db'), args.port, args.bcrypt_rounds)
+            try:
+                tokens = seed_tokens(args.port, max(args.seed_users, args.concurrency), args.concurrency)
+                elapsed, results, errors = run_load(args.port, tokens, args.requests, args.concurrency, args.write_ratio)
+            finally:
+                server.terminate()
+                server.wait()
+
+        print(f"\nProfile: {profile} ({args.requests} requests, {args.concurrency} clients, {elapsed:.2f}s)")
+        total_ok = sum(len(latencies) for latencies in results.values())
+        for op, path in [('register', '/register/'), ('me', '/users/me/')]:
+            latencies = results[op]
+            print(f"  {path:<12} ok={len(latencies):<6} errors={errors[op]:<5} "
+                  f"{len(latencies) / elapsed:8.1f} req/s  "
+                  f"p50={percentile(latencies, 0.5) * 1000:7.1f}ms  p99={percentile(latencies, 0.99) * 1000:7.1f}ms")
+        print(f"  {'total':<12} {total_ok / elapsed:.1f} req/s")
+        summary[profile] = total_ok / elapsed
+
+    if len(summary) == 2:
+        print(f"\nProduction profile throughput: {summary['production'] / summary['default']:.2f}x default")
+
+if __name__ == "__main__":
+    main()
@@ -16,56 +16,16 @@ import {
 } from '@mui/material';
 import { Delete, Edit, Add } from '@mui/icons-material';
 import { useAuth } from '../contexts/AuthContext';
-import { imagesAPI } from '../services/api';
+import { creationsAPI, API_URL } from '../services/api';
 
-const demoImages = [
-  {
-    id: 1,
-    title: 'Forest Adventure',
-    description: 'A beautiful forest scene with animals',
-    url: 'https://source.unsplash.com/random/300x400?forest,cartoon',
-    created_at: '2023-08-28T10:30:00Z'
-  },
-  {
-    id: 2,
-    title: 'Ocean Friends',
-    description: 'Underwater world with colorful fish',
-    url: 'https://source.unsplash.com/random/300x400?ocean,cartoon',
-    created_at: '2023-08-27T15:45:00Z'
-  },
-  {
-    id: 3,
-    title: 'Space Explorer',
-    description: 'Journey through the stars and planets',
-    url: 'https://source.unsplash.com/random/300x400?space,cartoon',
-    created_at: '2023-08-26T09:15:00Z'
-  },
-  {
-    id: 4,
-    title: 'Dinosaur Land',
-    description: 'Prehistoric world with friendly dinosaurs',
-    url: 'https://source.unsplash.com/random/300x400?dinosaur,cartoon',
-    created_at: '2023-08-25T14:20:00Z'
-  },
-  {
-    id: 5,
-    title: 'Fairy Tale Castle',
-    description: 'Magical castle in the clouds',
-    url: 'https://source.unsplash.com/random/300x400?castle,cartoon',
-    created_at: '2023-08-24T11:10:00Z'
-  },
-  {
-    id: 6,
-    title: 'Jungle Safari',
-    description: 'Wild animals in their natural habitat',
-    url: 'https://source.unsplash.com/random/300x400?jungle,cartoon',
-    created_at: '2023-08-23T16:30:00Z'
-  },
-];
+// Card-sized WebP rendered by the API, instead of the full-size image
+const thumbnailUrl = (imageUrl, width) => `${API_URL}${imageUrl}?w=${width}`;
 
 const MyCreations = () => {
   const [images, setImages] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [error, setError] = useState(null);
   const { user } = useAuth();
   const navigate = useNavigate();
@@ -76,12 +36,9 @@ const MyCreations = () => {
     const fetchImages = async () => {
       try {
         setLoading(true);
-        // In a real app, you would fetch user's images like this:
-        // const response = await imagesAPI.getImages();
-        // setImages(response.data);
-        
-        // For demo purposes, we'll use the demo images
-        setImages(demoImages);
+        const response = await creationsAPI.getCreations();
+        setImages(response.data.items);
+        setNextCursor(response.data.next_cursor);
       } catch (err) {
         console.error('Error fetching images:', err);
         setError('Failed to load images. Please try again later.');
@@ -97,6 +54,20 @@ const MyCreations = () => {
     }
   }, [user, navigate]);
 
+  const handleLoadMore = async () => {
+    try {
+      setLoadingMore(true);
+      const response = await creationsAPI.getCreations(nextCursor);
+      setImages((current) => [...current, ...response.data.items]);
+      setNextCursor(response.data.next_cursor);
+    } catch (err) {
+      console.error('Error fetching images:', err);
+      setError('Failed to load images. Please try again later.');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleDelete = async (id) => {
     if (window.confirm('Are you sure you want to delete this creation?')) {
       try {
@@ -185,10 +156,23 @@ const MyCreations = () => {
                   },
                 }}
               >
-                <Box sx={{ position: 'relative', pt: '133.33%' }}>
+                <Box
+                  sx={{
+                    position: 'relative',
+                    pt: '133.33%',
+                    // Blurred placeholder until the thumbnail arrives
+                    backgroundImage: image.lqip ? `url(${image.lqip})` : 'none',
+                    backgroundSize: 'cover',
+                  }}
+                >
                   <CardMedia
                     component="img"
-                    image={image.url}
+                    image={image.image_url ? thumbnailUrl(image.image_url, 320) : undefined}
+                    srcSet={image.image_url
+                      ? `${thumbnailUrl(image.image_url, 320)} 320w, ${thumbnailUrl(image.image_url, 640)} 640w`
+                      : undefined}
+                    sizes="(max-width: 600px) 100vw, 320px"
+                    loading="lazy"
                     alt={image.title}
                     sx={{
                       position: 'absolute',
@@ -236,6 +220,14 @@ const MyCreations = () => {
           ))}
         </Grid>
       )}
+
+      {nextCursor && (
+        <Box textAlign="center" mt={4}>
+          <Button variant="outlined" onClick={handleLoadMore} disabled={loadingMore}>
+            {loadingMore ? <CircularProgress size={24} /> : 'Load More'}
+          </Button>
+        </Box>
+      )}
     </Container>
   );
 };
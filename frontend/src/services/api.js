@@ -1,6 +1,6 @@
 import axios from 'axios';
 
-const API_URL = 'http://localhost:8000';
+export const API_URL = 'http://localhost:8000';
 
 const api = axios.create({
   baseURL: API_URL,
@@ -115,4 +115,10 @@ export const authService = {
   }
 };
 
+export const creationsAPI = {
+  // One page of the user's creations, newest first; pass the previous page's next_cursor for more
+  getCreations: (cursor = null, limit = 24) =>
+    api.get('/creations', { params: cursor ? { cursor, limit } : { limit } }),
+};
+
 export default api;
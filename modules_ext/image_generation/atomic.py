@@ -0,0 +1,100 @@
+import os
+import re
+import shutil
+import threading
+import contextlib
+
+# Matches the names temp_path() and attempt_path() give, so leftovers from a crash can be found;
+# the group is the pid of the run that wrote the file
+TEMP_NAME = re.compile(r'\.(\d+)\.\d+\.tmp(\.\w+)?$')
+
+# Pid that temp names are tagged with, when not this process's own; see set_owner()
+_owner_pid = None
+
+def set_owner(pid):
+    """Tag this process's temp files with ``pid``, e.g. in a worker process with the pid of the run that started it."""
+    global _owner_pid
+    _owner_pid = pid
+
+def temp_path(path):
+    """A temporary name next to ``path``, unique to this process and thread."""
+    return f"{path}.{_owner_pid or os.getpid()}.{threading.get_ident()}.tmp"
+
+def attempt_path(path, attempt):
+    """A name next to ``path`` for one attempt at producing it, keeping its extension (and so its format)."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{_owner_pid or os.getpid()}.{attempt}.tmp{ext}"
+
+def link_or_copy(src, dst):
+    """Point ``dst`` at the contents of ``src``, replacing any existing file.
+
+    A hardlink is used when possible, falling back to a copy across devices
+    or on filesystems without hardlinks. The new entry is created under a
+    temporary name and renamed into place, so ``dst`` always ends up as a
+    fresh directory entry rather than being rewritten in place.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    tmp_path = temp_path(dst)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', encoding=None):
+    """Open a file to write ``path`` so that ``path`` only ever holds a complete file.
+
+    The ``with`` block writes to a ``temp_path`` name; the file is fsynced and
+    renamed over ``path`` when the block ends, or removed if it raises. A
+    crash mid-write leaves the old file (or none) plus a stray temp file
+    that ``remove_temp_files`` recognises, never a truncated one.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = temp_path(path)
+    try:
+        with open(tmp_path, mode, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def save_image(image, output_path, **params):
+    """Save a PIL image atomically (see ``atomic_write``), in the format its extension names."""
+    from PIL import Image
+    fmt = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+    with atomic_write(output_path) as f:
+        image.save(f, format=fmt, **params)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Exists, but belongs to someone else
+    return True
+
+def remove_temp_files(directory, pids):
+    """Delete temp files that runs with one of ``pids`` left in ``directory`` or below; returns how many.
+
+    Other processes, such as the other shards of a split run, may share the
+    directory, so only the temp files of the given (interrupted) runs are
+    touched, and none of a pid that is running again.
+    """
+    pids = {pid for pid in pids if pid != os.getpid() and not _pid_alive(pid)}
+    removed = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            match = TEMP_NAME.search(name)
+            if match and int(match.group(1)) in pids:
+                try:
+                    os.unlink(os.path.join(root, name))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+    return removed
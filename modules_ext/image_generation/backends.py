@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import namedtuple
+import derivatives
+import generate_images
+import generate_local
+import generate_local_diffusers
+from output_cache import cache_key
+from embedding_cache import PromptEmbeddingCache
+from generation_worker import DEFAULT_WORKER_URL, worker_health, submit_job, wait_for_job
+
+# One image to generate, in the terms every backend understands
+GenerationJob = namedtuple('GenerationJob', 'prompt output_path width height steps seed')
+
+class Backend:
+    """An image generation service behind the interface the router dispatches to.
+
+    ``open()`` connects or loads a model and raises if the backend cannot be
+    used; it runs once, on one of the backend's own threads. ``generate(job)``
+    returns True once the image is saved at ``job.output_path``; it prints
+    and returns False on failure, like the scripts it wraps. Up to
+    ``max_in_flight`` jobs run on a backend at once, and ``expected_seconds``
+    is the time per image assumed until real timings come in. ``script`` is
+    the generator module whose prompt style and cache keys the backend uses.
+    """
+
+    name = None
+    script = None
+    expected_seconds = 30.0
+
+    def __init__(self, model, max_in_flight=1):
+        self.model = model
+        self.max_in_flight = max(1, max_in_flight)
+
+    def open(self):
+        pass
+
+    def generate(self, job):
+        raise NotImplementedError
+
+    def cache_key(self, job):
+        """The output cache key the backend's own script uses, so results are shared with it."""
+        return cache_key(self.name, self.model, job.prompt, self.script.DEFAULT_STYLE,
+                         self.script.DEFAULT_NEGATIVE_PROMPT, job.width, job.height, job.steps, 7.5, seed=job.seed)
+
+    def close(self):
+        pass
+
+class ReplicateBackend(Backend):
+    name = 'replicate'
+    script = generate_images
+    expected_seconds = 10.0
+
+    def __init__(self, model=generate_images.REPLICATE_MODEL, max_in_flight=4):
+        super().__init__(model, max_in_flight)
+        self.session = None
+
+    def open(self):
+        if not generate_images.load_api_token():
+            raise RuntimeError("no REPLICATE_API_TOKEN")
+        self.session = generate_images.create_session(self.max_in_flight)
+
+    def generate(self, job):
+        return generate_images.generate_image(job.prompt, job.output_path, job.width, job.height,
+                                              session=self.session, model=self.model, seed=job.seed,
+                                              steps=job.steps)
+
+    def close(self):
+        if self.session:
+            self.session.close()
+
+class OllamaBackend(Backend):
+    name = 'ollama'
+    script = generate_local
+    expected_seconds = 30.0
+
+    def __init__(self, model=generate_local.DEFAULT_MODEL, max_in_flight=generate_local.DEFAULT_PARALLEL):
+        super().__init__(model, max_in_flight)
+
+    def open(self):
+        import ollama
+        ollama.list()  # Raises if the server is not running
+
+    def generate(self, job):
+        return generate_local.generate_image(job.prompt, job.output_path, self.model, job.width, job.height,
+                                             steps=job.steps, seed=job.seed)
+
+class DiffusersBackend(Backend):
+    """Local Stable Diffusion: a resident worker serving the same model if one is running, else an in-process pipeline."""
+
+    name = 'diffusers'
+    script = generate_local_diffusers
+    expected_seconds = 60.0
+
+    def __init__(self, model=generate_local_diffusers.DEFAULT_MODEL, max_in_flight=1, device=None, cpu_profile=None,
+                 worker_url=DEFAULT_WORKER_URL, use_worker=True):
+        super().__init__(model, max_in_flight)
+        self.device = device
+        self.cpu_profile = cpu_profile
+        self.worker_url = worker_url if use_worker else None
+        self.pipe = None
+        self.embedding_cache = None
+        self._lock = threading.Lock()  # A pipeline runs one call at a time
+
+    def open(self):
+        health = worker_health(self.worker_url) if self.worker_url else None
+        if health and health.get('model') == self.model:
+            print(f"Sending diffusers jobs to worker at {self.worker_url} (queue depth: {health['queue_depth']})")
+            return
+        if health:
+            print(f"Worker at {self.worker_url} serves {health['model']}, loading {self.model} locally")
+        self.worker_url = None
+        self.max_in_flight = 1
+        self.device = self.device or generate_local_diffusers.default_device()
+        self.pipe = generate_local_diffusers.load_model(self.model, self.device, self.cpu_profile)
+        self.embedding_cache = PromptEmbeddingCache(self.model)
+
+    def generate(self, job):
+        if self.worker_url:
+            job_id = submit_job(self.worker_url, job.prompt, job.output_path, job.width, job.height, seed=job.seed,
+                                steps=job.steps)
+            result = wait_for_job(self.worker_url, job_id)
+            if result['status'] != 'done':
+                print(f"✗ Error generating {os.path.basename(job.output_path)}: {result.get('error', 'see worker log')}")
+                return False
+            derivatives.after_save(job.output_path)  # The worker saved it
+            print(f"✓ Saved: {job.output_path}")
+            return True
+        with self._lock:
+            return generate_local_diffusers.generate_image(self.pipe, job.prompt, job.output_path, job.width,
+                                                           job.height, device=self.device,
+                                                           embedding_cache=self.embedding_cache, seed=job.seed,
+                                                           steps=job.steps)
+
+BACKENDS = {backend.name: backend for backend in (ReplicateBackend, OllamaBackend, DiffusersBackend)}
@@ -0,0 +1,123 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+from contextlib import redirect_stdout
+
+# Default configuration
+DEFAULT_MODEL = "runwayml/stable-diffusion-v1-5"
+DEFAULT_IMAGES = 3  # The first image is reported separately, the rest give seconds per image
+DEFAULT_STEPS = 20
+DEFAULT_SIZE = 512
+BENCHMARK_PROMPT = "A friendly cartoon dog playing with a ball"
+
+def run_profile(profile, model, images, steps, width, height, threads=None, compile_cache=None):
+    """Load ``model`` with one profile and time every image. Meant to run in a fresh process.
+
+    ``profile`` is ``default`` (today's CPU path), ``cpu-optimized`` or
+    ``cpu-optimized-compile``.
+    """
+    from generate_local_diffusers import load_model, generate_image
+    from cpu_inference import CpuProfile, DEFAULT_COMPILE_CACHE_DIR
+
+    cpu_profile = None
+    if profile != 'default':
+        cpu_profile = CpuProfile(threads, compile_unet=profile.endswith('compile'),
+                                 compile_cache_dir=compile_cache or DEFAULT_COMPILE_CACHE_DIR)
+
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        pipe = load_model(model, 'cpu', cpu_profile)
+    load_seconds = time.perf_counter() - started
+
+    times = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(images):
+            started = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                ok = generate_image(pipe, f"{BENCHMARK_PROMPT} {i}", os.path.join(tmp_dir, f"{i}.png"),
+                                    width, height, device='cpu', seed=i, steps=steps)
+            if not ok:
+                raise RuntimeError(f"Generation failed with profile {profile}")
+            times.append(time.perf_counter() - started)
+
+    return {
+        'profile': profile,
+        'settings': cpu_profile.describe() if cpu_profile else 'float32 weights, autocast, attention slicing',
+        'load_seconds': round(load_seconds, 3),
+        'first_image_seconds': round(times[0], 3),
+        'seconds_per_image': round(statistics.median(times[1:] or times), 3),
+    }
+
+def run_in_subprocess(profile, args):
+    """Thread pools and compiled code are per process, so every profile gets a fresh one."""
+    command = [sys.executable, os.path.abspath(__file__), '--run-profile', profile,
+               '--model', args.model, '--images', str(args.images), '--steps', str(args.steps),
+               '--width', str(args.width), '--height', str(args.height), '--compile-cache', args.compile_cache]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    result = subprocess.run(command, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Profile {profile} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare seconds per image of the default CPU path and --cpu-optimized')
+    parser.add_argument('--model', '-m', default=DEFAULT_MODEL, help=f'Model id or local path (default: {DEFAULT_MODEL})')
+    parser.add_argument('--tiny', action='store_true',
+                      help='Use a tiny randomly initialised pipeline instead of --model, so no download is needed')
+    parser.add_argument('--images', '-n', type=int, default=DEFAULT_IMAGES,
+                      help=f'Images per profile (default: {DEFAULT_IMAGES})')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help=f'Inference steps (default: {DEFAULT_STEPS})')
+    parser.add_argument('--width', type=int, default=DEFAULT_SIZE, help=f'Image width (default: {DEFAULT_SIZE})')
+    parser.add_argument('--height', type=int, default=DEFAULT_SIZE, help=f'Image height (default: {DEFAULT_SIZE})')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads for the optimized profiles')
+    parser.add_argument('--compile', action='store_true',
+                      help='Also benchmark torch.compile, once with a cold and once with a warm artifact cache')
+    parser.add_argument('--compile-cache', default=None,
+                      help='Compile cache directory (default: a fresh temporary one)')
+    parser.add_argument('--json', default=None, help='Also write the results to this file')
+    parser.add_argument('--run-profile', default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run_profile:
+        print(json.dumps(run_profile(args.run_profile, args.model, args.images, args.steps, args.width, args.height,
+                                     args.threads, args.compile_cache)))
+        return
+
+    profiles = ['default', 'cpu-optimized'] + (['cpu-optimized-compile'] * 2 if args.compile else [])
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.tiny:
+            from stubs import tiny_pipeline_dir
+            args.model = tiny_pipeline_dir(tmp_dir)
+        print(f"Benchmarking {args.model}: {args.images} images of {args.width}x{args.height}, {args.steps} steps")
+        args.compile_cache = args.compile_cache or os.path.join(tmp_dir, 'compile_cache')
+        for profile in profiles:
+            result = run_in_subprocess(profile, args)
+            if profile.endswith('compile'):
+                result['profile'] += ' (warm cache)' if any(r['profile'].startswith(profile) for r in results) else ' (cold cache)'
+            results.append(result)
+            print(f"  {result['profile']:<34} load {result['load_seconds']:7.2f}s  "
+                  f"first image {result['first_image_seconds']:7.2f}s  "
+                  f"{result['seconds_per_image']:7.2f}s/image  [{result['settings']}]")
+
+    baseline = results[0]['seconds_per_image']
+    for result in results[1:]:
+        result['speedup'] = round(baseline / result['seconds_per_image'], 2)
+        print(f"{result['profile']}: {result['speedup']:.2f}x the default path")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json}")
+
+if __name__ == "__main__":
+    main()
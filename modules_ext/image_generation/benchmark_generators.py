@@ -0,0 +1,234 @@
+import io
+import os
+import sys
+import json
+import time
+import types
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+# Default configuration
+BACKENDS = ['replicate', 'ollama', 'diffusers', 'simple', 'router']
+DEFAULT_LINES = 20
+DEFAULT_SIZE = 256
+DEFAULT_STEPS = 10  # Only the diffusers backends run steps
+DEFAULT_CONCURRENCY = 4  # --concurrency / --parallel for the remote backends
+DEFAULT_BATCH_SIZE = 1
+SUBJECTS = ["a friendly cartoon dog", "a smiling sun", "a castle on a hill", "a happy dinosaur",
+            "a rocket ship", "a cat with a ball of yarn", "a tree house", "a fish in a bowl"]
+
+def write_manifest(path, lines, size, steps):
+    """A JSONL manifest of ``lines`` distinct prompts, so no image is a cache hit."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(lines):
+            f.write(json.dumps({
+                'filename': f"page_{i:05d}.png",
+                'description': f"{SUBJECTS[i % len(SUBJECTS)]}, picture {i}",
+                'size': f"{size}x{size}",
+                'steps': steps,
+            }) + '\n')
+
+def instrument(module, timer, save_modules=None):
+    """Time the stages every generator shares: reading the manifest, the output cache and saving.
+
+    ``save_modules`` are the modules that save the images, if not ``module`` itself.
+    """
+    module.read_manifest = timer.wrap_iter('manifest', module.read_manifest)
+    for saver in save_modules or [module]:
+        saver.save_image = timer.wrap('save', saver.save_image)
+    module.OutputCache.fetch = timer.wrap('cache_lookup', module.OutputCache.fetch)
+    module.OutputCache.store = timer.wrap('cache_store', module.OutputCache.store)
+
+def peak_rss_mb():
+    """Peak resident memory of this process. ``ru_maxrss`` survives fork+exec, so the kernel's VmHWM comes first."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # KiB on Linux
+
+def run_backend(backend, manifest_path, work_dir, latency, concurrency, batch_size, model_dir):
+    """Run one generator end to end against stubs. Meant to run in a fresh process."""
+    import stubs
+
+    timer = stubs.StageTimer()
+    output_dir = os.path.join(work_dir, backend)
+    server = None
+    versions = {}
+    save_modules = None
+
+    if backend == 'replicate':
+        config = types.ModuleType('config')
+        config.REPLICATE_API_TOKEN = 'benchmark'
+        sys.modules['config'] = config
+        server = stubs.install_replicate_stub(latency, timer)
+        import requests
+        import generate_images as module
+        requests.Session.get = timer.wrap('download', requests.Session.get)
+        argv = ['-i', manifest_path, '-o', output_dir, '--concurrency', str(concurrency)]
+    elif backend == 'ollama':
+        stubs.install_ollama_stub(latency, timer)
+        import generate_local as module
+        argv = ['-i', manifest_path, '-o', output_dir, '--parallel', str(concurrency)]
+    elif backend == 'router':
+        # Every backend at once: Replicate and Ollama stubs plus the tiny pipeline
+        config = types.ModuleType('config')
+        config.REPLICATE_API_TOKEN = 'benchmark'
+        sys.modules['config'] = config
+        server = stubs.install_replicate_stub(latency, timer)
+        stubs.install_ollama_stub(latency, timer)
+        stubs.install_diffusers_stub(model_dir, timer)
+        import torch
+        import router as module
+        import generate_images, generate_local, generate_local_diffusers
+        versions['torch'] = torch.__version__
+        save_modules = [generate_images, generate_local, generate_local_diffusers]
+        argv = ['-i', manifest_path, '-o', output_dir, '--cpu', '--no-worker',
+                '--replicate-concurrency', str(concurrency), '--ollama-parallel', str(concurrency)]
+    else:
+        import torch
+        versions['torch'] = torch.__version__
+        if backend == 'diffusers':
+            import generate_local_diffusers as module
+            argv = ['-i', manifest_path, '-o', output_dir, '--cpu', '--no-worker', '--batch-size', str(batch_size),
+                    '--embedding-cache', os.path.join(work_dir, 'embedding_cache')]
+        else:
+            import simple_generate as module
+            module.DEFAULT_INPUT_FILE = manifest_path
+            module.DEFAULT_OUTPUT_DIR = output_dir
+            module.worker_health = lambda url: None
+            argv = []
+        stubs.install_diffusers_stub(model_dir, timer)
+    instrument(module, timer, save_modules)
+
+    sys.argv = [module.__file__] + argv
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        module.main()
+    seconds = time.perf_counter() - started
+    if server:
+        server.shutdown()
+
+    images = sum(1 for name in os.listdir(output_dir) if name.endswith(('.png', '.jpg')))
+    return {
+        'backend': backend,
+        'images': images,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(images / seconds, 3),
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': timer.summary(),
+        **versions,
+    }
+
+def run_in_subprocess(backend, args, manifest_path, work_dir, model_dir):
+    """Each backend gets a fresh process, so peak RSS and imports are its own."""
+    command = [sys.executable, os.path.abspath(__file__), '--run-backend', backend,
+               '--manifest', manifest_path, '--work-dir', work_dir, '--latency', str(args.latency),
+               '--concurrency', str(args.concurrency), '--batch-size', str(args.batch_size)]
+    if model_dir:
+        command += ['--model-dir', model_dir]
+    result = subprocess.run(command, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        raise RuntimeError(f"Backend {backend} failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def compare(results, baseline_path, max_regression):
+    """Print throughput and memory against an earlier run; returns the backends that got slower than allowed."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {r['backend']: r for r in json.load(f)['results']}
+    regressed = []
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        before = baseline.get(result['backend'])
+        if not before:
+            print(f"  {result['backend']:<10} not in baseline")
+            continue
+        change = (result['images_per_second'] / before['images_per_second'] - 1) * 100
+        rss_change = result['peak_rss_mb'] - before['peak_rss_mb']
+        print(f"  {result['backend']:<10} throughput {change:+6.1f}%  peak RSS {rss_change:+7.1f} MB")
+        if max_regression is not None and change < -max_regression:
+            regressed.append(result['backend'])
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every generator offline, with stubbed models and services')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS,
+                      help='Generators to run (default: all)')
+    parser.add_argument('--lines', '-n', type=int, default=DEFAULT_LINES,
+                      help=f'Lines in the synthetic manifest (default: {DEFAULT_LINES})')
+    parser.add_argument('--size', type=int, default=DEFAULT_SIZE, help=f'Image width and height (default: {DEFAULT_SIZE})')
+    parser.add_argument('--steps', type=int, default=DEFAULT_STEPS, help=f'Inference steps (default: {DEFAULT_STEPS})')
+    parser.add_argument('--latency', type=float, default=None,
+                      help='Seconds each stubbed Replicate or Ollama call takes (default: 0.05)')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                      help=f'Requests in flight for Replicate and Ollama (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                      help=f'Batch size for the diffusers backend (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--json', default=None, help='Write the results to this file')
+    parser.add_argument('--compare', default=None, help='Results file of an earlier run to compare with')
+    parser.add_argument('--max-regression', type=float, default=None,
+                      help='With --compare, exit with an error if any throughput dropped by more than this many percent')
+    parser.add_argument('--run-backend', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--manifest', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--work-dir', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--model-dir', default=None, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    if args.latency is None:
+        from stubs import DEFAULT_LATENCY
+        args.latency = DEFAULT_LATENCY
+
+    if args.run_backend:
+        print(json.dumps(run_backend(args.run_backend, args.manifest, args.work_dir, args.latency,
+                                     args.concurrency, args.batch_size, args.model_dir)))
+        return
+
+    print(f"Benchmarking {', '.join(args.backends)}: {args.lines} images of {args.size}x{args.size}, "
+          f"{args.latency}s stub latency")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_path = os.path.join(tmp_dir, 'manifest.jsonl')
+        write_manifest(manifest_path, args.lines, args.size, args.steps)
+        model_dir = None
+        if {'diffusers', 'simple', 'router'} & set(args.backends):
+            from stubs import tiny_pipeline_dir
+            print("Building the tiny Stable Diffusion pipeline...")
+            with redirect_stdout(io.StringIO()):
+                model_dir = tiny_pipeline_dir(tmp_dir)
+
+        for backend in args.backends:
+            result = run_in_subprocess(backend, args, manifest_path, tmp_dir, model_dir)
+            results.append(result)
+            print(f"  {backend:<10} {result['images']:4d} images in {result['seconds']:7.2f}s  "
+                  f"{result['images_per_second']:7.2f} images/s  peak RSS {result['peak_rss_mb']:7.1f} MB")
+            for stage, timing in result['stages'].items():
+                print(f"      {stage:<14} {timing['count']:6d} calls  mean {timing['mean_ms']:9.2f}ms  "
+                      f"p95 {timing['p95_ms']:9.2f}ms")
+
+    report = {
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count()},
+        'settings': {'lines': args.lines, 'size': args.size, 'steps': args.steps, 'latency': args.latency,
+                     'concurrency': args.concurrency, 'batch_size': args.batch_size},
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    if args.compare:
+        regressed = compare(results, args.compare, args.max_regression)
+        if regressed:
+            print(f"✗ Throughput regressed by more than {args.max_regression}%: {', '.join(regressed)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,5 @@
-import ollama
-
 def list_ollama_models():
+    import ollama
     try:
         # List available models
         models = ollama.list()
@@ -20,6 +19,9 @@ def list_ollama_models():
         print("\nMake sure Ollama is running. Try running 'ollama serve' in a separate terminal.")
         return False
 
-if __name__ == "__main__":
+def main():
     print("Checking Ollama models...")
     list_ollama_models()
+
+if __name__ == "__main__":
+    main()
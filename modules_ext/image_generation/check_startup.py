@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Default configuration
+DEFAULT_BUDGET = 0.5  # Seconds, wall clock, including the interpreter's own startup
+DEFAULT_RUNS = 3
+ENTRY_POINT = 'kids_coloring_gen.py'
+
+# Help and listing commands: none of these should load torch, diffusers or a client library
+CHECKS = [
+    ['--help'],
+    ['replicate', '--help'],
+    ['ollama', '--help'],
+    ['diffusers', '--help'],
+    ['simple', '--help'],
+    ['route', '--help'],
+    ['worker', '--help'],
+    ['manifest', '--help'],
+    ['report', '--help'],
+    ['lineart', '--help'],
+    ['regions', '--help'],
+    ['benchmark', '--help'],
+    ['benchmark-cpu', '--help'],
+    ['ollama', '--list-models'],
+]
+
+def entry_point():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), ENTRY_POINT)
+
+def time_command(args, runs):
+    """Median wall-clock seconds of ``kids_coloring_gen.py <args>`` over ``runs`` fresh processes."""
+    command = [sys.executable, entry_point()] + args
+    durations = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - started)
+    return statistics.median(durations)
+
+def slowest_imports(args, limit=5):
+    """The top-level imports that took longest, from ``python -X importtime``, as ``(module, seconds)``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', entry_point()] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package"; nested imports are indented
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if name.startswith(' ') and not name.startswith('  ') and cumulative.strip().isdigit():
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda item: -item[1])[:limit]
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that help and listing commands start within a time budget')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                      help=f'Seconds each command may take (default: {DEFAULT_BUDGET})')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                      help=f'Runs per command; the median counts (default: {DEFAULT_RUNS})')
+    parser.add_argument('--json', default=None, help='Write the timings to this file')
+    args = parser.parse_args()
+
+    print(f"Startup budget: {args.budget:.2f}s per command (median of {args.runs} runs)")
+    results = []
+    for check in CHECKS:
+        seconds = time_command(check, args.runs)
+        within = seconds <= args.budget
+        results.append({'command': ' '.join(check), 'seconds': round(seconds, 3), 'within_budget': within})
+        print(f"  {'✓' if within else '✗'} {' '.join(check):<28} {seconds:6.2f}s")
+        if not within:
+            for name, import_seconds in slowest_imports(check):
+                print(f"      import {name:<24} {import_seconds:6.2f}s")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'budget': args.budget, 'runs': args.runs, 'results': results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+    over = [result['command'] for result in results if not result['within_budget']]
+    if over:
+        print(f"✗ Over budget: {', '.join(over)}")
+        sys.exit(1)
+    print("✓ All commands start within budget")
+
+if __name__ == "__main__":
+    main()
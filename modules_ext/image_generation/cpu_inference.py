@@ -0,0 +1,146 @@
+import os
+import atexit
+import hashlib
+import contextlib
+from atomic import atomic_write
+
+# Default configuration
+DEFAULT_INTEROP_THREADS = 1  # One denoising loop at a time; more inter-op threads only add contention
+DEFAULT_COMPILE_CACHE_DIR = '.compile_cache'
+
+def available_cpus():
+    """CPUs this process may run on (respects taskset/cgroup pinning)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def partition_cpus(workers):
+    """Split the available CPUs into ``workers`` contiguous groups of near-equal size.
+
+    Neighbouring CPU numbers usually share a core or a cache, so each group
+    keeps its threads close together. With more workers than CPUs, workers
+    share CPUs one each.
+    """
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    if workers >= len(cpus):
+        return [[cpus[i % len(cpus)]] for i in range(workers)]
+    size, extra = divmod(len(cpus), workers)
+    groups, start = [], 0
+    for i in range(workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+def pin_to_cpus(cpus):
+    """Keep this process (and the threads it starts later) on ``cpus``, where the OS supports it."""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+
+def bf16_supported():
+    """True if oneDNN has fast bfloat16 kernels for this CPU (AVX512-BF16, AMX or ARM BF16)."""
+    import torch
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+class CpuProfile:
+    """Settings for running a diffusers pipeline on a machine without a GPU.
+
+    ``apply`` pins the thread pools, switches the UNet and VAE to
+    channels_last (the layout oneDNN convolutions are fastest with) and
+    optionally wraps the UNet in ``torch.compile``. Pipeline calls should
+    run under ``autocast()``, which uses bfloat16 only where the CPU has
+    native support; elsewhere bfloat16 is emulated and slower than float32.
+
+    Compiled kernels go to ``compile_cache_dir`` through Inductor's on-disk
+    cache, and the whole compile cache is also saved there as one artifact
+    after the first ``autocast()`` call and again at exit, so later runs
+    load it instead of compiling. Pool processes leave through
+    ``os._exit`` and skip atexit handlers, so the first save is the one
+    they rely on.
+    """
+
+    def __init__(self, threads=None, interop_threads=DEFAULT_INTEROP_THREADS, bf16=None,
+                 compile_unet=False, compile_cache_dir=DEFAULT_COMPILE_CACHE_DIR):
+        self.threads = threads or available_cpus()
+        self.interop_threads = interop_threads
+        self.bf16 = bf16_supported() if bf16 is None else bf16
+        self.compile_unet = compile_unet
+        self.compile_cache_dir = compile_cache_dir
+        self._artifact_path = None
+        self._saved = False
+
+    def describe(self):
+        parts = [f"{self.threads} threads", "bfloat16" if self.bf16 else "float32", "channels_last"]
+        if self.compile_unet:
+            parts.append("compiled UNet")
+        return ", ".join(parts)
+
+    def configure_threads(self):
+        import torch
+        torch.set_num_threads(self.threads)
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            pass  # Only settable once per process, before any inter-op work has run
+
+    def apply(self, pipe, model_name):
+        """Prepare a float32 pipeline that is already on the CPU; returns it."""
+        import torch
+        self.configure_threads()
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+        if self.compile_unet:
+            self._load_compile_cache(model_name)
+            pipe.unet = torch.compile(pipe.unet)
+        pipe.cpu_profile = self
+        return pipe
+
+    @contextlib.contextmanager
+    def autocast(self):
+        """Context for pipeline calls: bfloat16 autocast when supported, plain float32 otherwise.
+
+        The first call that finishes with a compiled UNet saves the compile cache.
+        """
+        import torch
+        context = torch.autocast('cpu', dtype=torch.bfloat16) if self.bf16 else contextlib.nullcontext()
+        with context:
+            yield
+        if self._artifact_path and not self._saved:
+            self._saved = True
+            self.save_compile_cache()
+
+    def _load_compile_cache(self, model_name):
+        import torch
+        cache_dir = os.path.abspath(self.compile_cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Read by Inductor whenever it looks up a kernel, so setting it before the first compile is enough
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(cache_dir, 'inductor'))
+
+        # Compiled code depends on the model, the torch build, the CPU and the dtype
+        key = hashlib.sha256(
+            f"{model_name}\0{torch.__version__}\0{torch.backends.cpu.get_cpu_capability()}\0{self.bf16}".encode('utf-8')
+        ).hexdigest()[:16]
+        self._artifact_path = os.path.join(cache_dir, f"unet-{key}.bin")
+        if hasattr(torch.compiler, 'load_cache_artifacts') and os.path.exists(self._artifact_path):
+            with open(self._artifact_path, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            print(f"Loaded compiled UNet from {self._artifact_path}")
+        atexit.register(self.save_compile_cache)
+
+    def save_compile_cache(self):
+        """Write everything compiled so far as one artifact; runs after the first call and at exit."""
+        import torch
+        if not self._artifact_path or not hasattr(torch.compiler, 'save_cache_artifacts'):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if not artifacts:
+            return
+        with atomic_write(self._artifact_path) as f:
+            f.write(artifacts[0])
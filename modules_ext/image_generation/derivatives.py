@@ -0,0 +1,133 @@
+import os
+import base64
+import hashlib
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, features
+from atomic import atomic_write
+
+# Default configuration
+DEFAULT_WIDTHS = (320, 640)  # Gallery cards are ~300px wide; 640 covers 2x displays
+DEFAULT_QUALITY = 80
+DERIVATIVES_DIRNAME = '.derivatives'  # Created next to the full-size image
+LQIP_WIDTH = 16  # Placeholder width in pixels; inlined as a data URI
+
+def _avif_supported():
+    try:
+        return bool(features.check('avif'))
+    except ValueError:
+        return False  # Pillow too old to know about AVIF
+
+SUPPORTED_FORMATS = ('webp', 'avif') if _avif_supported() else ('webp',)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def derivative_path(image_path, width, fmt, content_hash=None):
+    """Where the ``width``-pixel ``fmt`` version of an image lives.
+
+    Derivatives are named after the source's content hash, so a file that
+    is regenerated or swapped in from the output cache never picks up a
+    stale thumbnail.
+    """
+    content_hash = content_hash or file_hash(image_path)
+    return os.path.join(_derivatives_dir(image_path), f"{content_hash}.{width}w.{fmt}")
+
+def _derivatives_dir(image_path):
+    return os.path.join(os.path.dirname(os.path.abspath(image_path)), DERIVATIVES_DIRNAME)
+
+def make_derivative(image_path, width, fmt='webp', content_hash=None, quality=DEFAULT_QUALITY):
+    """Write one resized copy of an image unless it already exists, and return its path.
+
+    Images are never upscaled.
+    """
+    if fmt not in SUPPORTED_FORMATS:
+        raise ValueError(f"Unsupported derivative format: {fmt}")
+    path = derivative_path(image_path, width, fmt, content_hash)
+    if os.path.exists(path):
+        return path
+    with Image.open(image_path) as img:
+        img = img.convert('RGB')
+        if img.width > width:
+            img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+        with atomic_write(path) as f:
+            img.save(f, format=fmt.upper(), quality=quality)
+    return path
+
+def make_lqip(image_path):
+    """Return a tiny blurred WebP of the image as a data URI, for use as a placeholder."""
+    with Image.open(image_path) as img:
+        img = img.convert('RGB')
+        img.thumbnail((LQIP_WIDTH, LQIP_WIDTH * 4))
+        buffer = BytesIO()
+        img.save(buffer, format='WEBP', quality=30)
+    return "data:image/webp;base64," + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def make_derivatives(image_path, widths=DEFAULT_WIDTHS, formats=SUPPORTED_FORMATS):
+    """Write every derivative of an image plus its LQIP, returning ``(paths, lqip)``.
+
+    The LQIP is also written next to the derivatives as ``<hash>.lqip.txt``.
+    """
+    content_hash = file_hash(image_path)
+    paths = [make_derivative(image_path, width, fmt, content_hash) for width in widths for fmt in formats]
+    lqip = make_lqip(image_path)
+    with atomic_write(os.path.join(_derivatives_dir(image_path), f"{content_hash}.lqip.txt"), 'w', 'ascii') as f:
+        f.write(lqip)
+    return paths, lqip
+
+class DerivativePool:
+    """Make derivatives in worker processes while generation carries on."""
+
+    def __init__(self, workers=None, widths=DEFAULT_WIDTHS, formats=SUPPORTED_FORMATS):
+        self.widths = widths
+        self.formats = formats
+        self.completed = 0
+        self.failed = 0
+        self._futures = []
+        # Spawn rather than fork so workers don't inherit a loaded pipeline
+        self._executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count(),
+                                             mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, image_path):
+        self._futures.append(self._executor.submit(make_derivatives, os.path.abspath(image_path),
+                                                   self.widths, self.formats))
+
+    def close(self):
+        """Wait for outstanding work and return ``(completed, failed)``."""
+        for future in self._futures:
+            try:
+                future.result()
+                self.completed += 1
+            except Exception as e:
+                print(f"✗ Error making derivatives: {str(e)}")
+                self.failed += 1
+        self._futures = []
+        self._executor.shutdown()
+        return self.completed, self.failed
+
+# Pool used by after_save; set by enable()
+_pool = None
+
+def enable(workers=None, widths=DEFAULT_WIDTHS, formats=SUPPORTED_FORMATS):
+    """Make every later ``after_save`` call queue derivatives for the saved image."""
+    global _pool
+    _pool = DerivativePool(workers, widths, formats)
+    return _pool
+
+def after_save(output_path):
+    """Post-save hook called by the generators right after writing an image."""
+    if _pool is not None:
+        _pool.submit(output_path)
+
+def finish():
+    """Wait for queued derivatives; returns ``(completed, failed)``, or None if not enabled."""
+    global _pool
+    if _pool is None:
+        return None
+    pool, _pool = _pool, None
+    return pool.close()
@@ -0,0 +1,101 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# Default configuration
+DEFAULT_CACHE_DIR = '.embedding_cache'
+DEFAULT_MAX_ENTRIES = 256  # Embeddings kept in memory (77x768 floats each for SD 1.5)
+
+class PromptEmbeddingCache:
+    """Cache CLIP text embeddings in memory (LRU) and on disk as .npy files.
+
+    Entries are keyed by a hash of the model id and the exact text that is
+    encoded. CLIP embeds every token in the context of the whole prompt, so
+    the full "prompt. style" string is the unit that gets cached; the shared
+    style suffix and the fixed negative prompt simply make those strings
+    repeat across runs.
+    """
+
+    def __init__(self, model_id, cache_dir=DEFAULT_CACHE_DIR, max_entries=DEFAULT_MAX_ENTRIES):
+        self.model_id = model_id
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode('utf-8')).hexdigest()
+
+    def _encode_text(self, pipe, text):
+        """Run the pipeline's tokenizer and text encoder exactly as diffusers does."""
+        import torch
+        inputs = pipe.tokenizer(
+            text,
+            padding="max_length",
+            max_length=pipe.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt",
+        )
+        attention_mask = None
+        if getattr(pipe.text_encoder.config, "use_attention_mask", False):
+            attention_mask = inputs.attention_mask.to(pipe.text_encoder.device)
+
+        with torch.no_grad():
+            embeds = pipe.text_encoder(inputs.input_ids.to(pipe.text_encoder.device), attention_mask=attention_mask)[0]
+        return embeds.float().cpu().numpy()
+
+    def encode(self, pipe, text):
+        """Return the embedding for ``text``, encoding it only on a cache miss."""
+        import torch
+        key = self._key(text)
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            embeds = self._entries[key]
+        else:
+            path = os.path.join(self.cache_dir, f"{key}.npy") if self.cache_dir else None
+            if path and os.path.exists(path):
+                self.hits += 1
+                embeds = torch.from_numpy(np.load(path))
+            else:
+                self.misses += 1
+                array = self._encode_text(pipe, text)
+                if path:
+                    # Write then rename so a crash never leaves a truncated file
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, array)
+                    os.replace(tmp_path, path)
+                embeds = torch.from_numpy(array)
+
+            self._entries[key] = embeds
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return embeds.to(device=pipe.text_encoder.device, dtype=pipe.text_encoder.dtype)
+
+def prompt_kwargs(pipe, prompt, negative_prompt=None, cache=None):
+    """Build the prompt arguments for a pipeline call.
+
+    ``prompt`` may be a string or a list of strings. Without a cache the text
+    is passed through unchanged; with one, cached ``prompt_embeds`` and
+    ``negative_prompt_embeds`` are passed instead so the text encoder is skipped.
+    """
+    if cache is None:
+        if negative_prompt is not None and not isinstance(prompt, str):
+            negative_prompt = [negative_prompt] * len(prompt)
+        return {'prompt': prompt, 'negative_prompt': negative_prompt}
+
+    import torch
+    prompts = [prompt] if isinstance(prompt, str) else prompt
+    # diffusers encodes an empty string when no negative prompt is given
+    negative = cache.encode(pipe, negative_prompt or "")
+    return {
+        'prompt_embeds': torch.cat([cache.encode(pipe, p) for p in prompts]),
+        'negative_prompt_embeds': torch.cat([negative] * len(prompts)),
+    }
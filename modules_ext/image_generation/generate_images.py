@@ -1,19 +1,18 @@
 import os
-import replicate
+import requests
+from io import BytesIO
 from pathlib import Path
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from tqdm import tqdm
+from PIL import Image
 import sys
-
-# Import configuration
-try:
-    from config import REPLICATE_API_TOKEN
-except ImportError:
-    print("Error: config.py not found. Please create it with your REPLICATE_API_TOKEN")
-    sys.exit(1)
-
-# Set the API token
-os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
+from output_cache import OutputCache, cache_key
+import derivatives
+import instrumentation
+from atomic import save_image, remove_temp_files
+from manifest import read_manifest, count_entries
+from journal import RunJournal, JOURNAL_FILENAME, DEFAULT_RETRY_FAILED, JournalMismatch
 
 # Default configuration
 DEFAULT_INPUT_FILE = 'img_desc.txt'
@@ -23,72 +22,94 @@ Coloring book style, black and white line art, high contrast, clean lines,
 no shading, white background, suitable for children's coloring book,
 simple and clear outlines, minimal details, no text, no watermark
 """
+DEFAULT_NEGATIVE_PROMPT = "text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed"
+DEFAULT_CONCURRENCY = 1
+DEFAULT_STEPS = 30
+REPLICATE_MODEL = "stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478"
 
-def read_image_descriptions(filename):
-    """Read image descriptions from the input file."""
-    descriptions = {}
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                if '|' in line:
-                    filename, description = line.split('|', 1)
-                    descriptions[filename.strip()] = description.strip()
-        return descriptions
-    except FileNotFoundError:
-        print(f"Error: Input file '{filename}' not found.")
-        return None
+def load_api_token():
+    """Export REPLICATE_API_TOKEN from config.py; returns False if there is no token.
 
-def generate_image(prompt, output_path, width=800, height=1000, style_prompt=DEFAULT_STYLE):
-    """Generate an image using Replicate's Stable Diffusion API."""
+    Without a config.py, a token already set in the environment is used.
+    """
     try:
-        # Add style prompts for consistent cartoon/coloring book style
-        enhanced_prompt = f"{prompt}. {style_prompt}"
+        from config import REPLICATE_API_TOKEN
+    except ImportError:
+        REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
+        if not REPLICATE_API_TOKEN:
+            print("Error: config.py not found. Please create it with your REPLICATE_API_TOKEN")
+            return False
+    if not REPLICATE_API_TOKEN:
+        print("Error: REPLICATE_API_TOKEN is not set in config.py")
+        print("Please check your config.py file and try again")
+        return False
+    os.environ["REPLICATE_API_TOKEN"] = REPLICATE_API_TOKEN
+    return True
+
+def create_session(pool_size=DEFAULT_CONCURRENCY):
+    """Create a keep-alive HTTP session that can hold ``pool_size`` open connections."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def generate_image(prompt, output_path, width=800, height=1000, style_prompt=DEFAULT_STYLE, session=None,
+                   model=REPLICATE_MODEL, seed=None, steps=DEFAULT_STEPS):
+    """Generate an image using Replicate's Stable Diffusion API.
+
+    Pass a shared ``session`` to reuse pooled connections for the download.
+    """
+    import replicate
+    with instrumentation.trace(os.path.basename(output_path), backend='replicate') as entry:
+        try:
+            # Add style prompts for consistent cartoon/coloring book style
+            enhanced_prompt = f"{prompt}. {style_prompt}"
         
-        print(f"\nGenerating: {os.path.basename(output_path)}")
-        print(f"Prompt: {prompt}")
+            print(f"\nGenerating: {os.path.basename(output_path)}")
+            print(f"Prompt: {prompt}")
         
-        # Run the model with a more stable version
-        output = replicate.run(
-            "stability-ai/stable-diffusion:27b93a2413e7f36cd83da926f3656280b2931564ff050bf9575f1fdf9bcd7478",
-            input={
+            # Run the model with a more stable version
+            inputs = {
                 "prompt": enhanced_prompt,
                 "width": width,
                 "height": height,
                 "num_outputs": 1,
-                "negative_prompt": "text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed",
-                "num_inference_steps": 30,
+                "negative_prompt": DEFAULT_NEGATIVE_PROMPT,
+                "num_inference_steps": steps,
                 "guidance_scale": 7.5,
             }
-        )
+            if seed is not None:
+                inputs["seed"] = seed
+            with instrumentation.stage('predict'):
+                output = replicate.run(model, input=inputs)
         
-        # Download the generated image
-        if output and len(output) > 0:
-            import requests
-            from io import BytesIO
-            from PIL import Image
-            
-            response = requests.get(output[0], timeout=60)  # Increased timeout
-            response.raise_for_status()
+            # Download the generated image
+            if output and len(output) > 0:
+                with instrumentation.stage('download'):
+                    response = (session or requests).get(output[0], timeout=60)  # Increased timeout
+                    response.raise_for_status()
             
-            img = Image.open(BytesIO(response.content))
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            
-            # Convert to RGB if needed (for PNG with transparency)
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
+                with instrumentation.stage('decode'):
+                    img = Image.open(BytesIO(response.content))
+                    img.load()
+                
+                    # Convert to RGB if needed (for PNG with transparency)
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
                 
-            img.save(output_path)
-            print(f"✓ Saved: {output_path}")
-            return True
+                with instrumentation.stage('save'):
+                    save_image(img, output_path)
+                derivatives.after_save(output_path)
+                print(f"✓ Saved: {output_path}")
+                return True
             
-    except Exception as e:
-        print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
-        print(f"Prompt used: {enhanced_prompt}")
+        except Exception as e:
+            print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
+            print(f"Prompt used: {enhanced_prompt}")
     
-    return False
+        entry['ok'] = False
+        return False
 
 def main():
     parser = argparse.ArgumentParser(description='Generate coloring book images from descriptions')
@@ -99,61 +120,168 @@ def main():
     parser.add_argument('--width', type=int, default=800, help='Image width (default: 800)')
     parser.add_argument('--height', type=int, default=1000, help='Image height (default: 1000)')
     parser.add_argument('--skip-existing', action='store_true', help='Skip existing files')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the output cache and regenerate everything')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                      help=f'Number of predictions to run at the same time (default: {DEFAULT_CONCURRENCY})')
+    parser.add_argument('--derivatives', action='store_true',
+                      help='Also write WebP/AVIF thumbnails and an LQIP placeholder after each save')
+    parser.add_argument('--derivative-workers', type=int, default=None,
+                      help='Processes for --derivatives (default: CPU count)')
+    parser.add_argument('--start-offset', type=int, default=0,
+                      help='Byte offset in the input file to start reading at (default: 0)')
+    parser.add_argument('--resume', action='store_true',
+                      help='Carry on where the last run in the output directory stopped, using its journal')
+    parser.add_argument('--retry-failed', type=int, default=DEFAULT_RETRY_FAILED,
+                      help=f'Extra attempts for images that fail (default: {DEFAULT_RETRY_FAILED})')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write per-stage timings here in Prometheus text format when the run ends')
+    parser.add_argument('--trace-log', default=None,
+                      help='Append a JSON line with the stage timings of every image to this file')
     
     args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
     
-    # Read image descriptions
+    print("\n" + "="*50)
+    print("Kids Coloring AI - Image Generator")
+    print("="*50)
+    print("This script generates coloring book style images using AI")
+    print("Make sure you have set the REPLICATE_API_TOKEN in config.py")
+    print("Get a free API key at: https://replicate.com/account/api-tokens")
+    print("="*50 + "\n")
+    
+    if not load_api_token():
+        sys.exit(1)
+    
+    # Count the work up front; the descriptions themselves are streamed
     print(f"Reading image descriptions from: {args.input}")
-    images = read_image_descriptions(args.input)
+    if not os.path.exists(args.input):
+        print(f"Error: Input file '{args.input}' not found.")
+        return
+    try:
+        journal = RunJournal(os.path.join(args.output, JOURNAL_FILENAME), args.input, resume=args.resume)
+    except JournalMismatch as e:
+        print(f"Error: {e}")
+        return
+    start_offset = args.start_offset or journal.checkpoint
+    if args.resume:
+        remove_temp_files(args.output, journal.previous_pids)
+        print(f"Resuming at byte {start_offset} with {len(journal.failed)} failed images from earlier runs")
+    total = count_entries(args.input, start_offset)
     
-    if not images:
+    if not total and not journal.failed:
         print("No valid image descriptions found.")
+        journal.close()
         return
     
-    print(f"Found {len(images)} images to generate")
+    print(f"Found {total} images to generate")
     print(f"Output directory: {args.output}")
     print("="*50 + "\n")
     
-    # Generate images one by one
+    cache = None if args.no_cache else OutputCache(args.output)
+    if args.derivatives:
+        derivatives.enable(args.derivative_workers)
+    
+    # Run predictions and downloads in parallel, reporting in completion order.
+    # Only a couple of predictions per thread are queued at a time, so memory
+    # stays flat however long the input is.
+    concurrency = max(1, args.concurrency)
+    session = create_session(concurrency)
     success_count = 0
-    for filename, description in tqdm(images.items(), desc="Generating images"):
+    futures = {}
+    
+    def collect(return_when):
+        nonlocal success_count
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            record, output_path, key = futures.pop(future)
+            ok = future.result()
+            if ok:
+                success_count += 1
+                if cache:
+                    cache.store(key, output_path, record.description)
+            journal.finished(record, ok)
+            progress.update(1)
+    
+    def submit(record):
+        nonlocal success_count
+        filename, description = record.filename, record.description
         output_path = os.path.join(args.output, filename)
         
-        # Skip if file already exists and --skip-existing is set
-        if args.skip_existing and os.path.exists(output_path):
+        # Skip if an earlier run finished the file, or it exists and --skip-existing is set
+        previous = journal.status(filename)
+        if os.path.exists(output_path) and (previous == 'done' or (args.skip_existing and previous != 'running')):
             print(f"Skipping existing: {filename}")
             success_count += 1
-            continue
+            journal.finished(record, True)
+            progress.update(1)
+            return
             
-        # Determine dimensions based on filename
-        if any(x in filename.lower() for x in ['banner', 'category']):
+        # Determine dimensions: per-line size first, then the filename
+        if record.width:
+            width, height = (record.width, record.height)
+        elif any(x in filename.lower() for x in ['banner', 'category']):
             width, height = (1200, 600)  # Wider format for banners
         elif 'icon' in filename.lower():
             width, height = (512, 512)   # Square for icons
         else:
             width, height = (args.width, args.height)  # Use provided or default
-            
-        # Generate the image
-        if generate_image(description, output_path, width, height):
+        model = record.model or REPLICATE_MODEL
+        steps = record.steps or DEFAULT_STEPS
+        
+        # Reuse a previous result for the exact same settings
+        key = cache_key('replicate', model, description, DEFAULT_STYLE, DEFAULT_NEGATIVE_PROMPT,
+                        width, height, steps, 7.5, seed=record.seed)
+        if cache and cache.fetch(key, output_path):
+            print(f"Cached: {filename}")
             success_count += 1
+            journal.finished(record, True)
+            progress.update(1)
+            return
+        
+        if len(futures) >= 2 * concurrency:
+            collect(FIRST_COMPLETED)
+        journal.started(record)
+        future = executor.submit(generate_image, description, output_path, width, height, session=session,
+                                 model=model, seed=record.seed, steps=steps)
+        futures[future] = (record, output_path, key)
+    
+    max_attempts = 1 + args.retry_failed
+    with tqdm(total=total, desc="Generating images") as progress, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for record in read_manifest(args.input, start_offset):
+            submit(record)
+        collect(ALL_COMPLETED)
+        
+        # Give failed images, including ones left over from earlier runs, a bounded number of retries
+        for _ in range(args.retry_failed):
+            retries = journal.retryable(max_attempts)
+            if not retries:
+                break
+            print(f"\nRetrying {len(retries)} failed images")
+            progress.total += len(retries)
+            for record in retries:
+                submit(record)
+            collect(ALL_COMPLETED)
+    session.close()
+    journal.close()
     
     print("\n" + "="*50)
     print(f"Image generation complete!")
-    print(f"Successfully generated: {success_count}/{len(images)} images")
+    print(f"Successfully generated: {success_count}/{success_count + journal.failed_count} images")
+    if journal.failed:
+        print(f"Still failed: {len(journal.failed)} ({journal.exhausted(max_attempts)} out of retries), see {journal.path}")
+    if cache:
+        print(f"Reused from cache: {cache.hits}")
+    derivative_counts = derivatives.finish()
+    if derivative_counts:
+        print(f"Derivatives written for {derivative_counts[0]} images ({derivative_counts[1]} failed)")
+    instrumentation.print_summary()
+    if args.metrics_file:
+        instrumentation.write_metrics(args.metrics_file)
+        print(f"Stage metrics written to {args.metrics_file}")
     print(f"Output directory: {os.path.abspath(args.output)}")
     print("="*50)
 
 if __name__ == "__main__":
-    print("\n" + "="*50)
-    print("Kids Coloring AI - Image Generator")
-    print("="*50)
-    print("This script generates coloring book style images using AI")
-    print("Make sure you have set the REPLICATE_API_TOKEN in config.py")
-    print("Get a free API key at: https://replicate.com/account/api-tokens")
-    print("="*50 + "\n")
-    
-    if not os.getenv("REPLICATE_API_TOKEN"):
-        print("Error: REPLICATE_API_TOKEN is not set in config.py")
-        print("Please check your config.py file and try again")
-    else:
-        main()
+    main()
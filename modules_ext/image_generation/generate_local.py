@@ -1,12 +1,21 @@
 import os
 import time
+import asyncio
+import contextvars
+import base64
 from pathlib import Path
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import requests
 from io import BytesIO
 from PIL import Image
-import ollama
+from output_cache import OutputCache, cache_key
+import derivatives
+import instrumentation
+from atomic import save_image, remove_temp_files
+from manifest import read_manifest, count_entries
+from journal import RunJournal, JOURNAL_FILENAME, DEFAULT_RETRY_FAILED, JournalMismatch
 
 # Default configuration
 DEFAULT_INPUT_FILE = 'img_desc.txt'
@@ -17,69 +26,172 @@ Coloring book style, black and white line art, high contrast, clean lines,
 no shading, white background, suitable for children's coloring book,
 simple and clear outlines, minimal details, no text, no watermark
 """
+DEFAULT_NEGATIVE_PROMPT = 'text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed'
+DEFAULT_PARALLEL = 1  # Match OLLAMA_NUM_PARALLEL on the server
+DEFAULT_TIMEOUT = 600  # Seconds allowed for a single generate request
+DEFAULT_RETRIES = 3
+DEFAULT_STEPS = 30
+RETRY_BACKOFF = 2  # Seconds before the first retry, doubled on each attempt
 
-def read_image_descriptions(filename):
-    """Read image descriptions from the input file."""
-    descriptions = {}
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                if '|' in line:
-                    filename, description = line.split('|', 1)
-                    descriptions[filename.strip()] = description.strip()
-        return descriptions
-    except FileNotFoundError:
-        print(f"Error: Input file '{filename}' not found.")
-        return None
+def generation_options(width, height, steps=DEFAULT_STEPS, seed=None):
+    """Build the Ollama options for a text-to-image request."""
+    options = {
+        'num_inference_steps': steps,
+        'guidance_scale': 7.5,
+        'width': width,
+        'height': height,
+        'negative_prompt': DEFAULT_NEGATIVE_PROMPT,
+    }
+    if seed is not None:
+        options['seed'] = seed
+    return options
 
-def generate_image(prompt, output_path, model_name=DEFAULT_MODEL, width=800, height=1000, style_prompt=DEFAULT_STYLE):
+def save_image_bytes(data, output_path):
+    """Decode image bytes (raw or base64) and save them as an RGB image."""
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    with instrumentation.stage('decode'):
+        img = Image.open(BytesIO(data))
+        img.load()
+        
+        # Convert to RGB if needed
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        
+    with instrumentation.stage('save'):
+        save_image(img, output_path)
+    derivatives.after_save(output_path)
+
+def generate_image(prompt, output_path, model_name=DEFAULT_MODEL, width=800, height=1000, style_prompt=DEFAULT_STYLE,
+                   steps=DEFAULT_STEPS, seed=None):
     """Generate an image using local Ollama model."""
-    try:
-        # Add style prompts for consistent cartoon/coloring book style
-        enhanced_prompt = f"{prompt}. {style_prompt}"
+    import ollama
+    with instrumentation.trace(os.path.basename(output_path), backend='ollama') as entry:
+        try:
+            # Add style prompts for consistent cartoon/coloring book style
+            enhanced_prompt = f"{prompt}. {style_prompt}"
         
-        print(f"\nGenerating: {os.path.basename(output_path)}")
-        print(f"Model: {model_name}")
-        print(f"Prompt: {prompt}")
+            print(f"\nGenerating: {os.path.basename(output_path)}")
+            print(f"Model: {model_name}")
+            print(f"Prompt: {prompt}")
         
-        # Generate image using Ollama
-        response = ollama.generate(
-            model=model_name,
-            prompt=enhanced_prompt,
-            images=None,  # For text-to-image
-            options={
-                'num_inference_steps': 30,
-                'guidance_scale': 7.5,
-                'width': width,
-                'height': height,
-                'negative_prompt': 'text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed',
-            }
-        )
+            # Generate image using Ollama
+            with instrumentation.stage('predict'):
+                response = ollama.generate(
+                    model=model_name,
+                    prompt=enhanced_prompt,
+                    images=None,  # For text-to-image
+                    options=generation_options(width, height, steps, seed)
+                )
         
-        # Save the generated image
-        if response and 'image' in response:
-            img = Image.open(BytesIO(response['image']))
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            # Save the generated image
+            if response and 'image' in response:
+                save_image_bytes(response['image'], output_path)
+                print(f"✓ Saved: {output_path}")
+                return True
             
-            # Convert to RGB if needed
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-                
-            img.save(output_path)
-            print(f"✓ Saved: {output_path}")
-            return True
+        except Exception as e:
+            print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
+            print(f"Prompt used: {enhanced_prompt}")
+    
+        entry['ok'] = False
+        return False
+
+def is_transient_error(error):
+    """Return True for errors worth retrying: lost connections, timeouts and busy servers."""
+    import httpx
+    import ollama
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (ConnectionError, asyncio.TimeoutError, httpx.TransportError))
+
+async def generate_image_async(client, semaphore, executor, prompt, output_path, model_name=DEFAULT_MODEL,
+                               width=800, height=1000, style_prompt=DEFAULT_STYLE,
+                               timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, steps=DEFAULT_STEPS, seed=None):
+    """Generate an image with ``ollama.AsyncClient``.
+
+    At most ``semaphore`` requests are in flight at once. Transient failures
+    are retried with exponential backoff, and decoding/saving the image runs
+    on ``executor`` so it never blocks the event loop.
+    """
+    with instrumentation.trace(os.path.basename(output_path), backend='ollama') as entry:
+        enhanced_prompt = f"{prompt}. {style_prompt}"
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    async with semaphore:
+                        started = time.perf_counter()
+                        response = await asyncio.wait_for(
+                            client.generate(
+                                model=model_name,
+                                prompt=enhanced_prompt,
+                                images=None,  # For text-to-image
+                                options=generation_options(width, height, steps, seed),
+                            ),
+                            timeout,
+                        )
+                        instrumentation.record('predict', time.perf_counter() - started)
+                    break
+                except Exception as e:
+                    if attempt == retries or not is_transient_error(e):
+                        raise
+                    delay = RETRY_BACKOFF * 2 ** attempt
+                    print(f"Retrying {os.path.basename(output_path)} in {delay}s: {str(e) or type(e).__name__}")
+                    await asyncio.sleep(delay)
+        
+            # Save the generated image
+            if response and 'image' in response:
+                loop = asyncio.get_running_loop()
+                # Run in a copy of this context so the executor's stage timings land in this image's trace
+                await loop.run_in_executor(executor, contextvars.copy_context().run, save_image_bytes,
+                                           response['image'], output_path)
+                print(f"✓ Saved: {output_path}")
+                return True
             
-    except Exception as e:
-        print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
-        print(f"Prompt used: {enhanced_prompt}")
+        except Exception as e:
+            print(f"✗ Error generating {os.path.basename(output_path)}: {str(e) or type(e).__name__}")
+            print(f"Prompt used: {enhanced_prompt}")
     
-    return False
+        entry['ok'] = False
+        return False
+
+async def generate_all_async(items, parallel=DEFAULT_PARALLEL, timeout=DEFAULT_TIMEOUT,
+                             retries=DEFAULT_RETRIES, on_done=None):
+    """Generate items that start with ``(prompt, output_path, width, height, model, steps, seed)`` concurrently.
+
+    ``items`` may be any iterable; it is consumed as slots free up, so only
+    a few items per request slot are held at once. ``on_done(item, success)``
+    is called as each item finishes, in completion order.
+    """
+    import ollama
+    client = ollama.AsyncClient()
+    semaphore = asyncio.Semaphore(parallel)
+    
+    async def run(item):
+        prompt, output_path, width, height, model_name, steps, seed = item[:7]
+        return item, await generate_image_async(client, semaphore, executor, prompt, output_path, model_name,
+                                                width, height, timeout=timeout, retries=retries,
+                                                steps=steps, seed=seed)
+    
+    def finish(tasks):
+        for task in tasks:
+            item, success = task.result()
+            if on_done:
+                on_done(item, success)
+    
+    running = set()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        for item in items:
+            if len(running) >= 2 * parallel:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                finish(done)
+            running.add(asyncio.ensure_future(run(item)))
+        if running:
+            finish((await asyncio.wait(running))[0])
 
 def check_ollama_models():
     """Check available Ollama models."""
+    import ollama
     try:
         models = ollama.list()
         print("\nAvailable models:")
@@ -103,53 +215,159 @@ def main():
     parser.add_argument('--width', type=int, default=800, help='Image width (default: 800)')
     parser.add_argument('--height', type=int, default=1000, help='Image height (default: 1000)')
     parser.add_argument('--skip-existing', action='store_true', help='Skip existing files')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the output cache and regenerate everything')
     parser.add_argument('--list-models', action='store_true', help='List available Ollama models')
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL,
+                      help=f'Requests to keep in flight; above 1 uses the async client (default: {DEFAULT_PARALLEL})')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                      help=f'Seconds allowed per request in parallel mode (default: {DEFAULT_TIMEOUT})')
+    parser.add_argument('--retries', type=int, default=DEFAULT_RETRIES,
+                      help=f'Retries for transient errors in parallel mode (default: {DEFAULT_RETRIES})')
+    parser.add_argument('--derivatives', action='store_true',
+                      help='Also write WebP/AVIF thumbnails and an LQIP placeholder after each save')
+    parser.add_argument('--derivative-workers', type=int, default=None,
+                      help='Processes for --derivatives (default: CPU count)')
+    parser.add_argument('--start-offset', type=int, default=0,
+                      help='Byte offset in the input file to start reading at (default: 0)')
+    parser.add_argument('--resume', action='store_true',
+                      help='Carry on where the last run in the output directory stopped, using its journal')
+    parser.add_argument('--retry-failed', type=int, default=DEFAULT_RETRY_FAILED,
+                      help=f'Extra attempts for images that fail (default: {DEFAULT_RETRY_FAILED})')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write per-stage timings here in Prometheus text format when the run ends')
+    parser.add_argument('--trace-log', default=None,
+                      help='Append a JSON line with the stage timings of every image to this file')
     
     args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
     
     if args.list_models:
         check_ollama_models()
         return
     
-    # Read image descriptions
+    # Count the work up front; the descriptions themselves are streamed
     print(f"\nReading image descriptions from: {args.input}")
-    images = read_image_descriptions(args.input)
+    if not os.path.exists(args.input):
+        print(f"Error: Input file '{args.input}' not found.")
+        return
+    try:
+        journal = RunJournal(os.path.join(args.output, JOURNAL_FILENAME), args.input, resume=args.resume)
+    except JournalMismatch as e:
+        print(f"Error: {e}")
+        return
+    start_offset = args.start_offset or journal.checkpoint
+    if args.resume:
+        remove_temp_files(args.output, journal.previous_pids)
+        print(f"Resuming at byte {start_offset} with {len(journal.failed)} failed images from earlier runs")
+    total = count_entries(args.input, start_offset)
     
-    if not images:
+    if not total and not journal.failed:
         print("No valid image descriptions found.")
+        journal.close()
         return
     
-    print(f"Found {len(images)} images to generate")
+    print(f"Found {total} images to generate")
     print(f"Output directory: {args.output}")
     print(f"Using model: {args.model}")
     print("="*50 + "\n")
     
-    # Generate images one by one
+    cache = None if args.no_cache else OutputCache(args.output)
+    if args.derivatives:
+        derivatives.enable(args.derivative_workers)
+    
     success_count = 0
-    for filename, description in tqdm(images.items(), desc="Generating images"):
-        output_path = os.path.join(args.output, filename)
-        
-        # Skip if file already exists and --skip-existing is set
-        if args.skip_existing and os.path.exists(output_path):
-            print(f"Skipping existing: {filename}")
-            success_count += 1
-            continue
+    
+    def pending(records, progress):
+        """Yield the items that actually need generating, as the records are read."""
+        nonlocal success_count
+        for record in records:
+            filename, description = record.filename, record.description
+            output_path = os.path.join(args.output, filename)
+            
+            # Skip if an earlier run finished the file, or it exists and --skip-existing is set
+            previous = journal.status(filename)
+            if os.path.exists(output_path) and (previous == 'done' or (args.skip_existing and previous != 'running')):
+                print(f"Skipping existing: {filename}")
+                success_count += 1
+                journal.finished(record, True)
+                progress.update(1)
+                continue
+                
+            # Determine dimensions: per-line size first, then the filename
+            if record.width:
+                width, height = (record.width, record.height)
+            elif any(x in filename.lower() for x in ['banner', 'category']):
+                width, height = (1200, 600)  # Wider format for banners
+            elif 'icon' in filename.lower():
+                width, height = (512, 512)   # Square for icons
+            else:
+                width, height = (args.width, args.height)
+            model = record.model or args.model
+            steps = record.steps or DEFAULT_STEPS
             
-        # Determine dimensions based on filename
-        if any(x in filename.lower() for x in ['banner', 'category']):
-            width, height = (1200, 600)  # Wider format for banners
-        elif 'icon' in filename.lower():
-            width, height = (512, 512)   # Square for icons
-        else:
-            width, height = (args.width, args.height)
+            # Reuse a previous result for the exact same settings
+            key = cache_key('ollama', model, description, DEFAULT_STYLE, DEFAULT_NEGATIVE_PROMPT,
+                            width, height, steps, 7.5, seed=record.seed)
+            if cache and cache.fetch(key, output_path):
+                print(f"Cached: {filename}")
+                success_count += 1
+                journal.finished(record, True)
+                progress.update(1)
+                continue
             
-        # Generate the image
-        if generate_image(description, output_path, args.model, width, height):
-            success_count += 1
+            journal.started(record)
+            yield (description, output_path, width, height, model, steps, record.seed, key, record)
+    
+    max_attempts = 1 + args.retry_failed
+    with tqdm(total=total, desc="Generating images") as progress:
+        def on_done(item, success):
+            nonlocal success_count
+            description, output_path, key, record = item[0], item[1], item[-2], item[-1]
+            if success:
+                success_count += 1
+                if cache:
+                    cache.store(key, output_path, description)
+            journal.finished(record, success)
+            progress.update(1)
+        
+        def run(records):
+            if args.parallel > 1:
+                asyncio.run(generate_all_async(pending(records, progress), args.parallel, args.timeout,
+                                               args.retries, on_done))
+            else:
+                # Generate images one by one
+                for item in pending(records, progress):
+                    description, output_path, width, height, model, steps, seed = item[:7]
+                    on_done(item, generate_image(description, output_path, model, width, height,
+                                                 steps=steps, seed=seed))
+        
+        run(read_manifest(args.input, start_offset))
+        
+        # Give failed images, including ones left over from earlier runs, a bounded number of retries
+        for _ in range(args.retry_failed):
+            retries = journal.retryable(max_attempts)
+            if not retries:
+                break
+            print(f"\nRetrying {len(retries)} failed images")
+            progress.total += len(retries)
+            run(retries)
+    journal.close()
     
     print("\n" + "="*50)
     print(f"Image generation complete!")
-    print(f"Successfully generated: {success_count}/{len(images)} images")
+    print(f"Successfully generated: {success_count}/{success_count + journal.failed_count} images")
+    if journal.failed:
+        print(f"Still failed: {len(journal.failed)} ({journal.exhausted(max_attempts)} out of retries), see {journal.path}")
+    if cache:
+        print(f"Reused from cache: {cache.hits}")
+    derivative_counts = derivatives.finish()
+    if derivative_counts:
+        print(f"Derivatives written for {derivative_counts[0]} images ({derivative_counts[1]} failed)")
+    instrumentation.print_summary()
+    if args.metrics_file:
+        instrumentation.write_metrics(args.metrics_file)
+        print(f"Stage metrics written to {args.metrics_file}")
     print(f"Output directory: {os.path.abspath(args.output)}")
     print("="*50)
 
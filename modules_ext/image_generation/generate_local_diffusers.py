@@ -1,10 +1,23 @@
 import os
-import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+import time
+import inspect
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from pathlib import Path
 import argparse
 from tqdm import tqdm
 from PIL import Image
+from embedding_cache import PromptEmbeddingCache, prompt_kwargs, DEFAULT_CACHE_DIR as DEFAULT_EMBEDDING_CACHE_DIR
+from output_cache import OutputCache, cache_key
+from generation_worker import DEFAULT_WORKER_URL, worker_health, submit_job, wait_for_job
+import derivatives
+import instrumentation
+from cpu_inference import CpuProfile, partition_cpus, pin_to_cpus, DEFAULT_INTEROP_THREADS, DEFAULT_COMPILE_CACHE_DIR
+import atomic
+from atomic import save_image, remove_temp_files
+from manifest import read_manifest, count_entries, parse_shard
+from journal import RunJournal, journal_filename, DEFAULT_RETRY_FAILED, JournalMismatch
 
 # Default configuration
 DEFAULT_INPUT_FILE = 'img_desc.txt'
@@ -15,77 +28,247 @@ Coloring book style, black and white line art, high contrast, clean lines,
 no shading, white background, suitable for children's coloring book,
 simple and clear outlines, minimal details, no text, no watermark
 """
+DEFAULT_NEGATIVE_PROMPT = "text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed"
+DEFAULT_BATCH_SIZE = 1
+DEFAULT_STEPS = 30
+WORKER_JOBS_IN_FLIGHT = 16  # Jobs queued on a resident worker at once
+BATCH_MAX_WAIT = 4  # A part-full batch runs after this many batches' worth of other images
 
-def read_image_descriptions(filename):
-    """Read image descriptions from the input file."""
-    descriptions = {}
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                if '|' in line:
-                    filename, description = line.split('|', 1)
-                    descriptions[filename.strip()] = description.strip()
-        return descriptions
-    except FileNotFoundError:
-        print(f"Error: Input file '{filename}' not found.")
-        return None
-
-def load_model(model_name, device="cuda" if torch.cuda.is_available() else "cpu"):
-    """Load the Stable Diffusion model."""
+# Linear approximation of the SD 1.x VAE decoder, mapping the 4 latent channels to RGB
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+def default_device():
+    """``"cuda"`` when a GPU is available, otherwise ``"cpu"``."""
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def load_model(model_name, device=None, cpu_profile=None):
+    """Load the Stable Diffusion model.
+
+    With a ``cpu_profile`` (see ``cpu_inference.CpuProfile``) and a CPU
+    device, the pipeline is tuned for CPU inference instead.
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+
+    device = device or default_device()
     print(f"Loading model: {model_name}...")
+    started = time.perf_counter()
     
-    # Use FP16 for better performance if GPU is available
-    torch_dtype = torch.float16 if device == "cuda" else torch.float32
-    
-    pipe = StableDiffusionPipeline.from_pretrained(
-        model_name,
-        torch_dtype=torch_dtype,
-        safety_checker=None,  # Disable safety checker for more consistent results
-    )
-    
-    # Enable attention slicing for lower memory usage
-    pipe.enable_attention_slicing()
-    pipe = pipe.to(device)
-    
-    # Use DPMSolver for faster inference
-    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    if cpu_profile is not None and device == "cpu":
+        # Attention slicing only saves GPU memory; on CPU it just adds overhead
+        pipe = StableDiffusionPipeline.from_pretrained(model_name, torch_dtype=torch.float32, safety_checker=None)
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        cpu_profile.apply(pipe, model_name)
+        print(f"Model loaded on cpu ({cpu_profile.describe()}).")
+    else:
+        # Use FP16 for better performance if GPU is available
+        torch_dtype = torch.float16 if device == "cuda" else torch.float32
+        
+        pipe = StableDiffusionPipeline.from_pretrained(
+            model_name,
+            torch_dtype=torch_dtype,
+            safety_checker=None,  # Disable safety checker for more consistent results
+        )
+        
+        # Enable attention slicing for lower memory usage
+        pipe.enable_attention_slicing()
+        pipe = pipe.to(device)
+        
+        # Use DPMSolver for faster inference
+        pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+        
+        print(f"Model loaded on {device}.")
     
-    print(f"Model loaded on {device}.")
-    return pipe
+    instrumentation.record('model_load', time.perf_counter() - started)
+    return instrumentation.instrument_pipeline(pipe)
 
-def generate_image(pipe, prompt, output_path, width=512, height=512, style_prompt=DEFAULT_STYLE, device="cuda" if torch.cuda.is_available() else "cpu"):
-    """Generate an image using the loaded model."""
-    try:
-        # Add style prompts for consistent cartoon/coloring book style
-        enhanced_prompt = f"{prompt}. {style_prompt}"
+def autocast_context(pipe, device):
+    """Autocast for a pipeline call: the CPU profile's if the pipeline was loaded with one."""
+    import torch
+    cpu_profile = getattr(pipe, 'cpu_profile', None)
+    return cpu_profile.autocast() if cpu_profile else torch.autocast(device)
+
+def latents_to_preview(latents):
+    """Turn in-progress latents into a small RGB preview without running the VAE.
+
+    The result is 1/8 of the final image size (64x64 for a 512x512 image).
+    """
+    import torch
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = latents[0].float().permute(1, 2, 0) @ factors
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).byte().cpu().numpy()
+    return Image.fromarray(rgb)
+
+def step_callback_kwargs(pipe, progress_callback, total_steps):
+    """Build pipeline arguments that report ``progress_callback(step, total_steps, latents)`` after every step.
+
+    Uses ``callback_on_step_end`` on diffusers versions that have it and the
+    older ``callback``/``callback_steps`` pair otherwise.
+    """
+    if progress_callback is None:
+        return {}
+    if 'callback_on_step_end' in inspect.signature(pipe.__call__).parameters:
+        def on_step_end(pipe, step, timestep, callback_kwargs):
+            progress_callback(step + 1, total_steps, callback_kwargs['latents'])
+            return callback_kwargs
+        return {'callback_on_step_end': on_step_end}
+    return {
+        'callback': lambda step, timestep, latents: progress_callback(step + 1, total_steps, latents),
+        'callback_steps': 1,
+    }
+
+def make_generator(device, seed=None):
+    """A ``torch.Generator`` seeded with ``seed``, or with a fresh random seed when it is None."""
+    import torch
+    generator = torch.Generator(device)
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+def generate_image(pipe, prompt, output_path, width=512, height=512, style_prompt=DEFAULT_STYLE, device=None, embedding_cache=None, seed=None, negative_prompt=DEFAULT_NEGATIVE_PROMPT, progress_callback=None, steps=DEFAULT_STEPS):
+    """Generate an image using the loaded model.
+
+    ``progress_callback(step, total_steps, latents)`` is called after each denoising step.
+    """
+    device = device or default_device()
+    with instrumentation.trace(os.path.basename(output_path), backend='diffusers') as entry:
+        try:
+            # Add style prompts for consistent cartoon/coloring book style
+            enhanced_prompt = f"{prompt}. {style_prompt}"
         
-        print(f"\nGenerating: {os.path.basename(output_path)}")
-        print(f"Prompt: {prompt}")
+            print(f"\nGenerating: {os.path.basename(output_path)}")
+            print(f"Prompt: {prompt}")
         
-        # Generate the image
-        with torch.autocast(device):
-            image = pipe(
-                enhanced_prompt,
-                width=width,
-                height=height,
-                num_inference_steps=30,
-                guidance_scale=7.5,
-                negative_prompt="text, watermark, signature, dark, blurry, shaded, grayscale, photo, realistic, complex, detailed",
-            ).images[0]
+            # Generate the image
+            with autocast_context(pipe, device):
+                image = pipe(
+                    width=width,
+                    height=height,
+                    num_inference_steps=steps,
+                    guidance_scale=7.5,
+                    generator=make_generator(device, seed) if seed is not None else None,
+                    **prompt_kwargs(pipe, enhanced_prompt, negative_prompt, embedding_cache),
+                    **step_callback_kwargs(pipe, progress_callback, steps),
+                ).images[0]
         
-        # Save the image
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        image.save(output_path)
-        print(f"✓ Saved: {output_path}")
-        return True
+            # Save the image
+            with instrumentation.stage('save'):
+                save_image(image, output_path)
+            derivatives.after_save(output_path)
+            print(f"✓ Saved: {output_path}")
+            return True
         
-    except Exception as e:
-        print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
-        print(f"Prompt used: {enhanced_prompt}")
-        return False
+        except Exception as e:
+            print(f"✗ Error generating {os.path.basename(output_path)}: {str(e)}")
+            print(f"Prompt used: {enhanced_prompt}")
+            entry['ok'] = False
+            return False
+
+def generate_batch(pipe, items, width=512, height=512, style_prompt=DEFAULT_STYLE, device=None, embedding_cache=None, steps=DEFAULT_STEPS, seeds=None):
+    """Generate several same-sized images with a single pipeline call.
+
+    ``items`` is a list of ``(prompt, output_path)`` pairs and ``seeds`` an
+    optional matching list of seeds (None for random). Returns one success
+    flag per item. If the batched call fails, each prompt is retried on its
+    own so that one bad prompt does not lose the rest of the batch.
+    """
+    device = device or default_device()
+    prompts = [f"{prompt}. {style_prompt}" for prompt, _ in items]
+    seeds = seeds or [None] * len(items)
+    
+    print(f"\nGenerating batch of {len(items)} at {width}x{height}:")
+    for prompt, output_path in items:
+        print(f"  {os.path.basename(output_path)}: {prompt}")
+    
+    with instrumentation.trace([os.path.basename(path) for _, path in items], backend='diffusers') as entry:
+        try:
+            with autocast_context(pipe, device):
+                images = pipe(
+                    width=width,
+                    height=height,
+                    num_inference_steps=steps,
+                    guidance_scale=7.5,
+                    generator=[make_generator(device, seed) for seed in seeds] if any(seed is not None for seed in seeds) else None,
+                    **prompt_kwargs(pipe, prompts, DEFAULT_NEGATIVE_PROMPT, embedding_cache),
+                ).images
+        except Exception as e:
+            print(f"✗ Batch failed ({str(e)}), falling back to one image at a time")
+            entry['ok'] = False
+            return [
+                generate_image(pipe, prompt, output_path, width, height, style_prompt, device, embedding_cache,
+                               seed=seed, steps=steps)
+                for (prompt, output_path), seed in zip(items, seeds)
+            ]
+    
+        # Save each image under its own filename
+        results = []
+        for (prompt, output_path), image in zip(items, images):
+            try:
+                with instrumentation.stage('save'):
+                    save_image(image, output_path)
+                derivatives.after_save(output_path)
+                print(f"✓ Saved: {output_path}")
+                results.append(True)
+            except Exception as e:
+                print(f"✗ Error saving {os.path.basename(output_path)}: {str(e)}")
+                entry['ok'] = False
+                results.append(False)
+        return results
+
+def generate_items(pipe, items, width, height, device, embedding_cache, steps, seeds):
+    """Generate same-sized ``(prompt, output_path)`` items: one pipeline call each, or one batched call for several."""
+    if len(items) == 1:
+        (prompt, output_path), = items
+        return [generate_image(pipe, prompt, output_path, width, height, device=device,
+                               embedding_cache=embedding_cache, seed=seeds[0], steps=steps)]
+    return generate_batch(pipe, items, width, height, device=device, embedding_cache=embedding_cache, steps=steps,
+                          seeds=seeds)
+
+def get_dimensions(filename, width, height):
+    """Pick the image size for a file based on its name."""
+    if any(x in filename.lower() for x in ['banner', 'category']):
+        return (1024, 512)  # Wider format for banners
+    elif 'icon' in filename.lower():
+        return (512, 512)   # Square for icons
+    return (width, height)
+
+# State of a --workers process, set up by _init_worker
+_worker = {}
+
+def _init_worker(cpu_groups, cpu_profile_settings, embedding_cache_dir, trace_log, run_pid):
+    """Start a --workers process: pin it to the next free group of CPUs and size torch's thread pools to match."""
+    import torch
+    atomic.set_owner(run_pid)  # So a resume of this run can find its temp files
+    cpus = cpu_groups.get()
+    pin_to_cpus(cpus)
+    cpu_profile = None
+    if cpu_profile_settings is not None:
+        cpu_profile = CpuProfile(len(cpus), **cpu_profile_settings)
+    else:
+        torch.set_num_threads(len(cpus))
+        torch.set_num_interop_threads(DEFAULT_INTEROP_THREADS)
+    if trace_log:
+        instrumentation.enable_trace_log(trace_log)
+    _worker.update(cpu_profile=cpu_profile, embedding_cache_dir=embedding_cache_dir, pipes={})
+
+def _run_in_worker(model, items, width, height, steps, seeds):
+    """Generate one batch in a --workers process; returns the success flags and the stage timings."""
+    pipes = _worker['pipes']
+    if model not in pipes:
+        cache_dir = _worker['embedding_cache_dir']
+        pipes[model] = (load_model(model, 'cpu', _worker['cpu_profile']),
+                        PromptEmbeddingCache(model, cache_dir) if cache_dir else None)
+    pipe, embedding_cache = pipes[model]
+    results = generate_items(pipe, items, width, height, 'cpu', embedding_cache, steps, seeds)
+    return results, instrumentation.metrics.take()
 
 def main():
     parser = argparse.ArgumentParser(description='Generate coloring book images using local Stable Diffusion')
@@ -99,58 +282,290 @@ def main():
     parser.add_argument('--height', type=int, default=512, help='Image height (default: 512)')
     parser.add_argument('--skip-existing', action='store_true', help='Skip existing files')
     parser.add_argument('--cpu', action='store_true', help='Force CPU mode')
+    parser.add_argument('--cpu-optimized', action='store_true',
+                      help='Run on CPU with pinned threads, channels_last and bfloat16 where supported')
+    parser.add_argument('--threads', type=int, default=None,
+                      help='Intra-op threads for --cpu-optimized (default: available CPUs)')
+    parser.add_argument('--interop-threads', type=int, default=DEFAULT_INTEROP_THREADS,
+                      help=f'Inter-op threads for --cpu-optimized (default: {DEFAULT_INTEROP_THREADS})')
+    parser.add_argument('--compile', action='store_true',
+                      help='With --cpu-optimized, torch.compile the UNet (slow first image, cached for later runs)')
+    parser.add_argument('--compile-cache', default=DEFAULT_COMPILE_CACHE_DIR,
+                      help=f'Directory for compiled UNet artifacts (default: {DEFAULT_COMPILE_CACHE_DIR})')
+    parser.add_argument('--workers', type=int, default=1,
+                      help='CPU processes, each with its own pipeline and its own share of the cores (default: 1)')
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                      help='Only generate shard i/n of the manifest, e.g. 2/4, to split it across n machines')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                      help=f'Number of same-sized images per pipeline call (default: {DEFAULT_BATCH_SIZE})')
+    parser.add_argument('--embedding-cache', default=DEFAULT_EMBEDDING_CACHE_DIR,
+                      help=f'Directory for cached prompt embeddings (default: {DEFAULT_EMBEDDING_CACHE_DIR})')
+    parser.add_argument('--no-embedding-cache', action='store_true', help='Always run the text encoder')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the output cache and regenerate everything')
+    parser.add_argument('--worker-url', default=DEFAULT_WORKER_URL,
+                      help=f'Resident worker to send jobs to when one is running (default: {DEFAULT_WORKER_URL})')
+    parser.add_argument('--no-worker', action='store_true', help='Always load the model in this process')
+    parser.add_argument('--derivatives', action='store_true',
+                      help='Also write WebP/AVIF thumbnails and an LQIP placeholder after each save')
+    parser.add_argument('--derivative-workers', type=int, default=None,
+                      help='Processes for --derivatives (default: CPU count)')
+    parser.add_argument('--start-offset', type=int, default=0,
+                      help='Byte offset in the input file to start reading at (default: 0)')
+    parser.add_argument('--resume', action='store_true',
+                      help='Carry on where the last run in the output directory stopped, using its journal')
+    parser.add_argument('--retry-failed', type=int, default=DEFAULT_RETRY_FAILED,
+                      help=f'Extra attempts for images that fail (default: {DEFAULT_RETRY_FAILED})')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write per-stage timings here in Prometheus text format when the run ends')
+    parser.add_argument('--trace-log', default=None,
+                      help='Append a JSON line with the stage timings of every image to this file')
     
     args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
     
-    # Set device
-    device = "cpu" if args.cpu or not torch.cuda.is_available() else "cuda"
-    if device == "cuda":
+    # Set device; torch is imported only now, so --help stays fast
+    import torch
+    workers = max(1, args.workers)
+    device = "cpu" if args.cpu or args.cpu_optimized or workers > 1 or not torch.cuda.is_available() else "cuda"
+    cpu_groups = partition_cpus(workers) if workers > 1 else None
+    cpu_profile = None
+    if cpu_groups:
+        print(f"Using {workers} CPU worker processes with {', '.join(str(len(group)) for group in cpu_groups)} CPUs"
+              + (", CPU-optimized" if args.cpu_optimized else ""))
+    elif args.cpu_optimized:
+        cpu_profile = CpuProfile(args.threads, args.interop_threads, compile_unet=args.compile,
+                                 compile_cache_dir=args.compile_cache)
+        print(f"Using CPU-optimized profile: {cpu_profile.describe()}")
+    elif device == "cuda":
         print(f"Using GPU: {torch.cuda.get_device_name(0)}")
     else:
         print("Using CPU (this will be slower)")
     
-    # Load the model
-    pipe = load_model(args.model, device)
-    
-    # Read image descriptions
+    # Count the work up front; the descriptions themselves are streamed
     print(f"\nReading image descriptions from: {args.input}")
-    images = read_image_descriptions(args.input)
+    if not os.path.exists(args.input):
+        print(f"Error: Input file '{args.input}' not found.")
+        return
+    try:
+        journal = RunJournal(os.path.join(args.output, journal_filename(args.shard)), args.input,
+                             resume=args.resume, shard=args.shard)
+    except JournalMismatch as e:
+        print(f"Error: {e}")
+        return
+    start_offset = args.start_offset or journal.checkpoint
+    if args.resume:
+        remove_temp_files(args.output, journal.previous_pids)
+        print(f"Resuming at byte {start_offset} with {len(journal.failed)} failed images from earlier runs")
+    if args.shard:
+        print(f"Taking shard {args.shard[0]}/{args.shard[1]} of the manifest")
+    total = count_entries(args.input, start_offset, args.shard)
     
-    if not images:
+    if not total and not journal.failed:
         print("No valid image descriptions found.")
+        journal.close()
         return
     
-    print(f"Found {len(images)} images to generate")
+    print(f"Found {total} images to generate")
     print(f"Output directory: {args.output}")
     print(f"Using model: {args.model}")
     print("="*50 + "\n")
     
-    # Generate images one by one
+    cache = None if args.no_cache else OutputCache(args.output)
+    if args.derivatives:
+        derivatives.enable(args.derivative_workers)
+    
     success_count = 0
-    for filename, description in tqdm(images.items(), desc="Generating images"):
+    health = None  # Resident worker status, looked up on the first cache miss
+    worker_jobs = deque()  # (job_id, record, output_path, key) queued on the worker
+    pipes = {}  # model -> (pipe, embedding cache), loaded on first use
+    batches = {}  # (model, width, height, steps) -> [(record, output_path, key, submitted)]
+    submitted = 0
+    batch_size = max(1, args.batch_size)
+    pool = None
+    pool_jobs = {}  # future -> batch, for batches running in --workers processes
+    if cpu_groups:
+        context = multiprocessing.get_context('spawn')  # torch's thread pools do not survive a fork
+        free_groups = context.Queue()
+        for group in cpu_groups:
+            free_groups.put(group)
+        cpu_profile_settings = None
+        if args.cpu_optimized:
+            cpu_profile_settings = {'interop_threads': args.interop_threads, 'compile_unet': args.compile,
+                                    'compile_cache_dir': args.compile_cache}
+        pool = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                   initargs=(free_groups, cpu_profile_settings,
+                                             None if args.no_embedding_cache else args.embedding_cache,
+                                             args.trace_log, os.getpid()))
+    
+    def finished(record, output_path, key, ok):
+        nonlocal success_count
+        if ok:
+            success_count += 1
+            if cache:
+                cache.store(key, output_path, record.description)
+        journal.finished(record, ok)
+        progress.update(1)
+    
+    def wait_for_worker(job_id, record, output_path, key):
+        nonlocal health
+        job = wait_for_job(args.worker_url, job_id)
+        ok = job['status'] == 'done'
+        if ok:
+            derivatives.after_save(output_path)  # The worker saved it
+            print(f"✓ Saved: {output_path}")
+        elif 'error' in job:
+            # The worker is gone or stuck: the rest of the run, and the retries, generate locally
+            print(f"✗ Error generating {os.path.basename(output_path)}: {job['error']}")
+            health = {}
+        else:
+            print(f"✗ Error generating {os.path.basename(output_path)} (see worker log)")
+        finished(record, output_path, key, ok)
+    
+    def run_batch(shape, batch):
+        model, width, height, steps = shape
+        items = [(record.description, output_path) for record, output_path, _, _ in batch]
+        seeds = [record.seed for record, _, _, _ in batch]
+        if pool:
+            # Keep a couple of batches per process queued, so no process waits for work
+            while len(pool_jobs) >= 2 * workers:
+                collect_pool(FIRST_COMPLETED)
+            pool_jobs[pool.submit(_run_in_worker, model, items, width, height, steps, seeds)] = batch
+            return
+        # Only pay for a model when something actually needs generating with it
+        if model not in pipes:
+            pipe = load_model(model, device, cpu_profile)
+            embedding_cache = None if args.no_embedding_cache else PromptEmbeddingCache(model, args.embedding_cache)
+            pipes[model] = (pipe, embedding_cache)
+        pipe, embedding_cache = pipes[model]
+        results = generate_items(pipe, items, width, height, device, embedding_cache, steps, seeds)
+        for (record, output_path, key, _), ok in zip(batch, results):
+            finished(record, output_path, key, ok)
+    
+    def collect_pool(return_when):
+        done, _ = wait(pool_jobs, return_when=return_when)
+        for future in done:
+            batch = pool_jobs.pop(future)
+            try:
+                results, stages = future.result()
+                instrumentation.metrics.merge(stages)
+            except Exception as e:
+                print(f"✗ Worker process failed: {str(e) or type(e).__name__}")
+                results = [False] * len(batch)
+            for (record, output_path, key, _), ok in zip(batch, results):
+                if ok:
+                    derivatives.after_save(output_path)  # The worker process saved it
+                finished(record, output_path, key, ok)
+    
+    def submit(record):
+        nonlocal success_count, health, submitted
+        filename, description = record.filename, record.description
         output_path = os.path.join(args.output, filename)
         
-        # Skip if file already exists and --skip-existing is set
-        if args.skip_existing and os.path.exists(output_path):
+        # Skip if an earlier run finished the file, or it exists and --skip-existing is set
+        previous = journal.status(filename)
+        if os.path.exists(output_path) and (previous == 'done' or (args.skip_existing and previous != 'running')):
             print(f"Skipping existing: {filename}")
             success_count += 1
-            continue
-            
-        # Determine dimensions based on filename
-        if any(x in filename.lower() for x in ['banner', 'category']):
-            width, height = (1024, 512)  # Wider format for banners
-        elif 'icon' in filename.lower():
-            width, height = (512, 512)   # Square for icons
+            journal.finished(record, True)
+            progress.update(1)
+            return
+        
+        # Determine dimensions: per-line size first, then the filename
+        if record.width:
+            width, height = (record.width, record.height)
         else:
-            width, height = (args.width, args.height)
-            
-        # Generate the image
-        if generate_image(pipe, description, output_path, width, height, device=device):
+            width, height = get_dimensions(filename, args.width, args.height)
+        model = record.model or args.model
+        steps = record.steps or DEFAULT_STEPS
+        
+        # Reuse a previous result for the exact same settings
+        key = cache_key('diffusers', model, description, DEFAULT_STYLE, DEFAULT_NEGATIVE_PROMPT,
+                        width, height, steps, 7.5, seed=record.seed)
+        if cache and cache.fetch(key, output_path):
+            print(f"Cached: {filename}")
             success_count += 1
+            journal.finished(record, True)
+            progress.update(1)
+            return
+        
+        # Hand the work to a resident worker with the same model if one is running
+        if health is None:
+            health = (None if args.no_worker or pool else worker_health(args.worker_url)) or {}
+            if health.get('model') == args.model:
+                print(f"Sending jobs to worker at {args.worker_url} (queue depth: {health['queue_depth']})")
+            elif health:
+                print(f"Worker at {args.worker_url} serves {health['model']}, loading {args.model} locally")
+        journal.started(record)
+        if health.get('model') == model and len(worker_jobs) >= WORKER_JOBS_IN_FLIGHT:
+            wait_for_worker(*worker_jobs.popleft())  # May find the worker gone and clear health
+        if health.get('model') == model:
+            try:
+                job_id = submit_job(args.worker_url, description, output_path, width, height, seed=record.seed,
+                                    steps=steps)
+                worker_jobs.append((job_id, record, output_path, key))
+                return
+            except OSError as e:
+                print(f"Worker at {args.worker_url} stopped taking jobs ({e}), loading {model} locally")
+                health = {}
+        
+        # Collect same-shaped work into batches and run each one as soon as it is full.
+        # A batch of a rare shape is run part-full once it falls far behind, so it
+        # does not hold back the journal checkpoint for the rest of the run.
+        submitted += 1
+        shape = (model, width, height, steps)
+        batch = batches.setdefault(shape, [])
+        batch.append((record, output_path, key, submitted))
+        for shape, batch in list(batches.items()):
+            if len(batch) >= batch_size or batch[0][3] < submitted - BATCH_MAX_WAIT * batch_size:
+                run_batch(shape, batches.pop(shape))
+    
+    def drain():
+        for shape in list(batches):
+            run_batch(shape, batches.pop(shape))
+        if pool_jobs:
+            collect_pool(ALL_COMPLETED)
+        while worker_jobs:
+            wait_for_worker(*worker_jobs.popleft())
+    
+    max_attempts = 1 + args.retry_failed
+    with tqdm(total=total, desc="Generating images") as progress:
+        for record in read_manifest(args.input, start_offset, shard=args.shard):
+            submit(record)
+        drain()
+        
+        # Give failed images, including ones left over from earlier runs, a bounded number of retries
+        for _ in range(args.retry_failed):
+            retries = journal.retryable(max_attempts)
+            if not retries:
+                break
+            print(f"\nRetrying {len(retries)} failed images")
+            progress.total += len(retries)
+            for record in retries:
+                submit(record)
+            drain()
+    if pool:
+        pool.shutdown()
+    journal.close()
     
     print("\n" + "="*50)
     print(f"Image generation complete!")
-    print(f"Successfully generated: {success_count}/{len(images)} images")
+    print(f"Successfully generated: {success_count}/{success_count + journal.failed_count} images")
+    if journal.failed:
+        print(f"Still failed: {len(journal.failed)} ({journal.exhausted(max_attempts)} out of retries), see {journal.path}")
+    if cache:
+        print(f"Reused from cache: {cache.hits}")
+    for _, embedding_cache in pipes.values():
+        if embedding_cache:
+            print(f"Prompt embedding cache ({embedding_cache.model_id}): "
+                  f"{embedding_cache.hits} hits, {embedding_cache.misses} misses")
+    derivative_counts = derivatives.finish()
+    if derivative_counts:
+        print(f"Derivatives written for {derivative_counts[0]} images ({derivative_counts[1]} failed)")
+    instrumentation.print_summary()
+    if args.metrics_file:
+        instrumentation.write_metrics(args.metrics_file)
+        print(f"Stage metrics written to {args.metrics_file}")
     print(f"Output directory: {os.path.abspath(args.output)}")
     print("="*50)
 
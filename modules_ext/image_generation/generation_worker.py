@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+import instrumentation
+
+# Default configuration
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7861
+DEFAULT_WORKER_URL = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}"
+MAX_FINISHED_JOBS = 1000  # Finished jobs kept around for status lookups
+DEFAULT_STALL_TIMEOUT = 600  # Seconds a job may go without progress before a client gives up on it
+MAX_POLL_ERRORS = 3  # Failed status polls in a row before a client treats the worker as gone
+
+class GenerationWorker:
+    """Run generation jobs one at a time against a pipeline that stays loaded."""
+
+    def __init__(self, pipe, model_name, device, embedding_cache=None):
+        from generate_local_diffusers import generate_image
+        self._generate_image = generate_image
+
+        self.pipe = pipe
+        self.model_name = model_name
+        self.device = device
+        self.embedding_cache = embedding_cache
+        self.started_at = time.time()
+        self.completed = 0
+        self.failed = 0
+        self.running = None
+        self.activity = 0  # Bumped on every denoising step of any job, so clients can tell a busy worker from a stuck one
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, spec):
+        """Queue a job and return its status record."""
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'prompt': spec['prompt'],
+            'output_path': os.path.abspath(spec['output_path']),
+            'width': int(spec.get('width', 512)),
+            'height': int(spec.get('height', 512)),
+            'seed': spec.get('seed'),
+            'steps': spec.get('steps'),
+            'style': spec.get('style'),
+            'negative_prompt': spec.get('negative_prompt'),
+            'step': 0,
+            'total_steps': None,
+            'submitted_at': time.time(),
+        }
+        with self._lock:
+            self._jobs[job['id']] = job
+        self._queue.put(job['id'])
+        return dict(job)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job, activity=self.activity) if job else None
+
+    def stats(self):
+        return {
+            'status': 'ok',
+            'model': self.model_name,
+            'device': self.device,
+            'queue_depth': self._queue.qsize(),
+            'running': self.running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'uptime': round(time.time() - self.started_at, 1),
+        }
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs[job_id]
+                job['status'] = 'running'
+                job['started_at'] = time.time()
+            self.running = job_id
+
+            kwargs = {}
+            if job['style'] is not None:
+                kwargs['style_prompt'] = job['style']
+            if job['negative_prompt'] is not None:
+                kwargs['negative_prompt'] = job['negative_prompt']
+            if job['steps'] is not None:
+                kwargs['steps'] = int(job['steps'])
+
+            def report(step, total_steps, latents):
+                with self._lock:
+                    job['step'], job['total_steps'] = step, total_steps
+                    self.activity += 1
+
+            ok = self._generate_image(
+                self.pipe, job['prompt'], job['output_path'], job['width'], job['height'],
+                device=self.device, embedding_cache=self.embedding_cache, seed=job['seed'],
+                progress_callback=report, **kwargs
+            )
+
+            self.running = None
+            with self._lock:
+                job['status'] = 'done' if ok else 'failed'
+                job['finished_at'] = time.time()
+                self.activity += 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._prune()
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job['status'] in ('done', 'failed')]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+class WorkerRequestHandler(BaseHTTPRequestHandler):
+    """HTTP front end: GET /health, GET /metrics, POST /jobs and GET /jobs/<id>."""
+
+    def log_message(self, format, *args):
+        pass  # Keep the console for generation output
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(self.server.worker.stats())
+        elif self.path == '/metrics':
+            self._send_metrics()
+        elif self.path.startswith('/jobs/'):
+            job = self.server.worker.get(self.path[len('/jobs/'):])
+            self._send_json(job or {'error': 'job not found'}, 200 if job else 404)
+        else:
+            self._send_json({'error': 'not found'}, 404)
+
+    def _send_metrics(self):
+        stats = self.server.worker.stats()
+        lines = []
+        for name, kind, help_text, value in [
+            ("worker_jobs_completed_total", "counter", "Jobs that produced an image", stats['completed']),
+            ("worker_jobs_failed_total", "counter", "Jobs that failed", stats['failed']),
+            ("worker_queue_depth", "gauge", "Jobs waiting to run", stats['queue_depth']),
+        ]:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {value}"]
+        body = ("\n".join(lines) + "\n" + instrumentation.metrics.render()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self._send_json({'error': 'not found'}, 404)
+            return
+        try:
+            spec = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._send_json(self.server.worker.submit(spec), 202)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json({'error': f'invalid job: {e}'}, 400)
+
+def _request(url, payload=None, timeout=10):
+    data = json.dumps(payload).encode('utf-8') if payload is not None else None
+    req = urlrequest.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urlrequest.urlopen(req, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def worker_health(url=DEFAULT_WORKER_URL, timeout=0.5):
+    """Return the worker's health stats, or None if no worker is listening."""
+    try:
+        return _request(f"{url}/health", timeout=timeout)
+    except OSError:
+        return None
+
+def submit_job(url, prompt, output_path, width=512, height=512, seed=None, style=None, negative_prompt=None, steps=None):
+    """Queue a job on a running worker and return its id.
+
+    ``style``, ``negative_prompt`` and ``steps`` use the worker's defaults when
+    ``None``; pass ``''`` for no negative prompt. Raises ``OSError`` (including
+    ``URLError`` and ``HTTPError``) when the worker cannot take the job.
+    """
+    job = _request(f"{url}/jobs", {
+        'prompt': prompt,
+        'output_path': os.path.abspath(output_path),
+        'width': width,
+        'height': height,
+        'seed': seed,
+        'style': style,
+        'negative_prompt': negative_prompt,
+        'steps': steps,
+    })
+    return job['id']
+
+def wait_for_job(url, job_id, poll_interval=0.5, on_update=None, stall_timeout=DEFAULT_STALL_TIMEOUT):
+    """Block until a job finishes and return its final status record.
+
+    ``on_update(job)`` is called with every status record polled along the way.
+    If the worker stops answering, or neither the job nor the worker makes
+    progress for ``stall_timeout`` seconds (a queued job waits as long as
+    the jobs ahead of it keep moving), a ``'failed'`` record with an ``error``
+    message is returned instead; records from the worker itself never
+    carry ``error``, so callers can tell a lost worker from a failed image.
+    """
+    progress, progressed_at, errors = None, time.monotonic(), 0
+    while True:
+        try:
+            job = _request(f"{url}/jobs/{job_id}")
+            errors = 0
+        except (OSError, ValueError) as e:
+            errors += 1
+            if errors >= MAX_POLL_ERRORS:
+                return {'id': job_id, 'status': 'failed', 'error': f"worker at {url} is not answering: {e}"}
+            time.sleep(poll_interval)
+            continue
+        if on_update:
+            on_update(job)
+        if job['status'] in ('done', 'failed'):
+            return job
+        if (job['status'], job.get('activity')) != progress:
+            progress, progressed_at = (job['status'], job.get('activity')), time.monotonic()
+        elif time.monotonic() - progressed_at > stall_timeout:
+            return {'id': job_id, 'status': 'failed', 'error': f"no progress from the worker for {stall_timeout}s"}
+        time.sleep(poll_interval)
+
+def main():
+    from generate_local_diffusers import load_model, default_device, DEFAULT_MODEL
+    from embedding_cache import PromptEmbeddingCache
+    from cpu_inference import CpuProfile, DEFAULT_INTEROP_THREADS, DEFAULT_COMPILE_CACHE_DIR
+    parser = argparse.ArgumentParser(description='Keep a Stable Diffusion pipeline loaded and serve generation jobs')
+    parser.add_argument('--model', '-m', default=DEFAULT_MODEL, help=f'Model to use (default: {DEFAULT_MODEL})')
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'Address to listen on (default: {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'Port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--cpu', action='store_true', help='Force CPU mode')
+    parser.add_argument('--cpu-optimized', action='store_true',
+                        help='Run on CPU with pinned threads, channels_last and bfloat16 where supported')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='Intra-op threads for --cpu-optimized (default: available CPUs)')
+    parser.add_argument('--interop-threads', type=int, default=DEFAULT_INTEROP_THREADS,
+                        help=f'Inter-op threads for --cpu-optimized (default: {DEFAULT_INTEROP_THREADS})')
+    parser.add_argument('--compile', action='store_true',
+                        help='With --cpu-optimized, torch.compile the UNet (slow first image, cached for later runs)')
+    parser.add_argument('--compile-cache', default=DEFAULT_COMPILE_CACHE_DIR,
+                        help=f'Directory for compiled UNet artifacts (default: {DEFAULT_COMPILE_CACHE_DIR})')
+    parser.add_argument('--trace-log', default=None,
+                        help='Append a JSON line with the stage timings of every job to this file')
+
+    args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
+
+    device = "cpu" if args.cpu or args.cpu_optimized else default_device()
+    cpu_profile = None
+    if args.cpu_optimized:
+        cpu_profile = CpuProfile(args.threads, args.interop_threads, compile_unet=args.compile,
+                                 compile_cache_dir=args.compile_cache)
+    pipe = load_model(args.model, device, cpu_profile)
+
+    server = ThreadingHTTPServer((args.host, args.port), WorkerRequestHandler)
+    server.worker = GenerationWorker(pipe, args.model, device, PromptEmbeddingCache(args.model))
+    print(f"Worker listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nWorker stopped.")
+
+if __name__ == "__main__":
+    main()
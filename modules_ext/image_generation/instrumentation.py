@@ -0,0 +1,188 @@
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from atomic import atomic_write
+
+# Histogram buckets in seconds, from a PIL conversion up to a slow CPU model load
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class StageMetrics:
+    """Histograms of seconds spent per stage, rendered in Prometheus text format.
+
+    Series are keyed by a stage name, or with several ``label_names`` by a
+    tuple of label values in the same order (the backend uses this for its
+    request and span histograms).
+    """
+
+    def __init__(self, name='generation_stage_seconds', help_text='Seconds spent in each stage of image generation',
+                 buckets=STAGE_BUCKETS, label_names=('stage',)):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label_names = label_names
+        self._stages = {}  # stage -> [per-bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            entry[0][index] += 1
+            entry[1] += seconds
+            entry[2] += 1
+
+    def take(self):
+        """Hand over everything observed so far and start from zero, e.g. to send it to another process."""
+        with self._lock:
+            stages, self._stages = self._stages, {}
+        return stages
+
+    def merge(self, stages):
+        """Add the observations returned by another instance's ``take()``."""
+        with self._lock:
+            for stage, (counts, total, count) in stages.items():
+                entry = self._stages.get(stage)
+                if entry is None:
+                    entry = self._stages[stage] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+                entry[2] += count
+
+    def summary(self):
+        """``{stage: {'count': n, 'seconds': total}}``, for printing at the end of a run."""
+        with self._lock:
+            return {stage: {'count': entry[2], 'seconds': entry[1]} for stage, entry in sorted(self._stages.items())}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for stage, (counts, total, count) in sorted(self._stages.items()):
+                values = stage if isinstance(stage, tuple) else (stage,)
+                label_text = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, values))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {total:.6f}')
+                lines.append(f'{self.name}_count{{{label_text}}} {count}')
+        return "\n".join(lines) + "\n"
+
+class TraceLog:
+    """Append-only JSONL file with one line per generated image (or batch)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+metrics = StageMetrics()
+_trace_log = None
+_current_trace = contextvars.ContextVar('generation_trace', default=None)
+
+def enable_trace_log(path):
+    """Write a JSON trace line for every image from now on."""
+    global _trace_log
+    _trace_log = TraceLog(path)
+    return _trace_log
+
+def record(stage, seconds):
+    """Count ``seconds`` against ``stage``, and against the image being traced in this context, if any."""
+    metrics.observe(stage, seconds)
+    entry = _current_trace.get()
+    if entry is not None:
+        totals = entry['stages'].setdefault(stage, {'count': 0, 'ms': 0.0})
+        totals['count'] += 1
+        totals['ms'] += seconds * 1000
+
+@contextlib.contextmanager
+def stage(name):
+    """Time the body of a ``with`` block as one occurrence of ``name``."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+def timed(name, func):
+    """Wrap ``func`` so that every call is timed as ``name``."""
+    def wrapper(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+@contextlib.contextmanager
+def trace(image, **fields):
+    """Collect the stages timed inside the block into one trace log line for ``image``.
+
+    Yields the entry, whose ``ok`` field the caller sets to False on
+    failure. Without a trace log this only does the bookkeeping.
+    """
+    entry = {'image': image, **fields, 'ok': True, 'stages': {}}
+    token = _current_trace.set(entry)
+    started = time.perf_counter()
+    try:
+        yield entry
+    finally:
+        _current_trace.reset(token)
+        if _trace_log is not None:
+            entry['time'] = round(time.time(), 3)
+            entry['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            for totals in entry['stages'].values():
+                totals['ms'] = round(totals['ms'], 2)
+            _trace_log.write(entry)
+
+def time_module(name, module):
+    """Time every forward call of a torch module, e.g. each UNet call of the denoising loop."""
+    starts = threading.local()
+
+    def before(*_):
+        starts.__dict__.setdefault('stack', []).append(time.perf_counter())
+
+    def after(*_):
+        record(name, time.perf_counter() - starts.stack.pop())
+
+    module.register_forward_pre_hook(before)
+    module.register_forward_hook(after)
+
+def instrument_pipeline(pipe):
+    """Time the stages inside a diffusers pipeline call: text encoding, each denoising step, VAE decode and PIL conversion."""
+    if getattr(pipe, '_instrumented', False):
+        return pipe
+    time_module('text_encode', pipe.text_encoder)
+    time_module('denoise_step', pipe.unet)
+    pipe.vae.decode = timed('vae_decode', pipe.vae.decode)
+    if hasattr(pipe, 'image_processor'):
+        pipe.image_processor.postprocess = timed('to_pil', pipe.image_processor.postprocess)
+    else:
+        pipe.numpy_to_pil = timed('to_pil', pipe.numpy_to_pil)
+    pipe._instrumented = True
+    return pipe
+
+def write_metrics(path):
+    """Write the metrics to ``path`` atomically, e.g. for node_exporter's textfile collector."""
+    with atomic_write(path, 'w', 'utf-8') as f:
+        f.write(metrics.render())
+
+def print_summary():
+    """Print where the time went, slowest stage first."""
+    summary = metrics.summary()
+    if not summary:
+        return
+    print("\nTime per stage:")
+    for name, totals in sorted(summary.items(), key=lambda item: -item[1]['seconds']):
+        mean_ms = totals['seconds'] / totals['count'] * 1000
+        print(f"  {name:<14} {totals['seconds']:9.2f}s total  {totals['count']:7d} calls  {mean_ms:9.1f}ms each")
@@ -0,0 +1,266 @@
+import os
+import glob
+import json
+import time
+import socket
+import argparse
+from collections import OrderedDict
+from manifest import ManifestRecord
+
+# Default configuration
+JOURNAL_FILENAME = '.journal.jsonl'  # Created inside the output directory
+DEFAULT_RETRY_FAILED = 1  # Extra attempts for an image that failed
+
+class JournalMismatch(Exception):
+    """Raised when ``--resume`` finds a journal written for a different input file."""
+
+def journal_filename(shard=None):
+    """The journal's name inside the output directory; each shard of a split run gets its own."""
+    if not shard:
+        return JOURNAL_FILENAME
+    return f".journal.shard-{shard[0]}-of-{shard[1]}.jsonl"
+
+class RunJournal:
+    """Append-only JSONL log of a batch run, so a crashed run can be resumed.
+
+    Each image gets a ``running`` event when work on it starts and a
+    ``done`` or ``failed`` event when it ends. Images finish out of order
+    when several run at once, so a ``checkpoint`` event records the
+    manifest offset up to which every image has finished; a resumed run
+    reads the manifest from there and redoes whatever was in progress.
+    Failed images keep their record and attempt count, so they can be
+    retried later in the same run or in a resumed one.
+
+    Lines are flushed as they are written, so a killed process loses at
+    most the line it was writing, which is ignored on resume.
+    """
+
+    def __init__(self, path, input_path, resume=False, shard=None):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.shard = f"{shard[0]}/{shard[1]}" if shard else None
+        self.checkpoint = 0
+        self.completed = 0
+        self.failed = {}  # filename -> {'record': dict, 'attempts': int, 'this_run': bool}
+        self._status = {}  # filename -> (event, offset) from earlier runs, past the checkpoint
+        self._outstanding = OrderedDict()  # manifest offset -> finished, in manifest order
+        self.previous_pids = set()  # Earlier runs of this journal on this host, whose temp files a resume may remove
+        resume = resume and os.path.exists(path)
+        if resume:
+            self._load()
+        self._last_offset = self.checkpoint
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        self._write('start', input=self.input_path, checkpoint=self.checkpoint, shard=self.shard,
+                    host=socket.gethostname(), pid=os.getpid())
+
+    def _load(self):
+        """Replay an existing journal; raises ``JournalMismatch``, leaving it untouched, if it belongs to another input."""
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue  # A line cut short by a crash
+                kind = event.get('event')
+                if kind == 'start' and event['input'] != self.input_path:
+                    raise JournalMismatch(f"journal {self.path} is for {event['input']}, not {self.input_path}; "
+                                          f"resume with that input, or run without --resume to start over")
+                if kind == 'start' and event.get('pid') and event.get('host') == socket.gethostname():
+                    self.previous_pids.add(event['pid'])
+                if kind == 'checkpoint':
+                    self.checkpoint = event['offset']
+                    self._status = {name: entry for name, entry in self._status.items() if entry[1] > self.checkpoint}
+                elif kind in ('running', 'done', 'failed'):
+                    self._status[event['filename']] = (kind, event['offset'])
+                    if kind == 'failed':
+                        self.failed[event['filename']] = {
+                            'record': event['record'], 'attempts': event['attempts'], 'this_run': False,
+                        }
+                    elif kind == 'done':
+                        self.failed.pop(event['filename'], None)
+
+    def _write(self, event, **fields):
+        self._file.write(json.dumps({'event': event, 'time': round(time.time(), 3), **fields}) + '\n')
+        self._file.flush()
+
+    def _track(self, record):
+        # Only first passes over the manifest move the checkpoint; retries come from behind it
+        if record.offset > self._last_offset:
+            self._outstanding[record.offset] = False
+            self._last_offset = record.offset
+
+    def status(self, filename):
+        """``'running'``, ``'done'`` or ``'failed'`` if an earlier run got that far with an image past the checkpoint."""
+        entry = self._status.get(filename)
+        return entry[0] if entry else None
+
+    def started(self, record):
+        """Note that work on ``record`` has begun."""
+        self._track(record)
+        self._write('running', filename=record.filename, offset=record.offset)
+
+    def finished(self, record, ok, error=None):
+        """Note how ``record`` ended. Skipped and cached images count as done."""
+        name = record.filename
+        if ok:
+            self.completed += 1
+            self.failed.pop(name, None)
+            self._write('done', filename=name, offset=record.offset)
+        else:
+            attempts = self.failed.get(name, {}).get('attempts', 0) + 1
+            self.failed[name] = {'record': record._asdict(), 'attempts': attempts, 'this_run': True}
+            self._write('failed', filename=name, offset=record.offset, attempts=attempts, error=error,
+                        record=record._asdict())
+
+        self._track(record)
+        if record.offset in self._outstanding:
+            self._outstanding[record.offset] = True
+        # Move the checkpoint past every leading image that has finished
+        checkpoint = self.checkpoint
+        while self._outstanding and next(iter(self._outstanding.values())):
+            checkpoint = self._outstanding.popitem(last=False)[0]
+        if checkpoint > self.checkpoint:
+            self.checkpoint = checkpoint
+            self._write('checkpoint', offset=checkpoint)
+
+    def retryable(self, max_attempts):
+        """Records of failed images with attempts left, from this run and earlier ones."""
+        return [ManifestRecord(**entry['record']) for entry in self.failed.values()
+                if entry['attempts'] < max_attempts]
+
+    @property
+    def failed_count(self):
+        """Images attempted in this run that are still failed."""
+        return sum(1 for entry in self.failed.values() if entry['this_run'])
+
+    def exhausted(self, max_attempts):
+        """Failed images that are out of attempts."""
+        return sum(1 for entry in self.failed.values() if entry['attempts'] >= max_attempts)
+
+    def close(self):
+        self._write('end', completed=self.completed, failed=self.failed_count, checkpoint=self.checkpoint)
+        self._file.close()
+
+def summarize(path):
+    """Replay a journal into where each of its images ended up, plus when and where it ran."""
+    summary = {'path': path, 'input': None, 'shard': None, 'host': None, 'runs': 0, 'started': None,
+               'ended': None, 'done': set(), 'failed': {}, 'running': set()}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue  # A line cut short by a crash
+            kind = event.get('event')
+            summary['started'] = summary['started'] or event.get('time')
+            summary['ended'] = event.get('time', summary['ended'])
+            if kind == 'start':
+                summary['runs'] += 1
+                for key in ('input', 'shard', 'host'):
+                    summary[key] = event.get(key)
+            elif kind == 'running':
+                summary['running'].add(event['filename'])
+            elif kind in ('done', 'failed'):
+                name = event['filename']
+                summary['running'].discard(name)
+                if kind == 'done':
+                    summary['done'].add(name)
+                    summary['failed'].pop(name, None)
+                else:
+                    summary['done'].discard(name)
+                    summary['failed'][name] = {'attempts': event['attempts'], 'error': event.get('error')}
+    return summary
+
+def merge_journals(paths):
+    """Combine the journals of the shards of one catalogue (or of any runs) into a single report."""
+    summaries = [summarize(path) for path in paths]
+    done_in = {}
+    for summary in summaries:
+        for name in summary['done']:
+            done_in.setdefault(name, []).append(summary['shard'] or summary['path'])
+
+    failed = {}
+    for summary in summaries:
+        for name, entry in summary['failed'].items():
+            if name not in done_in:
+                failed[name] = {'filename': name, **entry, 'shard': summary['shard']}
+    running = set().union(*(summary['running'] for summary in summaries)) - set(done_in) - set(failed)
+
+    # Shards a split run should have, but no journal was given for
+    shards = {}
+    for summary in summaries:
+        if summary['shard']:
+            index, count = map(int, summary['shard'].split('/'))
+            shards.setdefault(count, set()).add(index)
+    missing = [f"{index}/{count}" for count, seen in sorted(shards.items())
+               for index in range(1, count + 1) if index not in seen]
+
+    times = [t for summary in summaries for t in (summary['started'], summary['ended']) if t is not None]
+    seconds = max(times) - min(times) if times else 0
+    return {
+        'journals': [{
+            'path': summary['path'],
+            'input': summary['input'],
+            'shard': summary['shard'],
+            'host': summary['host'],
+            'runs': summary['runs'],
+            'done': len(summary['done']),
+            'failed': len(summary['failed']),
+            'in_progress': len(summary['running']),
+            'seconds': round((summary['ended'] or 0) - (summary['started'] or 0), 3),
+        } for summary in summaries],
+        'done': len(done_in),
+        'failed': sorted(failed.values(), key=lambda entry: entry['filename']),
+        'in_progress': len(running),
+        'duplicates': sorted(name for name, shards_done in done_in.items() if len(shards_done) > 1),
+        'missing_shards': missing,
+        'seconds': round(seconds, 3),
+        'images_per_second': round(len(done_in) / seconds, 3) if seconds else None,
+    }
+
+def find_journals(paths):
+    """Journal files among ``paths``; directories are searched for the journals of every shard."""
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += sorted(glob.glob(os.path.join(path, '.journal*.jsonl')))
+        else:
+            found.append(path)
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge run journals, e.g. one per shard, into one report')
+    parser.add_argument('paths', nargs='+', help='Journal files, or output directories to take every journal from')
+    parser.add_argument('--json', default=None, help='Also write the report to this file')
+
+    args = parser.parse_args()
+
+    paths = find_journals(args.paths)
+    if not paths:
+        print("No journals found.")
+        return
+    report = merge_journals(paths)
+    for entry in report['journals']:
+        where = f"Shard {entry['shard']}" if entry['shard'] else entry['path']
+        print(f"{where} on {entry['host']}: {entry['done']} done, {entry['failed']} failed, "
+              f"{entry['in_progress']} in progress ({entry['runs']} runs, {entry['seconds']:.0f}s)")
+
+    print(f"\nTotal: {report['done']} done, {len(report['failed'])} failed, {report['in_progress']} in progress")
+    if report['images_per_second']:
+        print(f"Throughput: {report['images_per_second']:.2f} images/s over {report['seconds']:.0f}s")
+    if report['missing_shards']:
+        print(f"✗ No journal for shards: {', '.join(report['missing_shards'])}")
+    if report['duplicates']:
+        print(f"✗ Done by more than one journal: {len(report['duplicates'])} images, e.g. {report['duplicates'][0]}")
+    for entry in report['failed']:
+        print(f"  ✗ {entry['filename']} ({entry['attempts']} attempts): {entry['error'] or 'see the generator log'}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json}")
+
+if __name__ == "__main__":
+    main()
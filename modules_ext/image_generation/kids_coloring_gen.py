@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""One entry point for every generator and tool: ``kids-coloring-gen <command> [options]``.
+
+Each command runs the ``main()`` of one script. Only that script is
+imported, and only once a command has been picked, so listing the
+commands costs no more than starting Python.
+"""
+import os
+import sys
+import importlib
+
+PROG = 'kids-coloring-gen'
+
+# command -> (module, description)
+COMMANDS = {
+    'replicate': ('generate_images', 'Generate images with Replicate'),
+    'ollama': ('generate_local', 'Generate images with a local Ollama model'),
+    'diffusers': ('generate_local_diffusers', 'Generate images with local Stable Diffusion (GPU or CPU)'),
+    'simple': ('simple_generate', 'Generate images with local Stable Diffusion, minimal options'),
+    'route': ('router', 'Spread image generation over Replicate, Ollama and local Stable Diffusion'),
+    'worker': ('generation_worker', 'Keep a Stable Diffusion model loaded and serve jobs over HTTP'),
+    'models': ('check_models', 'List the models Ollama has installed'),
+    'manifest': ('manifest', 'Check a description manifest and print its records'),
+    'report': ('journal', 'Merge run journals, e.g. one per shard, into one report'),
+    'lineart': ('lineart', 'Turn generated images into clean 1-bit line art'),
+    'regions': ('regions', 'Precompute the fillable regions of coloring pages'),
+    'benchmark': ('benchmark_generators', 'Benchmark every generator offline, with stubbed models and services'),
+    'benchmark-cpu': ('benchmark_cpu', 'Compare the default CPU path with the CPU-optimized profile'),
+    'check-startup': ('check_startup', 'Check that help and listing commands start within a time budget'),
+}
+
+def print_usage(file=sys.stdout):
+    print(f"usage: {PROG} <command> [options]\n", file=file)
+    print("Commands:", file=file)
+    for command, (_, description) in COMMANDS.items():
+        print(f"  {command:<15} {description}", file=file)
+    print(f"\nRun '{PROG} <command> --help' for the options of a command.", file=file)
+
+def run(command, args):
+    """Import the script behind ``command`` and run its ``main()`` with ``args`` as its command line."""
+    module = importlib.import_module(COMMANDS[command][0])
+    sys.argv = [f"{PROG} {command}"] + list(args)
+    module.main()
+
+def main():
+    # The scripts import each other as top-level modules
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+
+    args = sys.argv[1:]
+    if not args:
+        print_usage(sys.stderr)
+        sys.exit(2)
+    if args[0] in ('-h', '--help'):
+        print_usage()
+        return
+    if args[0] == 'help':
+        if len(args) == 1:
+            print_usage()
+            return
+        args = [args[1], '--help']
+
+    command = args[0]
+    if command not in COMMANDS:
+        print(f"{PROG}: unknown command '{command}'\n", file=sys.stderr)
+        print_usage(sys.stderr)
+        sys.exit(2)
+    run(command, args[1:])
+
+if __name__ == "__main__":
+    main()
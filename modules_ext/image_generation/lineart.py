@@ -0,0 +1,210 @@
+import os
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from atomic import atomic_write
+
+# Default configuration
+DEFAULT_BLOCK_SIZE = 31  # Side of the window the local mean is taken over, in pixels
+DEFAULT_OFFSET = 0.12  # A pixel is ink when it is this much darker than its local mean
+DEFAULT_DARK_LEVEL = 80  # Always ink at or below this grey level, so solid black stays solid
+DEFAULT_MIN_SPECK = 24  # Ink components smaller than this many pixels are removed
+DEFAULT_THICKNESS = 1  # Dilation radius for thickening lines; 0 leaves them as is
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+def to_grayscale(image):
+    """Return an image as a float32 array of grey levels in 0-255."""
+    return np.asarray(image.convert('L'), dtype=np.float32)
+
+def integral_image(gray):
+    """Summed-area table with a leading row and column of zeros."""
+    table = np.zeros((gray.shape[0] + 1, gray.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(gray, axis=0, dtype=np.float64), axis=1, out=table[1:, 1:])
+    return table
+
+def local_mean(gray, block_size=DEFAULT_BLOCK_SIZE):
+    """Mean of the ``block_size`` square around every pixel, via an integral image."""
+    radius = block_size // 2
+    padded = np.pad(gray, radius, mode='edge')
+    table = integral_image(padded)
+    h, w = gray.shape
+    size = 2 * radius + 1
+    sums = (table[size:size + h, size:size + w] - table[:h, size:size + w]
+            - table[size:size + h, :w] + table[:h, :w])
+    return (sums / (size * size)).astype(np.float32)
+
+def adaptive_threshold(gray, block_size=DEFAULT_BLOCK_SIZE, offset=DEFAULT_OFFSET, dark_level=DEFAULT_DARK_LEVEL):
+    """Return a boolean ink mask: pixels clearly darker than their surroundings, or simply dark."""
+    return (gray < local_mean(gray, block_size) * (1 - offset)) | (gray <= dark_level)
+
+def label_components(mask, connectivity=8):
+    """Label the connected ``True`` regions of a mask.
+
+    Returns ``(labels, count)``, where ``labels`` is an int32 array with 0
+    for background and 1..count for components, numbered in raster order
+    of their first pixel. Components are found by repeatedly hooking
+    neighbouring trees onto the smaller root and compressing paths, all
+    as whole-array operations, so there is no per-pixel Python loop.
+    """
+    h, w = mask.shape
+    flat = mask.ravel()
+    nodes = np.flatnonzero(flat)
+    if len(nodes) == 0:
+        return np.zeros((h, w), dtype=np.int32), 0
+    index = np.full(h * w, -1, dtype=np.int64)
+    index[nodes] = np.arange(len(nodes))
+    grid = index.reshape(h, w)
+
+    # Edges between neighbouring foreground pixels, as pairs of node numbers
+    offsets = [(0, 1), (1, 0)] + ([(1, 1), (1, -1)] if connectivity == 8 else [])
+    sources, targets = [], []
+    for dy, dx in offsets:
+        x0, x1 = max(0, -dx), w - max(0, dx)
+        a = grid[:h - dy, x0:x1]
+        b = grid[dy:, x0 + dx:x1 + dx]
+        linked = (a >= 0) & (b >= 0)
+        sources.append(a[linked])
+        targets.append(b[linked])
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+
+    parent = np.arange(len(nodes))
+    while True:
+        roots_a, roots_b = parent[sources], parent[targets]
+        differ = roots_a != roots_b
+        if not differ.any():
+            break
+        low = np.minimum(roots_a[differ], roots_b[differ])
+        high = np.maximum(roots_a[differ], roots_b[differ])
+        np.minimum.at(parent, high, low)
+        # Path compression until every node points straight at its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+    roots, numbered = np.unique(parent, return_inverse=True)
+    labels = np.zeros(h * w, dtype=np.int32)
+    labels[nodes] = numbered + 1
+    return labels.reshape(h, w), len(roots)
+
+def remove_specks(ink, min_size=DEFAULT_MIN_SPECK):
+    """Drop ink components smaller than ``min_size`` pixels."""
+    if min_size <= 1:
+        return ink
+    labels, count = label_components(ink)
+    areas = np.bincount(labels.ravel(), minlength=count + 1)
+    keep = areas >= min_size
+    keep[0] = False
+    return keep[labels]
+
+def thicken(ink, radius=DEFAULT_THICKNESS):
+    """Dilate the ink by a disc of ``radius`` pixels."""
+    if radius <= 0:
+        return ink
+    padded = np.pad(ink, radius)
+    h, w = ink.shape
+    result = np.zeros_like(ink)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dy * dy + dx * dx <= radius * radius:
+                result |= padded[radius + dy:radius + dy + h, radius + dx:radius + dx + w]
+    return result
+
+def to_line_art(image, block_size=DEFAULT_BLOCK_SIZE, offset=DEFAULT_OFFSET, dark_level=DEFAULT_DARK_LEVEL,
+                min_speck=DEFAULT_MIN_SPECK, thickness=DEFAULT_THICKNESS):
+    """Turn a generated image into a clean boolean ink mask (True = black line)."""
+    ink = adaptive_threshold(to_grayscale(image), block_size, offset, dark_level)
+    ink = remove_specks(ink, min_speck)
+    return thicken(ink, thickness)
+
+def save_line_art(ink, output_path):
+    """Write an ink mask as a 1-bit PNG (black lines on white), atomically."""
+    with atomic_write(output_path) as f:
+        Image.fromarray(~ink).save(f, format='PNG', optimize=True)
+
+def convert_file(input_path, output_path=None, **options):
+    """Clean up one image and save it as 1-bit PNG. Returns ``(input_bytes, output_bytes)``.
+
+    ``output_path`` defaults to the input with a ``.png`` extension. When
+    that is the input itself, the file is swapped atomically.
+    """
+    output_path = output_path or os.path.splitext(input_path)[0] + '.png'
+    input_bytes = os.path.getsize(input_path)
+    with Image.open(input_path) as image:
+        ink = to_line_art(image, **options)
+    save_line_art(ink, output_path)
+    return input_bytes, os.path.getsize(output_path)
+
+def _convert_job(job):
+    input_path, output_path, options = job
+    try:
+        return input_path, convert_file(input_path, output_path, **options), None
+    except Exception as e:
+        return input_path, None, str(e)
+
+def find_images(input_dir):
+    return sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS) and not name.startswith('.')
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Turn generated images into clean 1-bit line art')
+    parser.add_argument('input', help='Image file or directory of images')
+    parser.add_argument('--output', '-o', default=None,
+                      help='Output directory (default: a .png next to each image, replacing PNG inputs)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                      help='Processes to convert a directory with (default: CPU count)')
+    parser.add_argument('--block-size', type=int, default=DEFAULT_BLOCK_SIZE,
+                      help=f'Local threshold window in pixels (default: {DEFAULT_BLOCK_SIZE})')
+    parser.add_argument('--offset', type=float, default=DEFAULT_OFFSET,
+                      help=f'How much darker than the local mean counts as ink (default: {DEFAULT_OFFSET})')
+    parser.add_argument('--dark-level', type=int, default=DEFAULT_DARK_LEVEL,
+                      help=f'Grey level that always counts as ink (default: {DEFAULT_DARK_LEVEL})')
+    parser.add_argument('--min-speck', type=int, default=DEFAULT_MIN_SPECK,
+                      help=f'Smallest ink blob kept, in pixels (default: {DEFAULT_MIN_SPECK})')
+    parser.add_argument('--thickness', type=int, default=DEFAULT_THICKNESS,
+                      help=f'Line thickening radius in pixels (default: {DEFAULT_THICKNESS})')
+
+    args = parser.parse_args()
+
+    options = {
+        'block_size': args.block_size,
+        'offset': args.offset,
+        'dark_level': args.dark_level,
+        'min_speck': args.min_speck,
+        'thickness': args.thickness,
+    }
+    inputs = find_images(args.input) if os.path.isdir(args.input) else [args.input]
+    jobs = [
+        (path, os.path.join(args.output, os.path.splitext(os.path.basename(path))[0] + '.png') if args.output else None,
+         options)
+        for path in inputs
+    ]
+    if not jobs:
+        print("No images found.")
+        return
+
+    print(f"Converting {len(jobs)} images to line art")
+    total_in = total_out = failed = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(jobs))), mp_context=context) as executor:
+        for path, sizes, error in executor.map(_convert_job, jobs):
+            if error:
+                print(f"✗ Error converting {os.path.basename(path)}: {error}")
+                failed += 1
+                continue
+            total_in += sizes[0]
+            total_out += sizes[1]
+            print(f"✓ {os.path.basename(path)}: {sizes[0] // 1024} KB -> {sizes[1] // 1024} KB")
+
+    print(f"\nConverted {len(jobs) - failed}/{len(jobs)} images")
+    if total_out:
+        print(f"Total size: {total_in // 1024} KB -> {total_out // 1024} KB ({total_in / total_out:.1f}x smaller)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+import json
+import hashlib
+import argparse
+from collections import namedtuple
+
+# One image to generate. ``width``, ``height``, ``seed``, ``steps`` and ``model``
+# are None unless the line overrides them. ``offset`` is the byte offset just
+# past the record's line: pass it as ``start_offset`` to carry on after it.
+ManifestRecord = namedtuple('ManifestRecord', [
+    'filename', 'description', 'width', 'height', 'seed', 'steps', 'model', 'line', 'offset',
+])
+
+OVERRIDE_KEYS = ('size', 'width', 'height', 'seed', 'steps', 'model')
+
+def parse_size(value):
+    """Read a size given as ``"800x1000"``, ``[800, 1000]`` or ``{"width": 800, "height": 1000}``."""
+    if isinstance(value, str):
+        width, sep, height = value.lower().partition('x')
+        if not sep:
+            raise ValueError(f"size must look like 800x1000, got {value!r}")
+        return int(width), int(height)
+    if isinstance(value, dict):
+        return int(value['width']), int(value['height'])
+    width, height = value
+    return int(width), int(height)
+
+def parse_json_line(text):
+    """Turn one JSONL object into ``(filename, description, overrides)``.
+
+    ``prompt`` is accepted for ``description``, ``file`` for ``filename``.
+    """
+    item = json.loads(text)
+    if not isinstance(item, dict):
+        raise ValueError("expected a JSON object")
+    filename = item.get('filename', item.get('file'))
+    description = item.get('description', item.get('prompt'))
+    if not description:
+        raise ValueError("missing description")
+
+    overrides = {}
+    if item.get('size') is not None:
+        overrides['width'], overrides['height'] = parse_size(item['size'])
+    for key in ('width', 'height', 'seed', 'steps'):
+        if item.get(key) is not None:
+            overrides[key] = int(item[key])
+    if item.get('model'):
+        overrides['model'] = str(item['model'])
+    if ('width' in overrides) != ('height' in overrides):
+        raise ValueError("width and height must be given together")
+    return filename, str(description), overrides
+
+def parse_line(text):
+    """Parse a stripped, non-comment line in either format; the filename may be None."""
+    if text.startswith('{'):
+        return parse_json_line(text)
+    if '|' in text:
+        filename, description = text.split('|', 1)
+        return filename.strip(), description.strip(), {}
+    return None, text, {}
+
+def parse_shard(value):
+    """Read a shard given as ``"i/n"`` (the i-th of n, counting from 1) into ``(i, n)``."""
+    index, sep, count = str(value).partition('/')
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not sep or not 1 <= index <= count:
+        raise ValueError(f"shard must look like 2/4, got {value!r}")
+    return index, count
+
+def in_shard(filename, shard):
+    """True if ``filename`` belongs to ``shard``, an ``(i, n)`` pair.
+
+    The split depends only on the filename, so every machine given the
+    same manifest and ``n`` agrees on it, whatever order the lines are in.
+    """
+    index, count = shard
+    digest = hashlib.sha1(filename.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count == index - 1
+
+def _seek_line_start(f, offset):
+    """Seek to ``offset``, or to the start of the next line if it points inside one."""
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    if f.read(1) != b'\n':
+        f.readline()
+    return f.tell()
+
+def _is_entry(text):
+    return bool(text) and not text.startswith('#')
+
+def _line_text(raw, errors='strict'):
+    return raw.decode('utf-8', errors).lstrip('\ufeff').strip()
+
+def _count_entries_before(f, end):
+    """Count the entry lines in the first ``end`` bytes of ``f``, leaving it at ``end``."""
+    f.seek(0)
+    count = 0
+    while f.tell() < end:
+        if _is_entry(_line_text(f.readline(), 'replace')):
+            count += 1
+    return count
+
+def read_manifest(path, start_offset=0, default_name=None, shard=None, report=print):
+    """Yield a ``ManifestRecord`` for every image in a description file.
+
+    Lines are either ``filename|description`` or JSON objects with
+    ``filename``, ``description`` and optional ``size`` (or ``width`` and
+    ``height``), ``seed``, ``steps`` and ``model``; both can be mixed in one
+    file. Blank lines and ``#`` comments are ignored. Lines without a
+    filename get ``default_name.format(index=n)`` for the n-th entry of
+    the whole file, so names stay the same after a resume, or are skipped
+    when ``default_name`` is None. With ``shard``, an ``(i, n)``
+    pair, only the records ``in_shard`` of it are yielded.
+
+    The file is read one line at a time from ``start_offset``, so the
+    only state that grows with it is a 64-bit hash of each filename
+    (under 10 MB for 100k lines): a repeated filename is reported and
+    skipped rather than overwriting the earlier image. Problems are
+    reported by line number, or by byte offset after a resume, through
+    ``report``; lines that are not valid UTF-8 are skipped like bad JSON.
+    """
+    seen = set()
+    index = 0
+    with open(path, 'rb') as f:
+        offset = _seek_line_start(f, start_offset)
+        if default_name is not None and offset > 0:
+            index = _count_entries_before(f, offset)
+        for line_number, raw in enumerate(f, 1):
+            where = f"{path}:{line_number}" if start_offset <= 0 else f"{path} at byte {offset}"
+            offset += len(raw)
+            try:
+                text = _line_text(raw)
+            except UnicodeDecodeError as e:
+                index += 1
+                report(f"✗ {where}: not valid UTF-8 ({e.reason} at column {e.start + 1}), skipping")
+                continue
+            if not _is_entry(text):
+                continue
+            index += 1
+            try:
+                filename, description, overrides = parse_line(text)
+            except (ValueError, KeyError, TypeError) as e:
+                report(f"✗ {where}: {e}, skipping")
+                continue
+            if not filename:
+                if default_name is None:
+                    report(f"✗ {where}: no filename, skipping")
+                    continue
+                filename = default_name.format(index=index)
+            if shard and not in_shard(filename, shard):
+                continue
+
+            digest = int.from_bytes(hashlib.blake2b(filename.encode('utf-8'), digest_size=8).digest(), 'little')
+            if digest in seen:
+                report(f"✗ {where}: duplicate filename {filename}, skipping")
+                continue
+            seen.add(digest)
+
+            yield ManifestRecord(
+                filename, description,
+                overrides.get('width'), overrides.get('height'),
+                overrides.get('seed'), overrides.get('steps'), overrides.get('model'),
+                line_number, offset,
+            )
+
+def count_entries(path, start_offset=0, shard=None, default_name=None):
+    """Count the records ``read_manifest`` yields with the same arguments, for progress totals.
+
+    This reads the file once more with the same parsing, naming, shard
+    and duplicate rules, without reporting the problems it skips.
+    """
+    return sum(1 for _ in read_manifest(path, start_offset, default_name, shard, report=lambda message: None))
+
+def main():
+    parser = argparse.ArgumentParser(description='Check a description manifest and print its records')
+    parser.add_argument('input', help='Description file (filename|description lines and/or JSONL)')
+    parser.add_argument('--start-offset', type=int, default=0, help='Byte offset to start reading at (default: 0)')
+    parser.add_argument('--shard', type=parse_shard, default=None, help='Only print the records of shard i/n, e.g. 2/4')
+
+    args = parser.parse_args()
+
+    count = 0
+    for record in read_manifest(args.input, args.start_offset, shard=args.shard):
+        overrides = {key: value for key, value in record._asdict().items()
+                     if key in OVERRIDE_KEYS and value is not None}
+        print(f"{record.offset:>10}  {record.filename}  {overrides or ''}")
+        count += 1
+    print(f"\n{count} records")
+
+if __name__ == "__main__":
+    main()
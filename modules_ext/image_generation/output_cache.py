@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from atomic import link_or_copy
+
+# Default configuration
+DEFAULT_CACHE_DIRNAME = '.cache'  # Created inside the output directory
+
+def cache_key(backend, model, prompt, style, negative_prompt, width, height, steps, guidance, seed=None):
+    """Hash every setting that affects the generated image."""
+    fields = {
+        'backend': backend,
+        'model': model,
+        'prompt': prompt,
+        'style': style,
+        'negative_prompt': negative_prompt,
+        'width': width,
+        'height': height,
+        'steps': steps,
+        'guidance': guidance,
+        'seed': seed,
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+class OutputCache:
+    """Content-addressed cache of generated images.
+
+    Every finished image is hardlinked into ``<output_dir>/.cache/objects``
+    under the hash of its generation settings, and recorded in a SQLite
+    manifest. Before generating, a script asks the cache for the same
+    settings; on a hit the stored object is linked (or copied) to the
+    requested filename and no work is done.
+    """
+
+    def __init__(self, output_dir, cache_dirname=DEFAULT_CACHE_DIRNAME):
+        self.root = os.path.join(output_dir, cache_dirname)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        os.makedirs(self.objects_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(self.root, 'manifest.sqlite'), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT PRIMARY KEY, object TEXT NOT NULL, filename TEXT, prompt TEXT, created_at REAL)"
+        )
+        self._db.commit()
+
+    def _entry_key(self, key, output_path):
+        # The file format is part of the output, so .png and .jpg are cached separately
+        return key + os.path.splitext(output_path)[1].lower()
+
+    def fetch(self, key, output_path):
+        """Materialize a cached image at ``output_path``. Returns True on a hit."""
+        entry_key = self._entry_key(key, output_path)
+        with self._lock:
+            row = self._db.execute("SELECT object FROM outputs WHERE key = ?", (entry_key,)).fetchone()
+
+        object_path = os.path.join(self.objects_dir, row[0]) if row else None
+        if object_path is None or not os.path.exists(object_path):
+            self.misses += 1
+            # A file shared with the store must not be overwritten in place
+            if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+                os.unlink(output_path)
+            return False
+
+        self.hits += 1
+        if not (os.path.exists(output_path) and os.path.samefile(object_path, output_path)):
+            link_or_copy(object_path, output_path)
+        return True
+
+    def store(self, key, output_path, prompt=None):
+        """Add a freshly generated image to the cache."""
+        entry_key = self._entry_key(key, output_path)
+        link_or_copy(output_path, os.path.join(self.objects_dir, entry_key))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO outputs (key, object, filename, prompt, created_at) VALUES (?, ?, ?, ?, ?)",
+                (entry_key, entry_key, os.path.basename(output_path), prompt, time.time()),
+            )
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
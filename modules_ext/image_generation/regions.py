@@ -0,0 +1,121 @@
+import os
+import gzip
+import struct
+import argparse
+import numpy as np
+from PIL import Image
+from atomic import atomic_write
+from derivatives import DERIVATIVES_DIRNAME, file_hash
+from lineart import label_components, to_line_art
+
+# Default configuration
+DEFAULT_MIN_REGION = 16  # Fillable areas smaller than this many pixels are treated as line
+MAGIC = b'RGN1'
+MAX_REGIONS = 65535  # Labels are stored as uint16; 0 means "line, not fillable"
+
+# Per-region record: pixel count and inclusive bounding box
+REGION_DTYPE = np.dtype([('area', '<u4'), ('x0', '<u2'), ('y0', '<u2'), ('x1', '<u2'), ('y1', '<u2')])
+
+def ink_mask(image):
+    """Line pixels of an image; 1-bit line art is read as is, anything else is cleaned first."""
+    if image.mode == '1':
+        return ~np.asarray(image, dtype=bool)
+    return to_line_art(image)
+
+def find_regions(ink, min_region=DEFAULT_MIN_REGION):
+    """Split the non-line area into fillable regions.
+
+    Returns ``(labels, table)``: a uint16 label per pixel (0 for line and
+    for regions below ``min_region``), and a ``REGION_DTYPE`` record per
+    region, where record ``i`` describes label ``i + 1``. Regions are
+    4-connected, so a fill never leaks through a diagonal gap in a line.
+    If there are more than ``MAX_REGIONS``, the smallest are dropped.
+    """
+    labels, count = label_components(~ink, connectivity=4)
+    areas = np.bincount(labels.ravel(), minlength=count + 1)
+    keep = areas >= min_region
+    keep[0] = False
+    if keep.sum() > MAX_REGIONS:
+        keep[np.argsort(areas)[:-MAX_REGIONS]] = False
+    # Renumber the kept regions 1..n in their original order
+    renumber = np.zeros(count + 1, dtype=np.uint16)
+    renumber[keep] = np.arange(1, keep.sum() + 1)
+    labels = renumber[labels]
+
+    n = int(keep.sum())
+    h, w = labels.shape
+    flat = labels.ravel()
+    filled = flat > 0
+    region = flat[filled].astype(np.int64) - 1
+    ys, xs = np.divmod(np.flatnonzero(filled), w)
+    table = np.zeros(n, dtype=REGION_DTYPE)
+    table['area'] = np.bincount(region, minlength=n)
+    for field, values, reduce, start in [('x0', xs, np.minimum, w), ('y0', ys, np.minimum, h),
+                                         ('x1', xs, np.maximum, 0), ('y1', ys, np.maximum, 0)]:
+        bound = np.full(n, start, dtype=np.int64)
+        reduce.at(bound, region, values)
+        table[field] = bound
+    return labels, table
+
+def encode_regions(labels, table):
+    """Serialize a region map as gzip-compressed bytes.
+
+    Layout before compression, all little-endian:
+
+    - ``RGN1`` magic, then uint32 width, height and region count
+    - one 12-byte record per region: uint32 area, uint16 x0, y0, x1, y1
+    - the label of every pixel as uint16, row by row
+
+    Served with ``Content-Encoding: gzip``, a browser hands the client
+    the raw layout, so a tap becomes ``labels[y * width + x]``.
+    """
+    h, w = labels.shape
+    raw = (struct.pack('<4sIII', MAGIC, w, h, len(table))
+           + table.tobytes() + labels.astype('<u2').tobytes())
+    return gzip.compress(raw, compresslevel=6, mtime=0)
+
+def decode_regions(data):
+    """Inverse of ``encode_regions``; returns ``(labels, table)``."""
+    raw = gzip.decompress(data)
+    magic, w, h, count = struct.unpack_from('<4sIII', raw)
+    if magic != MAGIC:
+        raise ValueError("Not a region map")
+    offset = struct.calcsize('<4sIII')
+    table = np.frombuffer(raw, dtype=REGION_DTYPE, count=count, offset=offset)
+    offset += table.nbytes
+    labels = np.frombuffer(raw, dtype='<u2', count=w * h, offset=offset).reshape(h, w)
+    return labels, table
+
+def regions_path(image_path, content_hash=None):
+    """Where the region map of an image lives, next to its thumbnails."""
+    content_hash = content_hash or file_hash(image_path)
+    return os.path.join(os.path.dirname(os.path.abspath(image_path)), DERIVATIVES_DIRNAME,
+                        f"{content_hash}.regions.gz")
+
+def write_regions(image_path, content_hash=None, min_region=DEFAULT_MIN_REGION):
+    """Compute and store the region map of an image unless it exists; returns its path."""
+    path = regions_path(image_path, content_hash)
+    if os.path.exists(path):
+        return path
+    with Image.open(image_path) as image:
+        labels, table = find_regions(ink_mask(image), min_region)
+    with atomic_write(path) as f:
+        f.write(encode_regions(labels, table))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the fillable regions of coloring pages')
+    parser.add_argument('images', nargs='+', help='Image files')
+    parser.add_argument('--min-region', type=int, default=DEFAULT_MIN_REGION,
+                      help=f'Smallest fillable area in pixels (default: {DEFAULT_MIN_REGION})')
+
+    args = parser.parse_args()
+
+    for image_path in args.images:
+        path = write_regions(image_path, min_region=args.min_region)
+        with open(path, 'rb') as f:
+            labels, table = decode_regions(f.read())
+        print(f"✓ {os.path.basename(image_path)}: {len(table)} regions, {os.path.getsize(path) // 1024} KB -> {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+import derivatives
+import instrumentation
+from backends import BACKENDS, GenerationJob
+from output_cache import OutputCache
+from atomic import remove_temp_files, attempt_path, link_or_copy
+from manifest import read_manifest, count_entries
+from journal import RunJournal, JOURNAL_FILENAME, DEFAULT_RETRY_FAILED, JournalMismatch
+from generate_local_diffusers import get_dimensions, DEFAULT_STEPS
+from generation_worker import DEFAULT_WORKER_URL
+from cpu_inference import CpuProfile
+
+# Default configuration
+DEFAULT_INPUT_FILE = 'img_desc.txt'
+DEFAULT_OUTPUT_DIR = 'generated_images'
+DEFAULT_TIMEOUT = 600  # Seconds an image may take before it is handed to another backend
+DEFAULT_COOLDOWN = 30  # Seconds a backend is left alone after failing several times in a row
+FAILURES_BEFORE_COOLDOWN = 3
+LATENCY_SMOOTHING = 0.3  # Weight of the newest timing in a backend's latency estimate
+
+class BackendLoad:
+    """The router's view of one backend: its threads, jobs in flight, latency estimate and health."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers=backend.max_in_flight, thread_name_prefix=backend.name)
+        self.opening = self.executor.submit(backend.open)  # Loading a model must not hold up the others
+        self.ready = False
+        self.disabled = False
+        self.in_flight = 0
+        self.latency = backend.expected_seconds
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.cooling_until = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def usable(self, now):
+        return self.ready and not self.disabled and now >= self.cooling_until
+
+    def estimate(self, queued):
+        """Seconds until a new job would finish here, with ``queued`` jobs ahead of it."""
+        return (queued // self.backend.max_in_flight + 1) * self.latency
+
+    def observe(self, seconds):
+        # The first timing replaces the guess outright
+        self.latency += (LATENCY_SMOOTHING if self.samples else 1) * (seconds - self.latency)
+        self.samples += 1
+
+def _run(backend, job):
+    started = time.perf_counter()
+    try:
+        ok = backend.generate(job)
+    except Exception as e:
+        print(f"✗ {backend.name} failed on {os.path.basename(job.output_path)}: {str(e) or type(e).__name__}")
+        ok = False
+    return ok, time.perf_counter() - started
+
+class Router:
+    """Run each job on the backend expected to finish it soonest, moving it to another one if that fails.
+
+    The estimate for a backend is its smoothed seconds per image times the
+    rounds of work queued ahead of the job, so a fast backend with a short
+    wait beats a slow idle one. A backend without timings yet gets one job
+    as soon as it is ready, to measure it. No backend runs more than its
+    ``max_in_flight`` jobs; the rest wait here. A job that fails or runs
+    past ``timeout`` is retried on a backend it has not tried yet, and a
+    backend that fails several times in a row is left alone for
+    ``cooldown`` seconds. A timed-out call cannot be stopped, so it keeps
+    its slot until it returns, and its result is ignored.
+
+    Every attempt writes to its own ``attempt_path`` next to the output,
+    and only the attempt the router accepts is linked into place, so a
+    timed-out call that finishes late cannot overwrite the retried image.
+    The attempt files stay until ``close()``, for derivative jobs that
+    may still be reading them.
+
+    Not thread-safe: call ``submit`` and ``step`` from one thread.
+    """
+
+    def __init__(self, backends, timeout=DEFAULT_TIMEOUT, cooldown=DEFAULT_COOLDOWN):
+        self.loads = [BackendLoad(backend) for backend in backends]
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self._pending = []  # [job, tag, names of backends tried], oldest first
+        self._running = {}  # future -> (load, pending entry, started, attempt path)
+        self._abandoned = {}  # future -> load, for timed-out calls still holding a slot
+        self._finished = []
+        self._attempts = []  # Paths the backends were asked to write to, removed on close
+
+    @property
+    def capacity(self):
+        """Jobs that can run at once across the backends still in use."""
+        return sum(load.backend.max_in_flight for load in self.loads if not load.disabled)
+
+    def busy(self):
+        """Jobs submitted whose result ``step`` has not returned yet."""
+        return len(self._pending) + len(self._running) + len(self._finished)
+
+    def submit(self, job, tag=None):
+        """Queue ``job``; ``tag`` comes back with its result."""
+        self._pending.append([job, tag, set()])
+        self._dispatch()
+
+    def step(self):
+        """Wait until at least one job ends; returns ``(job, tag, backend name or None, ok)`` for each."""
+        while not self._finished and (self._pending or self._running):
+            futures = set(self._running) | set(self._abandoned)
+            futures |= {load.opening for load in self.loads if not load.ready and not load.disabled}
+            timeout = self._next_deadline()
+            if futures:
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                self._collect(done)
+            else:
+                time.sleep(timeout or 0)
+            self._expire()
+            self._dispatch()
+        finished, self._finished = self._finished, []
+        return finished
+
+    def _dispatch(self):
+        now = time.monotonic()
+        queued = {load: load.in_flight for load in self.loads}
+        for entry in list(self._pending):
+            job, tag, tried = entry
+            candidates = [load for load in self.loads if not load.disabled and load.backend.name not in tried]
+            if not candidates:
+                self._pending.remove(entry)
+                self._finished.append((job, tag, None, False))
+                continue
+            usable = [load for load in candidates if load.usable(now)]
+            if not usable:
+                continue  # Wait for a backend to finish loading or cooling down
+            unmeasured = [load for load in usable if not load.samples and not queued[load]]
+            best = unmeasured[0] if unmeasured else min(usable, key=lambda load: load.estimate(queued[load]))
+            queued[best] += 1
+            if best.in_flight < best.backend.max_in_flight:
+                self._pending.remove(entry)
+                best.in_flight += 1
+                attempt = job._replace(output_path=attempt_path(job.output_path, len(self._attempts)))
+                self._attempts.append(attempt.output_path)
+                future = best.executor.submit(_run, best.backend, attempt)
+                self._running[future] = (best, entry, now, attempt.output_path)
+
+    def _collect(self, done):
+        for load in self.loads:
+            if load.opening in done:
+                try:
+                    load.opening.result()
+                    load.ready = True
+                    print(f"✓ {load.backend.name} ready")
+                except Exception as e:
+                    load.disabled = True
+                    print(f"✗ {load.backend.name} unavailable: {str(e) or type(e).__name__}")
+        for future in done:
+            if future in self._abandoned:
+                load = self._abandoned.pop(future)
+                load.in_flight -= 1
+                ok, seconds = future.result()
+                if ok:
+                    load.observe(seconds)
+            elif future in self._running:
+                load, entry, _, output_path = self._running.pop(future)
+                load.in_flight -= 1
+                ok, seconds = future.result()
+                if ok:
+                    link_or_copy(output_path, entry[0].output_path)
+                    load.completed += 1
+                    load.consecutive_failures = 0
+                    load.observe(seconds)
+                    self._finished.append((entry[0], entry[1], load.backend.name, True))
+                else:
+                    load.failed += 1
+                    self._fail(load, entry)
+
+    def _expire(self):
+        now = time.monotonic()
+        for future, (load, entry, started, _) in list(self._running.items()):
+            if now - started > self.timeout:
+                del self._running[future]
+                self._abandoned[future] = load
+                load.timed_out += 1
+                load.observe(now - started)
+                print(f"✗ {load.backend.name} timed out on {os.path.basename(entry[0].output_path)}")
+                self._fail(load, entry)
+
+    def _fail(self, load, entry):
+        load.consecutive_failures += 1
+        if load.consecutive_failures >= FAILURES_BEFORE_COOLDOWN:
+            load.consecutive_failures = 0
+            load.cooling_until = time.monotonic() + self.cooldown
+            print(f"{load.backend.name} failed {FAILURES_BEFORE_COOLDOWN} times in a row, "
+                  f"pausing it for {self.cooldown}s")
+        entry[2].add(load.backend.name)
+        self._pending.insert(0, entry)  # Ahead of new work
+
+    def _next_deadline(self):
+        """Seconds until a running job times out or a backend comes back from a cooldown."""
+        now = time.monotonic()
+        deadlines = [started + self.timeout for _, _, started, _ in self._running.values()]
+        deadlines += [load.cooling_until for load in self.loads if load.cooling_until > now and not load.disabled]
+        return max(0, min(deadlines) - now) if deadlines else None
+
+    def close(self):
+        for load in self.loads:
+            load.executor.shutdown(wait=not self._abandoned, cancel_futures=True)
+            load.backend.close()
+        # A call still running past its timeout may write its file later; a --resume run removes it
+        for path in self._attempts:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def print_summary(self):
+        print("\nImages per backend:")
+        for load in self.loads:
+            state = 'unavailable' if load.disabled else f"{load.latency:7.1f}s per image"
+            print(f"  {load.backend.name:<10} {load.completed:6d} done  {load.failed:4d} failed  "
+                  f"{load.timed_out:4d} timed out  {state}")
+
+def create_backends(args):
+    """The backends named in ``--backends``, in that order, configured from the command line."""
+    backends = []
+    for name in args.backends:
+        if name == 'replicate':
+            backends.append(BACKENDS[name](max_in_flight=args.replicate_concurrency))
+        elif name == 'ollama':
+            backends.append(BACKENDS[name](args.ollama_model, max_in_flight=args.ollama_parallel))
+        else:
+            cpu_profile = None
+            if args.cpu_optimized:
+                cpu_profile = CpuProfile()
+            device = 'cpu' if args.cpu or args.cpu_optimized else None
+            backends.append(BACKENDS[name](args.diffusers_model, device=device, cpu_profile=cpu_profile,
+                                           worker_url=args.worker_url, use_worker=not args.no_worker))
+    return backends
+
+def main():
+    parser = argparse.ArgumentParser(description='Spread image generation over Replicate, Ollama and local Stable Diffusion')
+    parser.add_argument('--input', '-i', default=DEFAULT_INPUT_FILE,
+                      help=f'Input file with image descriptions (default: {DEFAULT_INPUT_FILE})')
+    parser.add_argument('--output', '-o', default=DEFAULT_OUTPUT_DIR,
+                      help=f'Output directory for generated images (default: {DEFAULT_OUTPUT_DIR})')
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS),
+                      help='Backends to use (default: all that are available)')
+    parser.add_argument('--width', type=int, default=512, help='Image width (default: 512)')
+    parser.add_argument('--height', type=int, default=512, help='Image height (default: 512)')
+    parser.add_argument('--replicate-concurrency', type=int, default=4,
+                      help='Replicate predictions to run at the same time (default: 4)')
+    parser.add_argument('--ollama-model', default=BACKENDS['ollama'].script.DEFAULT_MODEL,
+                      help=f"Ollama model to use (default: {BACKENDS['ollama'].script.DEFAULT_MODEL})")
+    parser.add_argument('--ollama-parallel', type=int, default=BACKENDS['ollama'].script.DEFAULT_PARALLEL,
+                      help=f"Ollama requests to keep in flight (default: {BACKENDS['ollama'].script.DEFAULT_PARALLEL})")
+    parser.add_argument('--diffusers-model', default=BACKENDS['diffusers'].script.DEFAULT_MODEL,
+                      help=f"Stable Diffusion model to use (default: {BACKENDS['diffusers'].script.DEFAULT_MODEL})")
+    parser.add_argument('--cpu', action='store_true', help='Run Stable Diffusion on the CPU')
+    parser.add_argument('--cpu-optimized', action='store_true',
+                      help='Run Stable Diffusion on the CPU with the CPU-optimized profile')
+    parser.add_argument('--worker-url', default=DEFAULT_WORKER_URL,
+                      help=f'Resident worker to send Stable Diffusion jobs to when one is running (default: {DEFAULT_WORKER_URL})')
+    parser.add_argument('--no-worker', action='store_true', help='Always load the Stable Diffusion model in this process')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                      help=f'Seconds an image may take before it moves to another backend (default: {DEFAULT_TIMEOUT})')
+    parser.add_argument('--cooldown', type=float, default=DEFAULT_COOLDOWN,
+                      help=f'Seconds to rest a backend after {FAILURES_BEFORE_COOLDOWN} failures in a row (default: {DEFAULT_COOLDOWN})')
+    parser.add_argument('--skip-existing', action='store_true', help='Skip existing files')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the output cache and regenerate everything')
+    parser.add_argument('--derivatives', action='store_true',
+                      help='Also write WebP/AVIF thumbnails and an LQIP placeholder after each save')
+    parser.add_argument('--derivative-workers', type=int, default=None,
+                      help='Processes for --derivatives (default: CPU count)')
+    parser.add_argument('--start-offset', type=int, default=0,
+                      help='Byte offset in the input file to start reading at (default: 0)')
+    parser.add_argument('--resume', action='store_true',
+                      help='Carry on where the last run in the output directory stopped, using its journal')
+    parser.add_argument('--retry-failed', type=int, default=DEFAULT_RETRY_FAILED,
+                      help=f'Extra attempts for images that fail on every backend (default: {DEFAULT_RETRY_FAILED})')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write per-stage timings here in Prometheus text format when the run ends')
+    parser.add_argument('--trace-log', default=None,
+                      help='Append a JSON line with the stage timings of every image to this file')
+
+    args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
+
+    # Count the work up front; the descriptions themselves are streamed
+    print(f"Reading image descriptions from: {args.input}")
+    if not os.path.exists(args.input):
+        print(f"Error: Input file '{args.input}' not found.")
+        return
+    try:
+        journal = RunJournal(os.path.join(args.output, JOURNAL_FILENAME), args.input, resume=args.resume)
+    except JournalMismatch as e:
+        print(f"Error: {e}")
+        return
+    start_offset = args.start_offset or journal.checkpoint
+    if args.resume:
+        remove_temp_files(args.output, journal.previous_pids)
+        print(f"Resuming at byte {start_offset} with {len(journal.failed)} failed images from earlier runs")
+    total = count_entries(args.input, start_offset)
+
+    if not total and not journal.failed:
+        print("No valid image descriptions found.")
+        journal.close()
+        return
+
+    print(f"Found {total} images to generate")
+    print(f"Output directory: {args.output}")
+    print(f"Backends: {', '.join(args.backends)} (per-line models are ignored; each backend uses its own)")
+    print("="*50 + "\n")
+
+    cache = None if args.no_cache else OutputCache(args.output)
+    if args.derivatives:
+        derivatives.enable(args.derivative_workers)
+
+    backends = create_backends(args)
+    backends_by_name = {backend.name: backend for backend in backends}
+    router = Router(backends, args.timeout, args.cooldown)
+    success_count = 0
+
+    def collect(results):
+        nonlocal success_count
+        for job, record, backend_name, ok in results:
+            if ok:
+                success_count += 1
+                if cache:
+                    cache.store(backends_by_name[backend_name].cache_key(job), job.output_path, record.description)
+            journal.finished(record, ok, error=None if ok else 'failed on every backend')
+            progress.update(1)
+
+    def submit(record):
+        nonlocal success_count
+        filename, description = record.filename, record.description
+        output_path = os.path.join(args.output, filename)
+
+        # Skip if an earlier run finished the file, or it exists and --skip-existing is set
+        previous = journal.status(filename)
+        if os.path.exists(output_path) and (previous == 'done' or (args.skip_existing and previous != 'running')):
+            print(f"Skipping existing: {filename}")
+            success_count += 1
+            journal.finished(record, True)
+            progress.update(1)
+            return
+
+        # Determine dimensions: per-line size first, then the filename
+        if record.width:
+            width, height = (record.width, record.height)
+        else:
+            width, height = get_dimensions(filename, args.width, args.height)
+        job = GenerationJob(description, output_path, width, height, record.steps or DEFAULT_STEPS, record.seed)
+
+        # Reuse what any of the backends made earlier with the exact same settings
+        if cache and any(cache.fetch(backend.cache_key(job), output_path) for backend in backends):
+            print(f"Cached: {filename}")
+            success_count += 1
+            journal.finished(record, True)
+            progress.update(1)
+            return
+
+        # Keep a couple of jobs per slot queued, so memory stays flat however long the input is
+        while router.busy() >= 2 * max(1, router.capacity):
+            collect(router.step())
+        journal.started(record)
+        router.submit(job, record)
+
+    def drain():
+        while router.busy():
+            collect(router.step())
+
+    max_attempts = 1 + args.retry_failed
+    with tqdm(total=total, desc="Generating images") as progress:
+        for record in read_manifest(args.input, start_offset):
+            submit(record)
+        drain()
+
+        # Give failed images, including ones left over from earlier runs, a bounded number of retries
+        for _ in range(args.retry_failed):
+            retries = journal.retryable(max_attempts)
+            if not retries:
+                break
+            print(f"\nRetrying {len(retries)} failed images")
+            progress.total += len(retries)
+            for record in retries:
+                submit(record)
+            drain()
+    derivative_counts = derivatives.finish()  # Before the router removes the attempt files they read
+    router.close()
+    journal.close()
+
+    print("\n" + "="*50)
+    print("Image generation complete!")
+    print(f"Successfully generated: {success_count}/{success_count + journal.failed_count} images")
+    if journal.failed:
+        print(f"Still failed: {len(journal.failed)} ({journal.exhausted(max_attempts)} out of retries), see {journal.path}")
+    if cache:
+        print(f"Reused from cache: {cache.hits}")
+    router.print_summary()
+    if derivative_counts:
+        print(f"Derivatives written for {derivative_counts[0]} images ({derivative_counts[1]} failed)")
+    instrumentation.print_summary()
+    if args.metrics_file:
+        instrumentation.write_metrics(args.metrics_file)
+        print(f"Stage metrics written to {args.metrics_file}")
+    print(f"Output directory: {os.path.abspath(args.output)}")
+    print("="*50)
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\nOperation cancelled by user.")
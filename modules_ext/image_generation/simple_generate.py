@@ -1,16 +1,18 @@
 import os
-import torch
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+import contextlib
 from pathlib import Path
 import argparse
 from tqdm import tqdm
 from PIL import Image
-
-# Check for CUDA availability
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-print(f"Using device: {device}")
-print(f"Using torch dtype: {torch_dtype}")
+from embedding_cache import PromptEmbeddingCache, prompt_kwargs
+from output_cache import OutputCache, cache_key
+from generation_worker import DEFAULT_WORKER_URL, worker_health, submit_job, wait_for_job
+import derivatives
+import instrumentation
+from cpu_inference import CpuProfile
+from atomic import save_image, remove_temp_files
+from manifest import read_manifest
+from journal import RunJournal, JOURNAL_FILENAME, DEFAULT_RETRY_FAILED, JournalMismatch
 
 # Default configuration
 DEFAULT_INPUT_FILE = 'img_desc.txt'
@@ -22,12 +24,23 @@ no shading, white background, suitable for children's coloring book,
 simple and clear outlines, minimal details, no text, no watermark
 """
 
-def load_model(model_name, torch_dtype=torch.float16):
+def detect_device():
+    """Return ``(device, torch_dtype)``: float16 on a GPU, float32 on the CPU."""
+    import torch
+    if torch.cuda.is_available():
+        return torch.device("cuda"), torch.float16
+    return torch.device("cpu"), torch.float32
+
+def load_model(model_name, torch_dtype=None):
     """Load the model with optimized settings for GPU."""
+    import torch
+    from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
+
+    device, default_dtype = detect_device()
     print(f"Loading model: {model_name}")
     pipe = StableDiffusionPipeline.from_pretrained(
         model_name,
-        torch_dtype=torch_dtype,
+        torch_dtype=torch_dtype or default_dtype,
         safety_checker=None,  # Disable safety checker for better performance
         requires_safety_checker=False
     ).to(device)
@@ -46,23 +59,53 @@ def load_model(model_name, torch_dtype=torch.float16):
     
     return pipe
 
-def generate_image(pipe, prompt, style, output_path, steps=30, guidance_scale=7.5):
+def generate_image(pipe, prompt, style, output_path, steps=30, guidance_scale=7.5, embedding_cache=None):
     """Generate a single image with the given prompt and style."""
+    import torch
     full_prompt = f"{prompt}, {style}"
     print(f"Generating image for: {prompt}")
     
     with torch.inference_mode():
         image = pipe(
-            full_prompt,
+            **prompt_kwargs(pipe, full_prompt, cache=embedding_cache),
             num_inference_steps=steps,
             guidance_scale=guidance_scale,
-            generator=torch.Generator(device).manual_seed(42)  # For reproducibility
+            generator=torch.Generator(pipe.device).manual_seed(42)  # For reproducibility
         ).images[0]
     
-    image.save(output_path)
+    save_image(image, output_path)
+    derivatives.after_save(output_path)
     return image
 
 def main():
+    parser = argparse.ArgumentParser(description='Generate coloring book images with a fixed Stable Diffusion setup')
+    parser.add_argument('--derivatives', action='store_true',
+                      help='Also write WebP/AVIF thumbnails and an LQIP placeholder after each save')
+    parser.add_argument('--derivative-workers', type=int, default=None,
+                      help='Processes for --derivatives (default: CPU count)')
+    parser.add_argument('--start-offset', type=int, default=0,
+                      help='Byte offset in the input file to start reading at (default: 0)')
+    parser.add_argument('--cpu-optimized', action='store_true',
+                      help='On a machine without a GPU, pin threads and use channels_last and bfloat16 where supported')
+    parser.add_argument('--resume', action='store_true',
+                      help='Carry on where the last run stopped, using the journal in the output directory')
+    parser.add_argument('--retry-failed', type=int, default=DEFAULT_RETRY_FAILED,
+                      help=f'Extra attempts for images that fail (default: {DEFAULT_RETRY_FAILED})')
+    parser.add_argument('--metrics-file', default=None,
+                      help='Write per-stage timings here in Prometheus text format when the run ends')
+    parser.add_argument('--trace-log', default=None,
+                      help='Append a JSON line with the stage timings of every image to this file')
+    args = parser.parse_args()
+    if args.trace_log:
+        instrumentation.enable_trace_log(args.trace_log)
+
+    # torch and diffusers are imported only now, so --help stays fast
+    import torch
+    from diffusers import StableDiffusionPipeline
+    device, torch_dtype = detect_device()
+    print(f"Using device: {device}")
+    print(f"Using torch dtype: {torch_dtype}")
+
     print("\n" + "="*50)
     print("Kids Coloring AI - Simple Image Generator (GPU)")
     print("="*50)
@@ -75,67 +118,163 @@ def main():
     output_dir.mkdir(parents=True, exist_ok=True)
     print(f"Output directory: {output_dir}")
 
-    # Load the model
-    print(f"Loading model: {DEFAULT_MODEL}")
-    pipe = StableDiffusionPipeline.from_pretrained(
-        DEFAULT_MODEL,
-        torch_dtype=torch_dtype,
-        safety_checker=None,
-        requires_safety_checker=False
-    ).to(device)
-    
-    # Enable attention slicing for lower memory usage
-    pipe.enable_attention_slicing()
+    # Use a resident worker with the same model if one is running,
+    # otherwise the model is loaded on the first cache miss
+    health = worker_health(DEFAULT_WORKER_URL)
+    worker_model = health['model'] if health else None
+    if worker_model == DEFAULT_MODEL:
+        print(f"Sending jobs to worker at {DEFAULT_WORKER_URL}")
+    pipes = {}  # model -> pipeline, for lines that pick their own model
+    cpu_profile = CpuProfile() if args.cpu_optimized and device.type == "cpu" else None
+    if cpu_profile:
+        print(f"Using CPU-optimized profile: {cpu_profile.describe()}")
+    embedding_caches = {}
+    cache = OutputCache(output_dir)
+    if args.derivatives:
+        derivatives.enable(args.derivative_workers)
     
     # Read image descriptions
     input_file = Path(DEFAULT_INPUT_FILE)
     if not input_file.exists():
         print(f"Error: Input file '{input_file}' not found.")
         return
+    try:
+        journal = RunJournal(str(output_dir / JOURNAL_FILENAME), input_file, resume=args.resume)
+    except JournalMismatch as e:
+        print(f"Error: {e}")
+        return
+    start_offset = args.start_offset or journal.checkpoint
+    if args.resume:
+        remove_temp_files(output_dir, journal.previous_pids)
+        print(f"Resuming at byte {start_offset} with {len(journal.failed)} failed images from earlier runs")
 
     success_count = 0
-    total_count = 0
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-                
-            total_count += 1
+    def generate(record):
+        """Produce one image from the cache, the worker or a local pipeline; returns True on success."""
+        nonlocal worker_model
+        filename, description = record.filename, record.description
+        model = record.model or DEFAULT_MODEL
+        seed = 42 if record.seed is None else record.seed  # Fixed for reproducibility
+        steps = record.steps or 30
+        with instrumentation.trace(filename, backend='simple') as entry:
             try:
-                if '|' in line:
-                    filename, description = line.split('|', 1)
-                    filename = filename.strip()
-                    description = description.strip()
-                else:
-                    filename = f"image_{total_count:03d}.jpg"
-                    description = line
-                
                 output_path = output_dir / filename
-                
+            
+                # Reuse a previous result for the exact same settings. The worker renders through
+                # generate_local_diffusers, with its own prompt joiner and scheduler, so its images
+                # are keyed as 'diffusers' renders and never stand in for this script's own
+                local_key = cache_key('diffusers-simple', model, description, DEFAULT_STYLE, None,
+                                      record.width, record.height, steps, 7.5, seed=seed)
+                if worker_model == model:
+                    key = cache_key('diffusers', model, description, DEFAULT_STYLE, '',
+                                    record.width or 512, record.height or 512, steps, 7.5, seed=seed)
+                else:
+                    key = local_key
+                if cache.fetch(key, str(output_path)):
+                    print(f"Cached: {output_path}")
+                    journal.finished(record, True)
+                    return True
+            
+                journal.started(record)
+                if worker_model == model:
+                    size = {'width': record.width, 'height': record.height} if record.width else {}
+                    try:
+                        job = wait_for_job(DEFAULT_WORKER_URL, submit_job(
+                            DEFAULT_WORKER_URL, description, output_path, seed=seed, steps=steps,
+                            style=DEFAULT_STYLE, negative_prompt='', **size))
+                    except OSError as e:
+                        job = {'status': 'failed', 'error': f"worker stopped taking jobs ({e})"}
+                    if job['status'] == 'done':
+                        derivatives.after_save(output_path)  # The worker saved it
+                        print(f"✓ Saved: {output_path}")
+                        cache.store(key, str(output_path), description)
+                        journal.finished(record, True)
+                        return True
+                    if 'error' not in job:
+                        raise RuntimeError("worker could not generate the image (see worker log)")
+                    # The worker is gone or stuck: generate this and every later image here
+                    print(f"{job['error']}, loading {model} locally")
+                    worker_model = None
+                    key = local_key
+            
+                if model not in pipes:
+                    print(f"Loading model: {model}")
+                    with instrumentation.stage('model_load'):
+                        pipe = StableDiffusionPipeline.from_pretrained(
+                            model,
+                            torch_dtype=torch_dtype,
+                            safety_checker=None,
+                            requires_safety_checker=False
+                        ).to(device)
+                    
+                        if cpu_profile:
+                            cpu_profile.apply(pipe, model)
+                        else:
+                            # Enable attention slicing for lower memory usage
+                            pipe.enable_attention_slicing()
+                    pipes[model] = instrumentation.instrument_pipeline(pipe)
+                    embedding_caches[model] = PromptEmbeddingCache(model)
+                pipe = pipes[model]
+            
                 print(f"\nGenerating: {output_path}")
                 print(f"Prompt: {description}")
-                
+            
                 # Generate the image
-                image = pipe(
-                    f"{description}, {DEFAULT_STYLE}",
-                    num_inference_steps=30,
-                    guidance_scale=7.5,
-                    generator=torch.Generator(device).manual_seed(42)
-                ).images[0]
-                
+                size = {'width': record.width, 'height': record.height} if record.width else {}
+                with cpu_profile.autocast() if cpu_profile else contextlib.nullcontext():
+                    image = pipe(
+                        **prompt_kwargs(pipe, f"{description}, {DEFAULT_STYLE}", cache=embedding_caches[model]),
+                        num_inference_steps=steps,
+                        guidance_scale=7.5,
+                        generator=torch.Generator(device).manual_seed(seed),
+                        **size
+                    ).images[0]
+            
                 # Save the image
-                image.save(output_path)
+                with instrumentation.stage('save'):
+                    save_image(image, output_path)
+                derivatives.after_save(output_path)
                 print(f"✓ Saved: {output_path}")
-                success_count += 1
-                
+                cache.store(key, str(output_path), description)
+                journal.finished(record, True)
+                return True
+            
             except Exception as e:
-                print(f"✗ Error generating {filename if 'filename' in locals() else 'image'}: {str(e)}")
+                print(f"✗ Error generating {filename}: {str(e)}")
+                journal.finished(record, False, str(e))
+                entry['ok'] = False
+                return False
+
+    for record in read_manifest(input_file, start_offset, default_name='image_{index:03d}.jpg'):
+        success_count += generate(record)
+    
+    # Give failed images, including ones left over from earlier runs, a bounded number of retries
+    max_attempts = 1 + args.retry_failed
+    for _ in range(args.retry_failed):
+        retries = journal.retryable(max_attempts)
+        if not retries:
+            break
+        print(f"\nRetrying {len(retries)} failed images")
+        for record in retries:
+            success_count += generate(record)
+    journal.close()
 
     print("\n" + "="*50)
     print("Image generation complete!")
-    print(f"Successfully generated: {success_count}/{total_count} images")
+    print(f"Successfully generated: {success_count}/{success_count + journal.failed_count} images")
+    if journal.failed:
+        print(f"Still failed: {len(journal.failed)} ({journal.exhausted(max_attempts)} out of retries), see {journal.path}")
+    print(f"Reused from cache: {cache.hits}")
+    for embedding_cache in embedding_caches.values():
+        print(f"Prompt embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} misses")
+    derivative_counts = derivatives.finish()
+    if derivative_counts:
+        print(f"Derivatives written for {derivative_counts[0]} images ({derivative_counts[1]} failed)")
+    instrumentation.print_summary()
+    if args.metrics_file:
+        instrumentation.write_metrics(args.metrics_file)
+        print(f"Stage metrics written to {args.metrics_file}")
     print(f"Output directory: {output_dir}")
     print("="*50 + "\n")
 
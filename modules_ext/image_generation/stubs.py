@@ -0,0 +1,266 @@
+import io
+import os
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import statistics
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageDraw
+
+# Default configuration
+DEFAULT_LATENCY = 0.05  # Seconds a stubbed remote prediction takes
+TINY_MODEL_DIRNAME = 'tiny-sd'
+
+def stub_image(prompt, width, height):
+    """A deterministic line drawing for ``prompt``: the same prompt and size always give the same image."""
+    rng = random.Random(hashlib.sha256(f"{prompt}\0{width}x{height}".encode('utf-8')).digest())
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(24):
+        x0, x1 = sorted(rng.randrange(width) for _ in range(2))
+        y0, y1 = sorted(rng.randrange(height) for _ in range(2))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), outline='black', width=3)
+        else:
+            draw.line((x0, y0, x1, y1), fill='black', width=3)
+    return image
+
+def stub_png(prompt, width, height):
+    buffer = io.BytesIO()
+    stub_image(prompt, width, height).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+class StageTimer:
+    """Collect wall-clock durations per named stage. Safe to use from several threads."""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+    def wrap_async(self, stage, func):
+        async def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        return timed
+
+    def wrap_iter(self, stage, func):
+        """Wrap a generator function, timing each step of the iteration."""
+        def timed(*args, **kwargs):
+            iterator = iter(func(*args, **kwargs))
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    self.add(stage, time.perf_counter() - started)
+                yield item
+        return timed
+
+    def hook_module(self, stage, module):
+        """Time every forward call of a torch module."""
+        starts = {}
+        module.register_forward_pre_hook(lambda *_: starts.__setitem__(threading.get_ident(), time.perf_counter()))
+        module.register_forward_hook(
+            lambda *_: self.add(stage, time.perf_counter() - starts.pop(threading.get_ident())))
+
+    def summary(self):
+        """Per stage: call count, total, mean, p50 and p95 in milliseconds."""
+        result = {}
+        for stage, values in sorted(self.durations.items()):
+            ordered = sorted(values)
+            result[stage] = {
+                'count': len(values),
+                'total_ms': round(sum(values) * 1000, 2),
+                'mean_ms': round(statistics.fmean(values) * 1000, 3),
+                'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+                'p95_ms': round(ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000, 3),
+            }
+        return result
+
+# Replicate
+
+class _ImageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the CDN the real client downloads from
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.images.pop(self.path, None)
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def install_replicate_stub(latency=DEFAULT_LATENCY, timer=None):
+    """Replace ``replicate.run`` with a deterministic local stand-in.
+
+    Each prediction sleeps for ``latency``, renders a stub image and returns
+    a URL on a loopback HTTP server, so the generator's download path runs
+    for real without any network. Returns the server; call ``shutdown()``.
+    """
+    import replicate
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ImageHandler)
+    server.images = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    counter = iter(range(1 << 62))
+
+    def run(model, input=None, **kwargs):
+        time.sleep(latency)
+        input = input or {}
+        path = f"/{next(counter)}.png"
+        server.images[path] = stub_png(input.get('prompt', ''), input.get('width', 512), input.get('height', 512))
+        return [f"http://127.0.0.1:{server.server_address[1]}{path}"]
+
+    replicate.run = timer.wrap('predict', run) if timer else run
+    return server
+
+# Ollama
+
+def install_ollama_stub(latency=DEFAULT_LATENCY, timer=None):
+    """Replace ``ollama.generate``, ``ollama.AsyncClient`` and ``ollama.list`` with deterministic local stand-ins."""
+    import ollama
+
+    def respond(prompt, options):
+        options = options or {}
+        return {'image': stub_png(prompt, options.get('width', 512), options.get('height', 512))}
+
+    def generate(model=None, prompt='', images=None, options=None, **kwargs):
+        time.sleep(latency)
+        return respond(prompt, options)
+
+    class AsyncClient:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def generate(self, model=None, prompt='', images=None, options=None, **kwargs):
+            await asyncio.sleep(latency)
+            return respond(prompt, options)
+
+    if timer:
+        generate = timer.wrap('predict', generate)
+        AsyncClient.generate = timer.wrap_async('predict', AsyncClient.generate)
+    ollama.generate = generate
+    ollama.AsyncClient = AsyncClient
+    ollama.list = lambda: {'models': [{'name': 'stub:latest', 'digest': '0' * 64}]}
+
+# Stable Diffusion
+
+def _write_tokenizer(path):
+    """A character-level CLIP tokenizer: every byte is a token, there are no merges."""
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    vocab = {token: i for i, token in enumerate(chars + [c + '</w>' for c in chars])}
+    vocab['<|startoftext|>'] = len(vocab)
+    vocab['<|endoftext|>'] = len(vocab)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'vocab.json'), 'w', encoding='utf-8') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(path, 'merges.txt'), 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+    return len(vocab)
+
+def tiny_pipeline_dir(cache_dir):
+    """Build (once) a tiny randomly initialised Stable Diffusion pipeline and return its directory.
+
+    Every component has the real architecture, including the VAE's 8x
+    downscale, but only a few narrow layers, so a 512x512 image costs
+    seconds on a CPU. Weights come from a fixed seed, so repeated builds
+    are identical.
+    """
+    import torch
+    from transformers import CLIPTokenizer, CLIPTextConfig, CLIPTextModel
+    from diffusers import StableDiffusionPipeline, UNet2DConditionModel, AutoencoderKL, DDIMScheduler
+
+    path = os.path.join(cache_dir, TINY_MODEL_DIRNAME)
+    if os.path.exists(os.path.join(path, 'model_index.json')):
+        return path
+
+    vocab_size = _write_tokenizer(os.path.join(cache_dir, 'tokenizer-src'))
+    tokenizer = CLIPTokenizer(os.path.join(cache_dir, 'tokenizer-src', 'vocab.json'),
+                              os.path.join(cache_dir, 'tokenizer-src', 'merges.txt'), model_max_length=77)
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=vocab_size, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=77, projection_dim=64,
+    ))
+    unet = UNet2DConditionModel(
+        sample_size=64, in_channels=4, out_channels=4, layers_per_block=1, block_out_channels=(32, 64),
+        down_block_types=('CrossAttnDownBlock2D', 'DownBlock2D'), up_block_types=('UpBlock2D', 'CrossAttnUpBlock2D'),
+        cross_attention_dim=64, attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        in_channels=3, out_channels=3, latent_channels=4, block_out_channels=(32, 32, 64, 64), norm_num_groups=16,
+        down_block_types=('DownEncoderBlock2D',) * 4, up_block_types=('UpDecoderBlock2D',) * 4,
+    )
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear',
+                              clip_sample=False, set_alpha_to_one=False, steps_offset=1)
+    pipe = StableDiffusionPipeline(
+        vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet, scheduler=scheduler,
+        safety_checker=None, feature_extractor=None, requires_safety_checker=False,
+    )
+    pipe.save_pretrained(path)
+    return path
+
+class StubPipelineLoader:
+    """Stands in for ``diffusers.StableDiffusionPipeline``.
+
+    ``from_pretrained`` loads the tiny pipeline whatever model id it is
+    given, and times the text encoder, each UNet step and the VAE decode.
+    """
+
+    def __init__(self, pipeline_class, model_dir, timer=None):
+        self.pipeline_class = pipeline_class
+        self.model_dir = model_dir
+        self.timer = timer
+
+    def from_pretrained(self, model_name, **kwargs):
+        kwargs.pop('requires_safety_checker', None)
+        pipe = self.pipeline_class.from_pretrained(self.model_dir, **kwargs)
+        if self.timer:
+            self.timer.hook_module('text_encoder', pipe.text_encoder)
+            self.timer.hook_module('unet_step', pipe.unet)
+            pipe.vae.decode = self.timer.wrap('vae_decode', pipe.vae.decode)
+        return pipe
+
+def install_diffusers_stub(model_dir, timer=None):
+    """Make the generators load the tiny pipeline instead of a real checkpoint.
+
+    They import ``StableDiffusionPipeline`` from diffusers only when they
+    load a model, so patching the package attribute is enough.
+    """
+    import diffusers
+
+    pipeline_class = diffusers.StableDiffusionPipeline
+    if isinstance(pipeline_class, StubPipelineLoader):
+        pipeline_class = pipeline_class.pipeline_class
+    diffusers.StableDiffusionPipeline = StubPipelineLoader(pipeline_class, model_dir, timer)